@@ -136,3 +136,16 @@ The name of the registry service
 {{- .Values.registry.serviceName -}}
 {{- end -}}
 {{- end -}}
+
+{{/*
+The address of the registry mirror used for base images, empty if none
+*/}}
+{{- define "reproserver.registryMirror" -}}
+{{- if .Values.mirror.enabled -}}
+{{- include "registry.fullname" .Subcharts.mirror -}}:5000
+{{- else if and .Values.registry.enabled .Values.registry.proxy.enabled -}}
+{{- include "registry.fullname" .Subcharts.registry -}}:5000
+{{- else -}}
+{{- .Values.mirror.address -}}
+{{- end -}}
+{{- end -}}
@@ -6,7 +6,8 @@ from sqlalchemy import Column, ForeignKey, create_engine
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.types import Boolean, DateTime, Integer, String, Text
+from sqlalchemy.types import BigInteger, Boolean, DateTime, Float, \
+    Integer, String, Text
 import sys
 import time
 
@@ -19,6 +20,11 @@ logger = logging.getLogger(__name__)
 Base = declarative_base()
 
 
+# Name of the output file holding the whole output of a run, when its log was
+# cut short
+LOG_ARCHIVE_NAME = '.reproserver-log.gz'
+
+
 class Experiment(Base):
     """Experiments available on the server.
 
@@ -155,6 +161,39 @@ class Path(Base):
             self.id, self.experiment_hash, descr, self.name)
 
 
+class Sweep(Base):
+    """A group of runs, one per combination of parameter values.
+
+    They are submitted together, and share the setup of their container when
+    the runner allows it.
+    """
+    __tablename__ = 'sweeps'
+
+    id = Column(Integer, primary_key=True)
+    experiment_hash = Column(String(64), ForeignKey('experiments.hash',
+                                                    ondelete='CASCADE'))
+    experiment = relationship('Experiment', uselist=False)
+    upload_id = Column(Integer, ForeignKey('uploads.id',
+                                           ondelete='RESTRICT'))
+    upload = relationship('Upload', uselist=False)
+    submitted = Column(DateTime, nullable=False,
+                       default=lambda: datetime.utcnow())
+
+    runs = relationship('Run', back_populates='sweep', order_by='Run.id')
+
+    @property
+    def short_id(self):
+        return sweep_short_ids.encode(self.id)
+
+    @staticmethod
+    def decode_id(short_id):
+        return sweep_short_ids.decode(short_id)
+
+    def __repr__(self):
+        return "<Sweep id=%d, experiment_hash=%r, %d runs>" % (
+            self.id, self.experiment_hash, len(self.runs))
+
+
 class Run(Base):
     """A run.
 
@@ -175,17 +214,51 @@ class Run(Base):
                        default=lambda: datetime.utcnow())
     started = Column(DateTime, nullable=True)
     done = Column(DateTime, nullable=True)
+    # Whether the run completed successfully, once done
+    succeeded = Column(Boolean, nullable=False, default=False)
 
     progress_percent = Column(Integer, nullable=False, default=0)
     progress_text = Column(Text, nullable=False, default='')
 
     submitted_ip = Column(Text, nullable=True)
 
+    # Requested wall-clock limit in seconds, capped by the deployment setting
+    timeout = Column(Integer, nullable=True)
+
+    # Last time the proxy was used to connect to the run
+    last_activity = Column(DateTime, nullable=True)
+
+    # Stopped for being idle, will be restarted by the proxy when used
+    sleeping = Column(Boolean, nullable=False, default=False)
+
+    # Identifies the experiment, parameters and inputs, to reuse the results
+    # of identical runs. Cleared if the run fails
+    cache_key = Column(String(64), nullable=True, index=True)
+
+    # Run whose results were copied instead of running the experiment again
+    reused_run_id = Column(Integer, ForeignKey('runs.id', ondelete='SET NULL'),
+                           nullable=True)
+
+    # Sweep this run is part of, if any
+    sweep_id = Column(Integer, ForeignKey('sweeps.id', ondelete='SET NULL'),
+                      nullable=True)
+    sweep = relationship('Sweep', uselist=False, back_populates='runs')
+
+    # Resources used by the container while running the experiment
+    cpu_seconds = Column(Float, nullable=True)
+    memory_peak = Column(BigInteger, nullable=True)
+    disk_read = Column(BigInteger, nullable=True)
+    disk_write = Column(BigInteger, nullable=True)
+    network_rx = Column(BigInteger, nullable=True)
+    network_tx = Column(BigInteger, nullable=True)
+
     parameter_values = relationship('ParameterValue', back_populates='run')
     input_files = relationship('InputFile', back_populates='run')
     ports = relationship('RunPort', back_populates='run')
 
     log = relationship('RunLogLine', back_populates='run')
+    events = relationship('RunEvent', back_populates='run',
+                          order_by='RunEvent.start')
     output_files = relationship('OutputFile', back_populates='run')
     extension_results = relationship('RunExtensionResult',
                                      back_populates='run')
@@ -203,6 +276,21 @@ class Run(Base):
     def get_log(self, from_line=0):
         return [log.line for log in self.log[from_line:]]
 
+    @property
+    def experiment_output_files(self):
+        """The output files, without the archived log.
+        """
+        return [f for f in self.output_files if f.name != LOG_ARCHIVE_NAME]
+
+    @property
+    def log_archive(self):
+        """The output file with the whole log, if it was cut short.
+        """
+        for output_file in self.output_files:
+            if output_file.name == LOG_ARCHIVE_NAME:
+                return output_file
+        return None
+
     def __repr__(self):
         if self.done:
             status = "done"
@@ -234,6 +322,25 @@ class RunLogLine(Base):
         return "<RunLogLine id=%d, run_id=%d>" % (self.id, self.run_id)
 
 
+class RunEvent(Base):
+    """A phase of a run, such as waiting in the queue or extracting the RPZ.
+    """
+    __tablename__ = 'run_events'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('runs.id', ondelete='CASCADE'),
+                    index=True)
+    run = relationship('Run', uselist=False, back_populates='events')
+    phase = Column(String(32), nullable=False)
+    start = Column(DateTime, nullable=False)
+    end = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return "<RunEvent id=%d, run_id=%d, phase=%r>" % (
+            self.id, self.run_id, self.phase,
+        )
+
+
 class ParameterValue(Base):
     """A value for a parameter in a run.
     """
@@ -276,6 +383,9 @@ class InputFile(Base):
     name = Column(Text, nullable=False)
     size = Column(Integer, nullable=False)
 
+    # Bucket the file is in, 'outputs' if it is the output of another run
+    bucket = Column(String(16), nullable=False, default='inputs')
+
     def __repr__(self):
         return "<InputFile id=%d, run_id=%d, hash=%r, name=%r>" % (
             self.id, self.run_id, self.hash, self.name)
@@ -392,9 +502,10 @@ def connect(url=None, *, create=False):
             raise RuntimeError("Database exists but no shortids_salt set")
         shortids_salt = b64decode(shortids_salt.value.encode('ascii'))
 
-    global run_short_ids, upload_short_ids
+    global run_short_ids, upload_short_ids, sweep_short_ids
     run_short_ids = ShortIDs(b'run' + shortids_salt)
     upload_short_ids = ShortIDs(b'upload' + shortids_salt)
+    sweep_short_ids = ShortIDs(b'sweep' + shortids_salt)
 
     return DBSession
 
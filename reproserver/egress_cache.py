@@ -0,0 +1,569 @@
+import asyncio
+import base64
+import collections
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import prometheus_client
+import re
+import tempfile
+import time
+from tornado import httputil
+from tornado.http1connection import HTTP1Connection, \
+    HTTP1ConnectionParameters
+from tornado.iostream import StreamClosedError
+import tornado.ioloop
+from tornado.routing import URLSpec
+from tornado.tcpclient import TCPClient
+import tornado.web
+import urllib.parse
+
+from . import __version__
+from .proxy import Health
+from .utils import setup
+from .web.base import GracefulApplication, HideStreamClosedHandler
+
+
+logger = logging.getLogger(__name__)
+
+
+# How requests were answered
+RESULTS = ('hit', 'miss', 'uncached', 'tunnel', 'error')
+
+PROM_EGRESS_REQUESTS = prometheus_client.Counter(
+    'egress_cache_requests_total',
+    "Requests through the egress cache",
+    ['result'],
+)
+PROM_EGRESS_BYTES = prometheus_client.Counter(
+    'egress_cache_bytes_total',
+    "Bytes sent to runs through the egress cache",
+    ['result'],
+)
+for result in RESULTS:
+    PROM_EGRESS_REQUESTS.labels(result).inc(0)
+    PROM_EGRESS_BYTES.labels(result).inc(0)
+
+PROM_EGRESS_CACHE_SIZE = prometheus_client.Gauge(
+    'egress_cache_size_bytes',
+    "Size of the responses in the egress cache",
+)
+
+
+# Headers that only apply to one connection, not forwarded
+HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+
+# Don't keep statistics for more runs than this
+STATS_MAX_RUNS = 10000
+
+# Largest response the proxy will forward
+MAX_BODY_SIZE = 100_000_000_000
+
+# Timeouts for the upstream servers, in seconds
+CONNECT_TIMEOUT = 30
+REQUEST_TIMEOUT = 3600
+
+_run_user = re.compile(r'^run([0-9]+)$')
+
+
+class DiskCache(object):
+    """Responses stored on disk, the least recently used ones are removed.
+
+    Each entry is a file named by the hash of its key, with a line of JSON
+    metadata followed by the body.
+    """
+    def __init__(self, directory, max_size, max_object_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        # Load existing entries, least recently used first
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith('.'):
+                # Leftover from an interrupted download
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            existing.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self.entries[name] = size
+            self.size += size
+        self._evict()
+
+    @staticmethod
+    def key(url, accept_encoding):
+        return hashlib.sha256(
+            ('%s\n%s' % (url, accept_encoding)).encode('utf-8'),
+        ).hexdigest()
+
+    def get(self, key):
+        """Open a fresh entry, returns ``(metadata, file)`` or None.
+        """
+        if key not in self.entries:
+            return None
+        path = os.path.join(self.directory, key)
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            self._remove(key)
+            return None
+        meta = json.loads(fp.readline())
+        if meta['expires'] < time.time():
+            fp.close()
+            return None
+        self.entries.move_to_end(key)
+        os.utime(path)
+        return meta, fp
+
+    def start(self, key, meta, length=None):
+        """Start storing a response, returns a writer or None if too big.
+        """
+        if length is not None and length > self.max_object_size:
+            return None
+        return CacheWriter(self, key, meta)
+
+    def _add(self, key, size):
+        self._remove(key, delete=False)
+        self.entries[key] = size
+        self.size += size
+        self._evict()
+
+    def _remove(self, key, delete=True):
+        size = self.entries.pop(key, None)
+        if size is not None:
+            self.size -= size
+            if delete:
+                try:
+                    os.remove(os.path.join(self.directory, key))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            key = next(iter(self.entries))
+            logger.info("Evicting %s from cache", key)
+            self._remove(key)
+        PROM_EGRESS_CACHE_SIZE.set(self.size)
+
+
+class CacheWriter(object):
+    """Writes a response to the cache as it is received.
+    """
+    def __init__(self, cache, key, meta):
+        self.cache = cache
+        self.key = key
+        self.fp = tempfile.NamedTemporaryFile(
+            dir=cache.directory, prefix='.', delete=False,
+        )
+        self.fp.write(json.dumps(meta).encode('utf-8') + b'\n')
+        self.body_size = 0
+
+    def write(self, chunk):
+        if self.fp is None:
+            return
+        self.body_size += len(chunk)
+        if self.body_size > self.cache.max_object_size:
+            self.abort()
+            return
+        self.fp.write(chunk)
+
+    def commit(self):
+        if self.fp is None:
+            return
+        self.fp.close()
+        size = os.path.getsize(self.fp.name)
+        os.rename(self.fp.name, os.path.join(self.cache.directory, self.key))
+        self.fp = None
+        self.cache._add(self.key, size)
+
+    def abort(self):
+        if self.fp is None:
+            return
+        self.fp.close()
+        os.remove(self.fp.name)
+        self.fp = None
+
+
+class RunStats(object):
+    """Counts the requests of each run, so runners can report them.
+    """
+    def __init__(self):
+        self.runs = collections.OrderedDict()
+
+    def count(self, run_id, result, size):
+        if run_id is None:
+            return
+        stats = self.runs.get(run_id)
+        if stats is None:
+            stats = self.runs[run_id] = {
+                name: {'requests': 0, 'bytes': 0} for name in RESULTS
+            }
+            while len(self.runs) > STATS_MAX_RUNS:
+                self.runs.popitem(last=False)
+        stats[result]['requests'] += 1
+        stats[result]['bytes'] += size
+
+    def get(self, run_id):
+        return self.runs.get(run_id)
+
+
+def cache_lifetime(headers, default_ttl):
+    """Get how long a response can be cached, None if it can't be.
+
+    Responses that don't say how long they are fresh for are only kept for
+    ``default_ttl`` if they have a validator (Last-Modified or ETag), as a
+    sign that they are static files.
+    """
+    if 'Set-Cookie' in headers:
+        return None
+    vary = headers.get('Vary', '').strip().lower()
+    if vary not in ('', 'accept-encoding'):
+        return None
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().lower().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                lifetime = int(directives[name], 10)
+            except ValueError:
+                return None
+            return lifetime if lifetime > 0 else None
+    if 'no-cache' in directives:
+        return None
+    if 'Expires' in headers:
+        expires = _parse_date(headers['Expires'])
+        if expires is None:
+            # Invalid dates mean the response is already expired
+            return None
+        date = _parse_date(headers.get('Date', '')) or time.time()
+        lifetime = int(expires - date)
+        return lifetime if lifetime > 0 else None
+    if 'Last-Modified' in headers or 'ETag' in headers:
+        return default_ttl
+    return None
+
+
+def _parse_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class EgressCacheApplication(GracefulApplication):
+    def __init__(self, cache, *, default_ttl, **settings):
+        self.cache = cache
+        self.default_ttl = default_ttl
+        self.stats = RunStats()
+        super(EgressCacheApplication, self).__init__(
+            [
+                URLSpec('/health', Health),
+                URLSpec('/stats/([0-9]+)', RunStatsHandler),
+                URLSpec('.*', EgressCacheHandler),
+            ],
+            **settings,
+        )
+
+    def log_request(self, handler):
+        if isinstance(handler, Health):
+            return
+        super(EgressCacheApplication, self).log_request(handler)
+
+
+class RunStatsHandler(tornado.web.RequestHandler):
+    def get(self, run_id):
+        stats = self.application.stats.get(int(run_id, 10))
+        if stats is None:
+            self.set_status(404)
+            return self.finish({'error': "No requests from this run"})
+        return self.finish(stats)
+
+
+class EgressCacheHandler(HideStreamClosedHandler):
+    """Forward proxy, caching the responses to plain HTTP GET requests.
+
+    HTTPS goes through CONNECT tunnels, which can't be cached without
+    intercepting TLS.
+    """
+    SUPPORTED_METHODS = (
+        'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS', 'CONNECT',
+    )
+
+    def __init__(self, application, request, **kwargs):
+        super(EgressCacheHandler, self).__init__(
+            application, request, **kwargs
+        )
+        self.answering = False
+        self.writer = None
+        self.sent = 0
+
+    def check_xsrf_cookie(self):
+        pass
+
+    def set_default_headers(self):
+        self.clear_header('Content-Type')
+        self.set_header('Via', '1.1 reproserver-egress/%s' % __version__)
+
+    def check_etag_header(self):
+        return False
+
+    def set_etag_header(self):
+        pass
+
+    def prepare(self):
+        # Runs identify themselves with the user in the proxy URL
+        self.run_id = None
+        auth = self.request.headers.get('Proxy-Authorization', '')
+        if auth[:6].lower() == 'basic ':
+            try:
+                user = base64.b64decode(auth[6:]).decode('utf-8')
+            except ValueError:
+                user = ''
+            m = _run_user.match(user.split(':', 1)[0])
+            if m is not None:
+                self.run_id = int(m.group(1), 10)
+
+    def count(self, result, size):
+        PROM_EGRESS_REQUESTS.labels(result).inc()
+        PROM_EGRESS_BYTES.labels(result).inc(size)
+        self.application.stats.count(self.run_id, result, size)
+
+    async def connect(self):
+        host, _, port = self.request.uri.rpartition(':')
+        try:
+            port = int(port, 10)
+        except ValueError:
+            self.set_status(400)
+            return await self.finish()
+        try:
+            upstream = await TCPClient().connect(host.strip('[]'), port)
+        except OSError:
+            self.count('error', 0)
+            self.set_status(502)
+            return await self.finish()
+        self.count('tunnel', 0)
+
+        client = self.detach()
+        await client.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+        async def pipe(from_stream, to_stream):
+            try:
+                while True:
+                    chunk = await from_stream.read_bytes(65536, partial=True)
+                    await to_stream.write(chunk)
+            except StreamClosedError:
+                pass
+            finally:
+                to_stream.close()
+
+        await asyncio.gather(pipe(client, upstream), pipe(upstream, client))
+
+    async def get(self):
+        url = self.request.uri
+        if not url.startswith('http://'):
+            self.set_status(400)
+            return await self.finish("Only proxy requests are accepted")
+
+        # Only plain GET requests are cached
+        key = None
+        if (
+            self.request.method == 'GET'
+            and not any(
+                h in self.request.headers
+                for h in ('Authorization', 'Cookie', 'Range')
+            )
+        ):
+            key = self.application.cache.key(
+                url,
+                self.request.headers.get('Accept-Encoding', ''),
+            )
+            entry = self.application.cache.get(key)
+            if entry is not None:
+                return await self._send_cached(*entry)
+
+        headers = httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name.lower() not in HOP_HEADERS:
+                headers.add(name, value)
+        headers['Connection'] = 'close'
+        if self.request.body:
+            headers['Content-Length'] = str(len(self.request.body))
+        parsed = urllib.parse.urlsplit(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        # Talk HTTP directly rather than through AsyncHTTPClient, so reading
+        # the response waits for the client to receive what we already sent
+        connection = None
+        try:
+            stream = await TCPClient().connect(
+                parsed.hostname, parsed.port or 80,
+                timeout=CONNECT_TIMEOUT,
+            )
+            connection = HTTP1Connection(
+                stream, True,
+                HTTP1ConnectionParameters(
+                    no_keep_alive=True,
+                    header_timeout=REQUEST_TIMEOUT,
+                    body_timeout=REQUEST_TIMEOUT,
+                    max_body_size=MAX_BODY_SIZE,
+                    decompress=False,
+                ),
+            )
+            await connection.write_headers(
+                httputil.RequestStartLine(self.request.method, path,
+                                          'HTTP/1.1'),
+                headers,
+                self.request.body or None,
+            )
+            connection.finish()
+            await connection.read_response(UpstreamResponse(self, key))
+        except Exception:
+            logger.info("Error fetching %s", url, exc_info=True)
+            if self.writer is not None:
+                self.writer.abort()
+            self.count('error', self.sent)
+            if self.answering:
+                # Already started answering, can only cut the connection
+                self.request.connection.close()
+                return
+            self.set_status(502)
+            return await self.finish()
+        finally:
+            if connection is not None:
+                connection.close()
+
+        if self.writer is not None:
+            self.writer.commit()
+            self.count('miss', self.sent)
+        else:
+            self.count('uncached', self.sent)
+        return await self.finish()
+
+    head = post = put = delete = patch = options = get
+
+    async def _send_cached(self, meta, fp):
+        with fp:
+            self.set_status(meta['status'], meta['reason'])
+            self._set_headers(meta['headers'])
+            self.set_header('X-Cache', 'HIT')
+            while True:
+                chunk = fp.read(65536)
+                if not chunk:
+                    break
+                self.sent += len(chunk)
+                self.write(chunk)
+                await self.flush()
+        self.count('hit', self.sent)
+        return await self.finish()
+
+    def _set_headers(self, headers):
+        # Replace our defaults (e.g. Date), but keep repeated headers
+        seen = set()
+        for name, value in headers:
+            if name.lower() in seen:
+                self.add_header(name, value)
+            else:
+                seen.add(name.lower())
+                self.set_header(name, value)
+
+    def _got_headers(self, first_line, response_headers, key):
+        self.answering = True
+        self.set_status(first_line.code, first_line.reason)
+        kept = []
+        for name, value in response_headers.get_all():
+            if name.lower() in HOP_HEADERS:
+                continue
+            if name.lower() == 'content-length' and (
+                self.request.method == 'HEAD'
+            ):
+                continue
+            kept.append((name, value))
+        self._set_headers(kept)
+
+        # Start storing the response if it can be cached
+        if key is not None and first_line.code == 200:
+            lifetime = cache_lifetime(
+                response_headers, self.application.default_ttl,
+            )
+            if lifetime is not None:
+                length = response_headers.get('Content-Length')
+                self.writer = self.application.cache.start(
+                    key,
+                    {
+                        'url': self.request.uri,
+                        'status': first_line.code,
+                        'reason': first_line.reason,
+                        'headers': kept,
+                        'expires': time.time() + lifetime,
+                    },
+                    length=int(length, 10) if length else None,
+                )
+        self.set_header('X-Cache', 'MISS')
+        return self.flush()
+
+    def _got_chunk(self, chunk):
+        if self.writer is not None:
+            self.writer.write(chunk)
+        self.sent += len(chunk)
+        self.write(chunk)
+        return self.flush()
+
+
+class UpstreamResponse(httputil.HTTPMessageDelegate):
+    """Passes the response of the upstream server on to the handler.
+
+    The futures returned pause reading from the server until the data was sent
+    to the client.
+    """
+    def __init__(self, handler, key):
+        self.handler = handler
+        self.key = key
+
+    def headers_received(self, start_line, headers):
+        return self.handler._got_headers(start_line, headers, self.key)
+
+    def data_received(self, chunk):
+        return self.handler._got_chunk(chunk)
+
+
+def make_app(**settings):
+    cache = DiskCache(
+        os.environ.get('EGRESS_CACHE_DIR', '/var/cache/reproserver-egress'),
+        int(os.environ.get('EGRESS_CACHE_SIZE_MB', '') or '10240', 10)
+        * 1_000_000,
+        int(os.environ.get('EGRESS_CACHE_MAX_OBJECT_MB', '') or '1024', 10)
+        * 1_000_000,
+    )
+    return EgressCacheApplication(
+        cache,
+        default_ttl=int(
+            os.environ.get('EGRESS_CACHE_TTL', '') or '86400',
+            10,
+        ),
+        **settings,
+    )
+
+
+def main():
+    setup()
+
+    app = make_app()
+    app.listen(3128, address='0.0.0.0')
+    loop = tornado.ioloop.IOLoop.current()
+    loop.start()
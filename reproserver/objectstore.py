@@ -92,6 +92,50 @@ class ObjectStore(object):
             Body=fileobj,
         )
 
+    def create_multipart_upload(self, bucket, objectname):
+        """Start uploading an object in parts, returns the upload ID.
+        """
+        return self.s3.meta.client.create_multipart_upload(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+        )['UploadId']
+
+    def upload_part(self, bucket, objectname, upload_id, number, data):
+        """Upload a part of a multipart upload, returns it for completing.
+        """
+        res = self.s3.meta.client.upload_part(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return {'PartNumber': number, 'ETag': res['ETag']}
+
+    def complete_multipart_upload(self, bucket, objectname, upload_id, parts):
+        self.s3.meta.client.complete_multipart_upload(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+
+    def abort_multipart_upload(self, bucket, objectname, upload_id):
+        self.s3.meta.client.abort_multipart_upload(
+            Bucket=self.bucket_name(bucket),
+            Key=objectname,
+            UploadId=upload_id,
+        )
+
+    def move_object(self, bucket, objectname, new_objectname):
+        bucket = self.bucket_name(bucket)
+        # The managed copy does a multipart copy for objects over 5 GB
+        self.s3.meta.client.copy(
+            {'Bucket': bucket, 'Key': objectname},
+            bucket, new_objectname,
+        )
+        self.s3.meta.client.delete_object(Bucket=bucket, Key=objectname)
+
     def upload_file(self, bucket, objectname, filename):
         with open(filename, 'rb') as fileobj:
             self.upload_fileobj(bucket, objectname, fileobj)
@@ -1,8 +1,11 @@
+import asyncio
+from datetime import datetime
 import itertools
 import logging
 import os
 import prometheus_client
 import re
+import time
 from tornado import httputil
 from tornado import httpclient
 import tornado.ioloop
@@ -28,6 +31,19 @@ for args in itertools.product(['http', 'ws'], ['success', 'error']):
     PROM_PROXY_REQUESTS.labels(*args).inc(0)
 
 
+# Only write the last activity time of a run to the database this often
+ACTIVITY_RECORD_INTERVAL = 60
+
+_last_recorded_activity = {}
+
+# How long to hold requests to a run that is being restarted
+WAKE_TIMEOUT = 90
+WAKE_RETRY_INTERVAL = 2
+
+# Runs woken up by this process, and until when to wait for them
+_waking_runs = {}
+
+
 class IsKubernetesProbe(tornado.routing.Matcher):
     def match(self, request):
         if 'X-Kubernetes-Probe' in request.headers:
@@ -49,7 +65,10 @@ class Health(tornado.web.RequestHandler):
 
 
 class ProxyApplication(GracefulApplication):
-    def __init__(self, handler, **settings):
+    def __init__(self, handler, DBSession=None, api_endpoint=None,
+                 **settings):
+        self.DBSession = DBSession
+        self.api_endpoint = api_endpoint
         super(ProxyApplication, self).__init__(
             [
                 (
@@ -95,6 +114,7 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
     def __init__(self, application, request, **kwargs):
         super(ProxyHandler, self).__init__(application, request, **kwargs)
         self.headers = []
+        self.run_id = None
 
     def check_xsrf_cookie(self):
         pass
@@ -114,6 +134,87 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
     def alter_request(self, request):
         pass
 
+    def record_activity(self):
+        """Record that the run is being used, so it is not reaped as idle.
+        """
+        DBSession = getattr(self.application, 'DBSession', None)
+        if self.run_id is None or DBSession is None:
+            return
+
+        now = time.monotonic()
+        last = _last_recorded_activity.get(self.run_id)
+        if last is not None and now < last + ACTIVITY_RECORD_INTERVAL:
+            return
+        if len(_last_recorded_activity) > 1000:
+            for run_id, last in list(_last_recorded_activity.items()):
+                if now >= last + ACTIVITY_RECORD_INTERVAL:
+                    del _last_recorded_activity[run_id]
+        _last_recorded_activity[self.run_id] = now
+
+        with DBSession() as db:
+            (
+                db.query(database.Run)
+                .filter(database.Run.id == self.run_id)
+                .update({database.Run.last_activity: datetime.utcnow()})
+            )
+            db.commit()
+
+    async def request_wake(self):
+        """Ask the runner to restart the run.
+        """
+        # If we are part of the web application, we have the runner
+        runner = getattr(self.application, 'runner', None)
+        if runner is not None:
+            return await runner.wake(self.run_id)
+
+        api_endpoint = getattr(self.application, 'api_endpoint', None)
+        if not api_endpoint:
+            return False
+        response = await httpclient.AsyncHTTPClient().fetch(
+            '%s/runners/run/%d/wake' % (api_endpoint.rstrip('/'), self.run_id),
+            method='POST',
+            body=b'',
+            headers={
+                'X-Reproserver-Authenticate':
+                    self.application.settings['connection_token'],
+            },
+            raise_error=False,
+        )
+        if response.code != 202:
+            logger.warning("Error waking run %r: %r", self.run_id, response)
+            return False
+        return True
+
+    async def should_retry(self):
+        """Check whether the run is restarting, waking it up if it was idle.
+
+        Returns True if the request should be held and retried.
+        """
+        DBSession = getattr(self.application, 'DBSession', None)
+        if self.run_id is None or DBSession is None:
+            return False
+
+        now = time.monotonic()
+        deadline = _waking_runs.get(self.run_id)
+        if deadline is not None and now >= deadline:
+            del _waking_runs[self.run_id]
+            return False
+
+        with DBSession() as db:
+            run = db.query(database.Run).get(self.run_id)
+            if run is None:
+                return False
+            sleeping, done = run.sleeping, run.done
+
+        if sleeping:
+            if not await self.request_wake():
+                return False
+            _waking_runs[self.run_id] = now + WAKE_TIMEOUT
+            return True
+
+        # Keep waiting for a run we woke up, unless it failed
+        return deadline is not None and done is None
+
     async def get(self):
         logger.info("Incoming connection, host=%r", self.request.host)
 
@@ -121,6 +222,8 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
         if self._finished:
             return
 
+        self.record_activity()
+
         if self.request.headers.get('Upgrade', '').lower() == 'websocket':
             headers = dict(self.request.headers)
             headers.pop('Host', None)
@@ -150,35 +253,60 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
                 self.write(chunk)
                 self.flush()
 
-            headers = dict(self.request.headers)
-            headers.pop('Host', None)
-            request = httpclient.HTTPRequest(
-                'http://' + url,
-                method=self.request.method,
-                headers=headers,
-                follow_redirects=False,
-                body=self.request.body or None,
-                header_callback=self.got_header,
-                streaming_callback=write,
-            )
-            self.alter_request(request)
-            logger.info("Forwarding HTTP connection, url=%r, headers=%r",
-                        request.url, request.headers)
-            try:
-                await httpclient.AsyncHTTPClient().fetch(
-                    request,
-                    raise_error=False,
-                )
-            except Exception:
-                PROM_PROXY_REQUESTS.labels('http', 'error').inc()
-                # Host resolves but doesn't answer
-                logger.info("Host doesn't reply, sending 503")
-                self.set_status(503)
-                self.set_header('Content-Type', 'text/plain')
-                return await self.finish(
-                    "This run is not responding, it might be starting up "
-                    + "or have already ended",
+            def make_request():
+                headers = dict(self.request.headers)
+                headers.pop('Host', None)
+                request = httpclient.HTTPRequest(
+                    'http://' + url,
+                    method=self.request.method,
+                    headers=headers,
+                    follow_redirects=False,
+                    body=self.request.body or None,
+                    header_callback=self.got_header,
+                    streaming_callback=write,
                 )
+                self.alter_request(request)
+                return request
+
+            waited = False
+            while True:
+                request = make_request()
+                if not waited:
+                    logger.info(
+                        "Forwarding HTTP connection, url=%r, headers=%r",
+                        request.url, request.headers,
+                    )
+                try:
+                    await httpclient.AsyncHTTPClient().fetch(
+                        request,
+                        raise_error=False,
+                    )
+                except Exception:
+                    # If the run was stopped for being idle, restart it and
+                    # hold the request until it answers
+                    if not self.headers and await self.should_retry():
+                        if not waited:
+                            logger.info("Waiting for run %r to start",
+                                        self.run_id)
+                        waited = True
+                        await asyncio.sleep(WAKE_RETRY_INTERVAL)
+                        continue
+
+                    PROM_PROXY_REQUESTS.labels('http', 'error').inc()
+                    # Host resolves but doesn't answer
+                    logger.info("Host doesn't reply, sending 503")
+                    self.set_status(503)
+                    self.set_header('Content-Type', 'text/plain')
+                    if waited:
+                        self.set_header('Retry-After', '10')
+                        return await self.finish(
+                            "This run is restarting, try again in a moment",
+                        )
+                    return await self.finish(
+                        "This run is not responding, it might be starting up "
+                        + "or have already ended",
+                    )
+                break
 
             PROM_PROXY_REQUESTS.labels('http', 'success').inc()
             return await self.finish()
@@ -188,7 +316,9 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
 
     def got_header(self, header):
         if not self.headers:
-            first_line = httputil.parse_response_start_line(header)
+            first_line = httputil.parse_response_start_line(
+                header.rstrip('\r\n'),
+            )
             self.set_status(first_line.code, first_line.reason)
             self.headers.append(header)
         elif header != '\r\n':
@@ -207,6 +337,7 @@ class ProxyHandler(HideStreamClosedHandler, WebSocketHandler):
         self.upstream_ws.close(close_code, close_reason)
 
     def on_message(self, message):
+        self.record_activity()
         return self.upstream_ws.write_message(message)
 
     def on_upstream_message(self, message):
@@ -232,7 +363,7 @@ class DockerProxyHandler(ProxyHandler):
             self.finish("Invalid hostname")
             return
         run_short_id, port = parts
-        database.Run.decode_id(run_short_id)
+        self.run_id = database.Run.decode_id(run_short_id)
 
         url = 'docker:{0}{1}'.format(port, self.request.uri)
         return url
@@ -252,7 +383,7 @@ class DockerSubdirProxyHandler(SubdirRewriteMixin, DockerProxyHandler):
         if m is None:
             return
         run_short_id, port = m.groups()
-        database.Run.decode_id(run_short_id)
+        self.run_id = database.Run.decode_id(run_short_id)
 
         uri = self.request.uri
         uri = self._re_path.sub('', uri)
@@ -272,11 +403,11 @@ class K8sProxyHandler(ProxyHandler):
             self.finish("Invalid hostname")
             return
         run_short_id, self.target_port = parts
-        run_id = database.Run.decode_id(run_short_id)
+        self.run_id = database.Run.decode_id(run_short_id)
 
         url = '{0}run-{1}:5597{2}'.format(
             os.environ['RUN_NAME_PREFIX'],
-            run_id,
+            self.run_id,
             self.request.uri,
         )
         return url
@@ -314,13 +445,13 @@ class K8sSubdirProxyHandler(SubdirRewriteMixin, K8sProxyHandler):
         if m is None:
             return
         run_short_id, self.target_port = m.groups()
-        run_id = database.Run.decode_id(run_short_id)
+        self.run_id = database.Run.decode_id(run_short_id)
 
         uri = self.request.uri
         uri = self._re_path.sub('', uri)
         url = '{0}run-{1}:5597{2}'.format(
             os.environ['RUN_NAME_PREFIX'],
-            run_id,
+            self.run_id,
             uri,
         )
         return url
@@ -334,10 +465,14 @@ class K8sSubdirProxyHandler(SubdirRewriteMixin, K8sProxyHandler):
 def docker_proxy():
     setup()
 
-    # Database connection is not used, but we still need to prime short ids
-    database.connect()
+    # Database is used to record activity, and to prime short ids
+    DBSession = database.connect()
 
-    proxy = DockerProxyHandler.make_app()
+    proxy = DockerProxyHandler.make_app(
+        DBSession=DBSession,
+        api_endpoint=os.environ.get('API_ENDPOINT'),
+        connection_token=os.environ.get('CONNECTION_TOKEN', ''),
+    )
     proxy.listen(8001, address='0.0.0.0', xheaders=True)
     loop = tornado.ioloop.IOLoop.current()
     loop.start()
@@ -346,10 +481,13 @@ def docker_proxy():
 def k8s_proxy():
     setup()
 
-    # Database connection is not used, but we still need to prime short ids
-    database.connect()
+    # Database is used to record activity, and to prime short ids
+    DBSession = database.connect()
 
-    proxy = K8sProxyHandler.make_app()
+    proxy = K8sProxyHandler.make_app(
+        DBSession=DBSession,
+        api_endpoint=os.environ.get('API_ENDPOINT'),
+    )
     proxy.listen(8001, address='0.0.0.0', xheaders=True)
     loop = tornado.ioloop.IOLoop.current()
     loop.start()
@@ -6,6 +6,7 @@ from tornado.httpclient import AsyncHTTPClient
 from .. import database
 from ..extensions import process_uploaded_rpz
 from .. import rpz_metadata
+from ..run.prepull import experiment_uploaded
 
 
 logger = logging.getLogger(__name__)
@@ -91,6 +92,9 @@ async def get_from_link(db, object_store, remote_addr,
     db.add(upload)
     db.commit()
 
+    # Get its base image ready
+    experiment_uploaded(experiment)
+
     return upload
 
 
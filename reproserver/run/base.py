@@ -1,8 +1,13 @@
 import asyncio
+from datetime import datetime
+import heapq
+import itertools
 import logging
+import os
 import prometheus_client
 
 from ..utils import background_future
+from .phases import PhaseTimer
 
 
 logger = logging.getLogger(__name__)
@@ -13,30 +18,210 @@ PROM_RUNS = prometheus_client.Gauge(
     "Runs currently happening",
 )
 
+PROM_QUEUED_RUNS = prometheus_client.Gauge(
+    'queued_runs',
+    "Runs waiting for a free slot",
+)
+
+PROM_IDLE_RUNS_STOPPED = prometheus_client.Counter(
+    'idle_runs_stopped_total',
+    "Runs with exposed ports stopped because they were not used",
+)
+
+PROM_RUNS_WOKEN = prometheus_client.Counter(
+    'runs_woken_total',
+    "Idle runs restarted because their ports were used again",
+)
+
+
+# Expected duration used for experiments that never completed a run
+DEFAULT_EXPECTED_DURATION = 10 * 60
+
+# Wall-clock limit for runs if RUN_TIMEOUT is not set
+DEFAULT_RUN_TIMEOUT = 24 * 3600
+
+# How often to look for idle runs
+IDLE_REAPER_INTERVAL = 60
+
+# How often to look for resources left behind by runs
+ORPHAN_SWEEP_INTERVAL = 600
+
+
+def get_run_timeout(requested=None):
+    """Get the time limit of a run, in seconds.
+
+    This is the time requested for this run if any, capped by the deployment's
+    ``RUN_TIMEOUT``.
+    """
+    timeout = os.environ.get('RUN_TIMEOUT', '')
+    timeout = int(timeout, 10) if timeout else DEFAULT_RUN_TIMEOUT
+    if requested is not None:
+        timeout = min(timeout, requested)
+    return timeout
+
 
 class BaseRunner(object):
     """Base class for runners.
 
     This is in charge of taking an experiment and running it, building it first
     if necessary.
+
+    If ``RUN_SLOTS`` is set, at most that many runs will be executed at the
+    same time. Other runs wait in a queue, which is ordered by expected
+    finish time (time queued plus predicted duration), so that short runs go
+    first without starving long ones.
     """
     def __init__(self, connector):
         self.loop = asyncio.get_event_loop()
         self.connector = connector
 
+        slots = os.environ.get('RUN_SLOTS', '')
+        self.slots = int(slots, 10) if slots else None
+        self.active = 0
+        self.queue = []
+        self._queue_counter = itertools.count()
+        self.tasks = {}
+
     async def run(self, run_id):
         """Called to trigger a run.
         """
         logger.info("Run request received: %r", run_id)
 
-        run_info = await self.connector.init_run_get_info(run_id)
+        self.tasks[run_id] = asyncio.current_task()
+        try:
+            run_info = await self.connector.init_run_get_info(run_id)
+
+            await self._acquire_slot(run_info)
+            if run_info.get('queued_since'):
+                PhaseTimer(self.connector, run_id).record(
+                    'queued',
+                    datetime.fromisoformat(run_info['queued_since']),
+                )
+            try:
+                await asyncio.ensure_future(self.run_inner(run_info))
+            except Exception as e:
+                logger.exception("Error processing run!")
+                logger.warning("Got error: %s", str(e))
+                background_future(self.connector.run_failed(run_id, str(e)))
+            finally:
+                self._release_slot()
+        finally:
+            self.tasks.pop(run_id, None)
 
+    async def cancel(self, run_id, reason="Run cancelled"):
+        """Stop a run, whether it is queued or running, and mark it as done.
+        """
+        logger.info("Cancelling run %r: %s", run_id, reason)
+        task = self.tasks.get(run_id)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Mark it as done first, so its removal is not reported as an error
+        await self.connector.run_failed(run_id, reason)
+        await self.cancel_inner(run_id)
+
+    async def wake(self, run_id):
+        """Restart a run that was stopped for being idle.
+
+        Returns True if the run is starting, False if it wasn't sleeping.
+        """
+        if not await self.connector.wake_run(run_id):
+            return False
+        logger.info("Waking up run %r", run_id)
+        PROM_RUNS_WOKEN.inc()
+        background_future(self.run(run_id))
+        return True
+
+    async def idle_reaper(self, idle_timeout):
+        """Stop runs with exposed ports that are not used through the proxy.
+
+        This runs forever, checking every minute for runs that have not seen
+        any activity in ``idle_timeout`` seconds.
+        """
+        logger.info("Stopping runs idle for %ds", idle_timeout)
+        while True:
+            await asyncio.sleep(IDLE_REAPER_INTERVAL)
+            try:
+                run_ids = await self.connector.get_idle_runs(idle_timeout)
+                for run_id in run_ids:
+                    PROM_IDLE_RUNS_STOPPED.inc()
+                    await self.cancel(
+                        run_id,
+                        "Run stopped after being idle for %d minutes" % (
+                            idle_timeout // 60
+                        ),
+                    )
+                    await self.connector.run_sleeping(run_id)
+            except Exception:
+                logger.exception("Error stopping idle runs")
+
+    async def orphan_sweeper(self):
+        """Periodically clean up after runs that are no longer running.
+        """
+        while True:
+            try:
+                await self.sweep_orphans()
+            except Exception:
+                logger.exception("Error cleaning up after runs")
+            await asyncio.sleep(ORPHAN_SWEEP_INTERVAL)
+
+    async def cancel_inner(self, run_id):
+        """Tears down a run that is not running in this process.
+        Overridable in subclasses.
+        """
+
+    async def prepull(self, image_name):
+        """Get a base image ready, ahead of runs that will use it.
+        Overridable in subclasses.
+        """
+
+    async def sweep_orphans(self):
+        """Remove what is left behind by runs that are over.
+        Overridable in subclasses.
+        """
+
+    async def _acquire_slot(self, run_info):
+        if self.slots is None:
+            return
+        if self.active < self.slots and not self.queue:
+            self.active += 1
+            return
+
+        expected = run_info.get('expected_duration')
+        if expected is None:
+            expected = DEFAULT_EXPECTED_DURATION
+        future = self.loop.create_future()
+        heapq.heappush(
+            self.queue,
+            (self.loop.time() + expected, next(self._queue_counter), future),
+        )
+        PROM_QUEUED_RUNS.set(len(self.queue))
+        logger.info(
+            "Run %r queued, expected duration %ds, %d runs waiting",
+            run_info['id'], expected, len(self.queue),
+        )
         try:
-            await asyncio.ensure_future(self.run_inner(run_info))
-        except Exception as e:
-            logger.exception("Error processing run!")
-            logger.warning("Got error: %s", str(e))
-            background_future(self.connector.run_failed(run_id, str(e)))
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We got the slot but we're not using it
+                self._release_slot()
+            raise
+
+    def _release_slot(self):
+        if self.slots is None:
+            return
+        # Hand over the slot to the next run in the queue, if any
+        while self.queue:
+            _, _, future = heapq.heappop(self.queue)
+            PROM_QUEUED_RUNS.set(len(self.queue))
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
 
     async def run_inner(self, run_info):
         """Executes the experiment. Overridable in subclasses.
@@ -3,15 +3,22 @@ import contextlib
 import hashlib
 import json
 import subprocess
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import os
+from sqlalchemy import func
 from sqlalchemy.orm import joinedload
 from tornado import gen
 from tornado.httpclient import AsyncHTTPClient, HTTPClient
 import urllib.parse
+import uuid
 
 from .. import database
+from .base import get_run_timeout
+from .duration import predict_duration
+from .log_capture import ProcessLogLimiter
+from .phases import PROM_RUN_PHASE
+from .resources import RESOURCE_FIELDS, observe_usage
 
 
 logger = logging.getLogger(__name__)
@@ -47,6 +54,39 @@ class BaseConnector(object):
         """
         raise NotImplementedError
 
+    def run_phase(self, run_id, phase, start, end):  # async
+        """Record a phase of the run, between two (UTC) datetimes.
+        """
+        raise NotImplementedError
+
+    def run_resources(self, run_id, usage):  # async
+        """Record the resources used by the run.
+        """
+        raise NotImplementedError
+
+    def get_idle_runs(self, idle_time):  # async
+        """List runs with exposed ports that have not been used recently.
+        """
+        raise NotImplementedError
+
+    def run_sleeping(self, run_id):  # async
+        """Mark a run stopped for being idle, so it can be woken up.
+        """
+        raise NotImplementedError
+
+    def get_finished_runs(self, run_ids):  # async
+        """Get the runs among those that are done or don't exist.
+        """
+        raise NotImplementedError
+
+    def wake_run(self, run_id):  # async
+        """Reset a sleeping run so it can run again.
+
+        Returns False if the run was not sleeping (possibly because it is
+        already being woken up).
+        """
+        raise NotImplementedError
+
     def get_input_links(self, run_info):
         """Add (internal) download URLs for each input.
         """
@@ -77,6 +117,11 @@ class BaseConnector(object):
         """
         raise NotImplementedError
 
+    def upload_output_stream(self, run_id, name, size, stream):  # async
+        """Upload data from an async iterator to the run's output files.
+        """
+        raise NotImplementedError
+
     def log(self, run_id, msg, *args):  # async
         """Record a message to the run's log.
         """
@@ -88,14 +133,11 @@ class BaseConnector(object):
         for line in lines:
             await self.log(run_id, '%s', line)
 
-    async def run_cmd_and_log(self, run_id, cmd):  # async
+    async def run_cmd_and_log(self, run_id, cmd, *, capture=None):  # async
         """Run a command, adding each line of output to the run's log.
-        """
-        async def log_and_wait(lines):
-            await self.log_multiple(run_id, lines)
-            # Don't send requests too fast
-            await asyncio.sleep(self.RUN_CMD_LOG_INTERVAL)
 
+        If this is cancelled (for example by a timeout), the process is killed.
+        """
         proc = await asyncio.create_subprocess_exec(
             *cmd,
             stdin=subprocess.DEVNULL,
@@ -103,54 +145,91 @@ class BaseConnector(object):
             stderr=subprocess.STDOUT,
         )
 
+        try:
+            return await self.log_output(
+                run_id, proc.stdout, proc.wait(), capture=capture,
+            )
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+
+    async def log_output(self, run_id, stream, wait_end, *,
+                         capture=None):  # async
+        """Add each line read from a stream to the run's log.
+
+        Returns the result of ``wait_end`` (e.g. the exit status of a process)
+        once the stream ends.
+
+        If a ``LogCapture`` is given, it decides which lines are added, and
+        the caller has to add the end of the output with ``capture.finish()``.
+        """
+        process_log = ProcessLogLimiter()
+
+        async def log_and_wait(lines):
+            await self.log_multiple(run_id, lines)
+            # Don't send requests too fast
+            await asyncio.sleep(self.RUN_CMD_LOG_INTERVAL)
+
         log_op = asyncio.Future()
         log_op.set_result(None)
 
-        read_op = asyncio.create_task(proc.stdout.readuntil(b'\n'))
+        read_op = asyncio.create_task(stream.readuntil(b'\n'))
 
-        proc_end = asyncio.create_task(proc.wait())
+        proc_end = asyncio.ensure_future(wait_end)
 
         lines = []
 
-        while proc.returncode is None:
-            # If we have lines to send, wait for either the next line or for
-            # the current insertion to complete.
-            # If we don't have anything to send, only wait for lines.
-            wait_for_futures = [read_op, proc_end]
-            if lines:
-                wait_for_futures.append(log_op)
-            await asyncio.wait(
-                wait_for_futures,
-                return_when=asyncio.FIRST_COMPLETED,
-            )
+        try:
+            # Read until the end of the stream, so no output is lost even if
+            # the process is reported done first
+            while True:
+                # If we have lines to send, wait for either the next line or
+                # for the current insertion to complete.
+                # If we don't have anything to send, only wait for lines.
+                wait_for_futures = [read_op]
+                if lines:
+                    wait_for_futures.append(log_op)
+                await asyncio.wait(
+                    wait_for_futures,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
 
-            # If we have read a line, add it to the list and read again
-            if read_op.done():
-                eof = False
-                try:
-                    line = await read_op
-                except asyncio.IncompleteReadError as e:
-                    if e.partial:
-                        # Handle this last part before exiting
-                        line = e.partial
-                        eof = True
+                # If we have read a line, add it to the list and read again
+                if read_op.done():
+                    eof = False
+                    try:
+                        line = await read_op
+                    except asyncio.IncompleteReadError as e:
+                        if e.partial:
+                            # Handle this last part before exiting
+                            line = e.partial
+                            eof = True
+                        else:
+                            # We're done
+                            break
+                    line = line.decode('utf-8', 'replace')
+                    line = line.rstrip()
+                    process_log.log(line)
+                    if capture is None:
+                        lines.append(line)
                     else:
-                        # We're done
+                        lines.extend(capture.add(line))
+                    if eof:
                         break
-                line = line.decode('utf-8', 'replace')
-                line = line.rstrip()
-                logger.info("> %s", line)
-                lines.append(line)
-                if eof:
-                    break
-                read_op = asyncio.create_task(proc.stdout.readuntil(b'\n'))
-
-            # If we have completed the insertion and we have lines to send,
-            # send them
-            if lines and log_op.done():
-                await log_op
-                log_op = asyncio.create_task(log_and_wait(lines))
-                lines = []
+                    read_op = asyncio.create_task(stream.readuntil(b'\n'))
+
+                # If we have completed the insertion and we have lines to
+                # send, send them
+                if lines and log_op.done():
+                    await log_op
+                    log_op = asyncio.create_task(log_and_wait(lines))
+                    lines = []
+        except asyncio.CancelledError:
+            read_op.cancel()
+            proc_end.cancel()
+            raise
 
         # Send remaining lines, if any
         if lines:
@@ -223,6 +302,7 @@ class DirectConnector(BaseConnector):
                 'hash': input_file.hash,
                 'path': paths[input_file.name],
                 'size': input_file.size,
+                'bucket': input_file.bucket,
             })
 
         # Get output files
@@ -247,6 +327,11 @@ class DirectConnector(BaseConnector):
         if extra_config is not None:
             extra_config = json.loads(extra_config)
 
+        # Runs woken up are queued again from that time
+        queued_since = run.submitted
+        if run.last_activity is not None:
+            queued_since = max(queued_since, run.last_activity)
+
         # Remove previous info
         run.log[:] = []
         run.output_files[:] = []
@@ -255,12 +340,16 @@ class DirectConnector(BaseConnector):
         return {
             'id': run_id,
             'experiment_hash': run.experiment.hash,
+            'sweep_id': run.sweep_id,
+            'queued_since': queued_since.isoformat(),
             'parameters': params,
             'inputs': inputs,
             'outputs': outputs,
             'ports': ports,
             'extra_config': extra_config,
             'rpz_meta': json.loads(run.experiment.info),
+            'expected_duration': predict_duration(db, run.experiment.hash),
+            'timeout': get_run_timeout(run.timeout),
         }
 
     async def run_started(self, run_id):
@@ -286,18 +375,105 @@ class DirectConnector(BaseConnector):
         db = self.DBSession()
         run = db.query(database.Run).get(run_id)
         run.done = datetime.utcnow()
+        run.succeeded = True
         db.commit()
 
     async def run_failed(self, run_id, error):
         db = self.DBSession()
         run = db.query(database.Run).get(run_id)
         run.done = datetime.utcnow()
+        # Don't reuse the results of failed runs
+        run.cache_key = None
         db.add(database.RunLogLine(run_id=run.id, line=error))
         db.commit()
 
+    async def run_phase(self, run_id, phase, start, end):
+        with self.DBSession() as db:
+            db.add(database.RunEvent(
+                run_id=run_id, phase=phase, start=start, end=end,
+            ))
+            db.commit()
+        PROM_RUN_PHASE.labels(phase).observe((end - start).total_seconds())
+
+    async def run_resources(self, run_id, usage):
+        with self.DBSession() as db:
+            run = db.query(database.Run).get(run_id)
+            for field in RESOURCE_FIELDS:
+                setattr(run, field, usage[field])
+            db.commit()
+            observe_usage(run.experiment_hash, usage)
+
+    async def get_idle_runs(self, idle_time):
+        threshold = datetime.utcnow() - timedelta(seconds=idle_time)
+        with self.DBSession() as db:
+            runs = (
+                db.query(database.Run.id)
+                .filter(database.Run.done == None)  # noqa: E711
+                .filter(database.Run.started != None)  # noqa: E711
+                # Runs with extra containers (e.g. crawlers) use their ports
+                # without going through the proxy
+                .filter(database.Run.extra_config == None)  # noqa: E711
+                .filter(database.Run.ports.any())
+                .filter(
+                    func.coalesce(
+                        database.Run.last_activity,
+                        database.Run.started,
+                    ) < threshold
+                )
+            ).all()
+        return [run_id for run_id, in runs]
+
+    async def get_finished_runs(self, run_ids):
+        run_ids = set(run_ids)
+        if not run_ids:
+            return set()
+        with self.DBSession() as db:
+            active = (
+                db.query(database.Run.id)
+                .filter(database.Run.id.in_(run_ids))
+                .filter(database.Run.done == None)  # noqa: E711
+            ).all()
+        return run_ids - {run_id for run_id, in active}
+
+    async def run_sleeping(self, run_id):
+        with self.DBSession() as db:
+            run = db.query(database.Run).get(run_id)
+            run.sleeping = True
+            db.commit()
+
+    async def wake_run(self, run_id):
+        with self.DBSession() as db:
+            # Single UPDATE, so only one caller gets to restart the run
+            woken = (
+                db.query(database.Run)
+                .filter(database.Run.id == run_id)
+                .filter(database.Run.sleeping == True)  # noqa: E712
+                .update(
+                    {
+                        database.Run.sleeping: False,
+                        database.Run.started: None,
+                        database.Run.done: None,
+                        database.Run.progress_percent: 0,
+                        database.Run.progress_text: '',
+                        # Don't reap it again before it had a chance to start
+                        database.Run.last_activity: datetime.utcnow(),
+                    },
+                    synchronize_session=False,
+                )
+            )
+            if woken == 1:
+                # The phases of the previous start are not relevant anymore
+                (
+                    db.query(database.RunEvent)
+                    .filter(database.RunEvent.run_id == run_id)
+                    .delete(synchronize_session=False)
+                )
+            db.commit()
+        return woken == 1
+
     def _add_input_link(self, input_file):
         link = self.object_store.presigned_internal_url(
-            'inputs',
+            input_file.get('bucket', 'inputs'),
             input_file['hash'],
         )
         return dict(input_file, link=link)
@@ -330,7 +506,7 @@ class DirectConnector(BaseConnector):
                 input_file['name'], input_file['hash'], input_file['size'],
             )
             self.object_store.download_file(
-                'inputs', input_file['hash'],
+                input_file.get('bucket', 'inputs'), input_file['hash'],
                 local_path,
             )
             input_file = dict(input_file, local_path=local_path)
@@ -400,6 +576,77 @@ class DirectConnector(BaseConnector):
             ),
         )
 
+    async def upload_output_stream(self, run_id, name, size, stream):
+        loop = asyncio.get_event_loop()
+        object_store = self.object_store
+
+        def call(func, *args):
+            return loop.run_in_executor(None, func, *args)
+
+        # The object is stored under its hash, which is only known at the end,
+        # so upload it in parts to a temporary name, then move it
+        temp_name = 'upload-%s' % uuid.uuid4().hex
+        logger.info("Uploading file, size: %d bytes", size)
+        upload_id = await call(
+            object_store.create_multipart_upload, 'outputs', temp_name,
+        )
+        try:
+            hasher = hashlib.sha256()
+            received = 0
+            parts = []
+            buffer = []
+            buffered = 0
+
+            async def send_part():
+                nonlocal buffer, buffered
+                data = b''.join(buffer)
+                buffer = []
+                buffered = 0
+                parts.append(await call(
+                    object_store.upload_part,
+                    'outputs', temp_name, upload_id, len(parts) + 1, data,
+                ))
+
+            async for chunk in stream:
+                hasher.update(chunk)
+                received += len(chunk)
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= UPLOAD_PART_SIZE:
+                    await send_part()
+            if buffer or not parts:
+                await send_part()
+
+            if received != size:
+                raise ValueError(
+                    "Output size mismatch: expected %d bytes, got %d" % (
+                        size, received,
+                    )
+                )
+            await call(
+                object_store.complete_multipart_upload,
+                'outputs', temp_name, upload_id, parts,
+            )
+        except BaseException:
+            await call(
+                object_store.abort_multipart_upload,
+                'outputs', temp_name, upload_id,
+            )
+            raise
+
+        digest = hasher.hexdigest()
+        await call(object_store.move_object, 'outputs', temp_name, digest)
+
+        # Add it to database
+        db = self.DBSession()
+        db.add(database.OutputFile(
+            run_id=run_id,
+            hash=digest,
+            name=name,
+            size=size,
+        ))
+        db.commit()
+
     async def log(self, run_id, msg, *args):
         db = self.DBSession()
         line = msg % args
@@ -415,6 +662,11 @@ class DirectConnector(BaseConnector):
 
 MAX_FILE_SIZE = 5_000_000_000  # 5 GB
 
+# Size of the parts of multipart uploads, S3 needs at least 5 MB
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+
+UPLOAD_TIMEOUT = 3600
+
 
 def download_file(url, local_path, http_client=None):
     with contextlib.ExitStack() as http_context:
@@ -489,6 +741,16 @@ class HttpConnector(BaseConnector):
     async def run_failed(self, run_id, error):
         await self._post(run_id, 'failed', {'error': error})
 
+    async def run_phase(self, run_id, phase, start, end):
+        await self._post(run_id, 'phase', {
+            'phase': phase,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+        })
+
+    async def run_resources(self, run_id, usage):
+        await self._post(run_id, 'resources', usage)
+
     def get_input_links(self, run_info):
         # The input links are already set by init_run_get_info()
         return run_info
@@ -551,7 +813,7 @@ class HttpConnector(BaseConnector):
                 '{0}/runners/run/{1}/output/{2}'.format(
                     self.api_endpoint,
                     run_id,
-                    urllib.parse.quote_plus(name),
+                    urllib.parse.quote(name, safe=''),
                 ),
                 method='PUT',
                 body_producer=file_body_producer(file),
@@ -565,13 +827,33 @@ class HttpConnector(BaseConnector):
             '{0}/runners/run/{1}/output/{2}'.format(
                 self.api_endpoint,
                 run_id,
-                urllib.parse.quote_plus(name),
+                urllib.parse.quote(name, safe=''),
             ),
             method='PUT',
             body_producer=file_body_producer(file),
             headers={'X-Reproserver-Authenticate': self.connection_token},
         )
 
+    async def upload_output_stream(self, run_id, name, size, stream):
+        async def producer(write):
+            async for chunk in stream:
+                await write(chunk)
+
+        await self.http_client.fetch(
+            '{0}/runners/run/{1}/output/{2}'.format(
+                self.api_endpoint,
+                run_id,
+                urllib.parse.quote(name, safe=''),
+            ),
+            method='PUT',
+            body_producer=producer,
+            headers={
+                'Content-Length': '%d' % size,
+                'X-Reproserver-Authenticate': self.connection_token,
+            },
+            request_timeout=UPLOAD_TIMEOUT,
+        )
+
     def log(self, run_id, msg, *args):
         line = msg % args
         return self.log_multiple(run_id, [line])
@@ -1,22 +1,296 @@
 import asyncio
+import collections
+from datetime import datetime
+import functools
+import hashlib
+import io
 import logging
 import os
+import prometheus_client
 import random
+import re
 from reprounzip_docker import select_image
 import shutil
 import string
 import subprocess
+import sys
+import tarfile
 import tempfile
 import textwrap
+import time
 
-from .base import PROM_RUNS, BaseRunner
-from ..utils import subprocess_call_async, subprocess_check_call_async, \
-    shell_escape, prom_incremented
+from .base import PROM_RUNS, BaseRunner, get_run_timeout
+from .docker_api import DockerClient, DockerError
+from .egress import egress_environ, egress_stats, format_egress_stats
+from .file_cache import get_file_cache
+from .image_gc import get_image_collector
+from .image_cache import PROM_IMAGE_CACHE, IMAGE_CACHE_LABEL, \
+    experiment_image_name, image_cache_registry
+from .log_capture import get_log_capture
+from .phases import PhaseTimer
+from .resources import ResourceSampler, resource_sample_interval
+from .sweeps import PROM_SWEEP_SETUPS, SWEEP_LABEL, SWEEP_LOCAL_IMAGES, \
+    sweep_image_name
+from .steps import PROM_STEP_SNAPSHOTS, PROM_STEPS_SKIPPED, \
+    STEP_SNAPSHOT_LABEL, run_steps, step_snapshot_keys, step_snapshot_name, \
+    step_snapshots_size
+from ..utils import background_future, shell_escape, prom_incremented
 
 
 logger = logging.getLogger(__name__)
 
 
+PROM_POOL_CLAIMS = prometheus_client.Counter(
+    'container_pool_claims_total',
+    "Runs that could use a container from the warm pool",
+    ['result'],
+)
+PROM_POOL_CLAIMS.labels('hit').inc(0)
+PROM_POOL_CLAIMS.labels('miss').inc(0)
+
+PROM_POOL_READY = prometheus_client.Gauge(
+    'container_pool_ready',
+    "Containers ready in the warm pool",
+)
+
+PROM_OUTPUT_SIZE = prometheus_client.Histogram(
+    'run_output_size_bytes',
+    "Size of output files",
+    buckets=[1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, float('inf')],
+)
+PROM_OUTPUT_TIME = prometheus_client.Histogram(
+    'run_output_upload_seconds',
+    "Time to get an output file from the container and upload it",
+)
+PROM_ORPHANS_REMOVED = prometheus_client.Counter(
+    'run_orphan_containers_removed_total',
+    "Containers of finished runs found and removed by the sweeper",
+)
+PROM_ORPHANS_RECLAIMED = prometheus_client.Counter(
+    'run_orphan_reclaimed_bytes_total',
+    "Disk space used by the containers removed by the sweeper",
+)
+PROM_TIME_TO_FIRST_COMMAND = prometheus_client.Histogram(
+    'run_time_to_first_command_seconds',
+    "Time from the start of a run until its container can run commands",
+)
+
+
+# How long the container stays up after the experiment's time limit, to allow
+# for setup and collecting outputs
+CONTAINER_GRACE_TIME = 600
+
+# Busybox, rpztar, and rpzsudo, copied into the containers
+RPZ_TOOLS_DIR = '/opt/rpz-tools-x86_64'
+
+# Where the tools are in derived images
+DERIVED_TOOLS_DIR = '/.rpz.tools'
+
+# Name of the derived images, tagged by base image and tools version
+DERIVED_IMAGE_REPO = 'reproserver-run'
+
+# Labels set on derived images
+DERIVED_BASE_LABEL = 'reproserver.base-image'
+DERIVED_TOOLS_LABEL = 'reproserver.tools-version'
+
+# How many input files to download at the same time
+INPUT_DOWNLOAD_CONCURRENCY = 4
+
+# How many output files to upload at the same time
+OUTPUT_UPLOAD_CONCURRENCY = 4
+
+# Names of the containers of runs
+RUN_CONTAINER_NAME = re.compile(r'^/?run_([0-9]+)$')
+
+# Label set on the containers of the warm pool
+POOL_LABEL = 'reproserver.pool'
+
+# How long a container can wait in the pool before being replaced
+POOL_MAX_IDLE = 3600
+
+# How often to check the pool
+POOL_CHECK_INTERVAL = 60
+
+# How many of the most used base images to keep containers ready for
+POOL_TRACKED_IMAGES = 3
+
+
+def make_tools_archive(working_dir):
+    """Make a tar archive putting the rpz tools in a directory.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        tar.add(RPZ_TOOLS_DIR, arcname=working_dir.lstrip('/'))
+    return buf.getvalue()
+
+
+@functools.lru_cache()
+def tools_version():
+    """Hash of the tools, identifying derived images that contain them.
+    """
+    hasher = hashlib.sha256()
+    for name in sorted(os.listdir(RPZ_TOOLS_DIR)):
+        hasher.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(RPZ_TOOLS_DIR, name), 'rb') as fp:
+            hasher.update(hashlib.sha256(fp.read()).digest())
+    return hasher.hexdigest()
+
+
+def derived_images_enabled():
+    return os.environ.get('RUN_DERIVED_IMAGES', 'true').lower() not in (
+        'n', 'no', 'false', 'off', '0',
+    )
+
+
+async def download_stream(url):
+    """Download a URL with curl, yielding the data as it arrives.
+    """
+    cmd = ['curl', '-fsSL', '--', url]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        while True:
+            chunk = await proc.stdout.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+        ret = await proc.wait()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+
+async def download_file(url, path):
+    """Download a URL to a local file with curl.
+    """
+    cmd = ['curl', '-fsSL', '-o', path, '--', url]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.DEVNULL,
+    )
+    ret = await proc.wait()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+
+
+async def file_stream(fp):
+    """Read a local file, yielding chunks, and close it.
+    """
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, fp.read, 512 * 1024)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fp.close()
+
+
+async def tar_stream(files):
+    """Stream a tar archive of open local files, given as (file, arcname).
+    """
+    for fp, arcname in files:
+        info = tarfile.TarInfo(arcname.lstrip('/'))
+        info.size = os.fstat(fp.fileno()).st_size
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        async for chunk in file_stream(fp):
+            yield chunk
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+class ChunkReader(object):
+    """Read exact amounts of data from an async iterator of chunks.
+    """
+    def __init__(self, iterator):
+        self._iterator = iterator.__aiter__()
+        self._buffer = b''
+
+    async def _next(self):
+        try:
+            return await self._iterator.__anext__()
+        except StopAsyncIteration:
+            raise EOFError("Unexpected end of stream")
+
+    async def read_exactly(self, size):
+        parts = [self._buffer]
+        received = len(self._buffer)
+        while received < size:
+            chunk = await self._next()
+            parts.append(chunk)
+            received += len(chunk)
+        data = b''.join(parts)
+        self._buffer = data[size:]
+        return data[:size]
+
+    async def iter_exactly(self, size):
+        """Yield chunks until exactly ``size`` bytes have been read.
+        """
+        while size > 0:
+            if not self._buffer:
+                self._buffer = await self._next()
+            chunk = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            size -= len(chunk)
+            yield chunk
+
+
+def _pax_size(data):
+    """Get the size from PAX extended header records, if set.
+    """
+    pos = 0
+    while pos < len(data) and data[pos] != 0:
+        length = int(data[pos:data.index(b' ', pos)], 10)
+        record = data[pos:pos + length].rstrip(b'\n')
+        keyword, _, value = record.split(b' ', 1)[1].partition(b'=')
+        if keyword == b'size':
+            return int(value, 10)
+        pos += length
+    return None
+
+
+async def tar_first_file(stream):
+    """Read the first member of a tar stream, if it is a regular file.
+
+    Returns its size and an async iterator over its content, or None.
+    """
+    reader = ChunkReader(stream)
+    size = None
+    while True:
+        header = await reader.read_exactly(tarfile.BLOCKSIZE)
+        if header == tarfile.NUL * tarfile.BLOCKSIZE:
+            return None
+        info = tarfile.TarInfo.frombuf(
+            header, tarfile.ENCODING, 'surrogateescape',
+        )
+        if info.type in (
+            tarfile.XHDTYPE, tarfile.XGLTYPE,
+            tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+        ):
+            # Extended header, the actual member comes after it
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            data = await reader.read_exactly(padded)
+            if info.type == tarfile.XHDTYPE:
+                size = _pax_size(data[:info.size])
+            continue
+        if not info.isreg():
+            return None
+        if size is None:
+            size = info.size
+        return size, reader.iter_exactly(size)
+
+
 class DockerRunner(BaseRunner):
     """Docker runner implementation.
 
@@ -24,6 +298,74 @@ class DockerRunner(BaseRunner):
     when running with docker-compose; on Kubernetes, the subclass K8sRunner
     will be used to schedule a pod that will run _docker_run().
     """
+    def __init__(self, connector):
+        super(DockerRunner, self).__init__(connector)
+        self.docker = DockerClient()
+        self.derived_images = derived_images_enabled()
+        self._derive_locks = collections.defaultdict(asyncio.Lock)
+        self.stream_bundle = (
+            os.environ.get('RUN_STREAM_BUNDLE', '').lower()
+            in ('y', 'yes', 'true', 'on', '1')
+        )
+
+        # Containers being removed in the background
+        self._removing = {}
+
+        # Local cache for bundles and inputs
+        self.file_cache = get_file_cache()
+
+        # Registry where to cache images of extracted experiments
+        self.image_cache = image_cache_registry()
+        if self.image_cache is not None and not self.derived_images:
+            logger.warning(
+                "The experiment image cache requires derived images, "
+                "disabling it",
+            )
+            self.image_cache = None
+        self.image_cache_local_size = int(
+            os.environ.get('RUN_IMAGE_CACHE_LOCAL', '') or '10',
+            10,
+        )
+
+        # Snapshots of the container after each step, to resume later runs
+        self.step_snapshots = step_snapshots_size()
+        if self.step_snapshots and not self.derived_images:
+            logger.warning(
+                "Step snapshots require derived images, disabling them",
+            )
+            self.step_snapshots = 0
+
+        # Experiment images and step snapshots present locally, by label,
+        # least recently used first
+        self._local_images = {}
+
+        # Share the setup of containers between the runs of a sweep, which
+        # only makes sense if they use the same Docker daemon
+        self.share_sweep_setup = True
+        # Prepared containers of sweeps being committed, by image name
+        self._sweep_setups = {}
+
+        self.pool = None
+        pool_size = os.environ.get('RUN_POOL_SIZE', '')
+        if pool_size and int(pool_size, 10) > 0:
+            pool_images = os.environ.get('RUN_POOL_IMAGES', '')
+            self.pool = ContainerPool(
+                self,
+                int(pool_size, 10),
+                [image for image in pool_images.split(',') if image],
+            )
+            background_future(self.pool.maintain(), should_never_exit=True)
+
+        # Remove old images when they use too much disk, but keep the ones we
+        # keep ready containers for
+        self.image_gc = get_image_collector(
+            self.docker,
+            pinned=self.pool.wanted_images if self.pool is not None else None,
+            derived_label=DERIVED_BASE_LABEL,
+        )
+        if self.image_gc is not None:
+            background_future(self.image_gc.maintain(), should_never_exit=True)
+
     async def run_inner(self, run_info):
         # Straight-up Docker, e.g. we're using docker-compose
         # Run and build right here
@@ -33,6 +375,421 @@ class DockerRunner(BaseRunner):
                 '0.0.0.0',  # Accept connections to proxy from everywhere
             )
 
+    async def cancel_inner(self, run_id):
+        # The run might have been started by a previous process
+        container = 'run_%s' % run_id
+        await self._wait_removed(container)
+        try:
+            await self.docker.remove_container(container)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+
+    async def prepull(self, image_name):
+        if self.derived_images:
+            await self._derived_image(image_name)
+        else:
+            await self._inspect_image(image_name)
+
+    def _remove_later(self, container):
+        """Remove a container in the background.
+        """
+        async def remove():
+            try:
+                await self.docker.remove_container(container)
+            except DockerError as e:
+                if e.status != 404:
+                    logger.exception("Error removing container %s", container)
+            finally:
+                self._removing.pop(container, None)
+
+        future = asyncio.ensure_future(remove())
+        self._removing[container] = future
+        background_future(future)
+
+    async def _wait_removed(self, container):
+        """Wait until a container being removed is gone, so the name is free.
+        """
+        future = self._removing.get(container)
+        if future is not None:
+            await asyncio.shield(future)
+
+    async def sweep_orphans(self):
+        """Remove the containers of runs that are done or no longer exist.
+
+        Those could be left behind if the process stopped during the run.
+        """
+        containers = {}
+        for info in await self.docker.list_containers(name='run_', size=True):
+            for name in info['Names']:
+                m = RUN_CONTAINER_NAME.match(name)
+                if m is not None:
+                    run_id = int(m.group(1), 10)
+                    # Skip those we are running or removing right now
+                    if (
+                        run_id not in self.tasks
+                        and 'run_%d' % run_id not in self._removing
+                    ):
+                        containers[run_id] = info
+        if not containers:
+            return
+
+        finished = await self.connector.get_finished_runs(containers)
+        reclaimed = 0
+        for run_id in sorted(finished):
+            info = containers[run_id]
+            logger.info("Removing orphaned container run_%d", run_id)
+            try:
+                await self.docker.remove_container(info['Id'])
+            except DockerError as e:
+                if e.status != 404:
+                    logger.warning("Can't remove run_%d: %s", run_id, e)
+                continue
+            PROM_ORPHANS_REMOVED.inc()
+            size = info.get('SizeRw') or 0
+            PROM_ORPHANS_RECLAIMED.inc(size)
+            reclaimed += size
+        if finished:
+            logger.info(
+                "Removed %d orphaned containers, reclaimed %d bytes",
+                len(finished), reclaimed,
+            )
+
+    async def remove_leftover_containers(self):
+        """Remove every container, when this runner has the daemon to itself.
+
+        In runner pods using a persistent image store, the containers of
+        previous runs on the node might still be there.
+        """
+        for info in await self.docker.list_containers():
+            logger.info("Removing leftover container %s", info['Id'])
+            try:
+                await self.docker.remove_container(info['Id'])
+            except DockerError as e:
+                if e.status != 404:
+                    logger.warning("Can't remove %s: %s", info['Id'], e)
+
+    async def wait_removals(self):
+        """Wait for the containers being removed in the background.
+        """
+        await asyncio.gather(*self._removing.values())
+
+    async def _exec_check(self, container, cmd, *, stdin=None):
+        ret = await self.docker.exec_run(container, cmd, stdin=stdin)
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, cmd)
+
+    async def _create_container(self, container, config):
+        if self.image_gc is not None:
+            self.image_gc.touch(config['Image'])
+        try:
+            await self.docker.create_container(container, config)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+            # Image is not available locally, pull it
+            logger.info("Pulling image %s", config['Image'])
+            await self.docker.pull_image(config['Image'])
+            await self.docker.create_container(container, config)
+
+    async def _inspect_image(self, image_name):
+        """Inspect an image, pulling it if necessary.
+        """
+        try:
+            return await self.docker.inspect_image(image_name)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+        logger.info("Pulling image %s", image_name)
+        await self.docker.pull_image(image_name)
+        return await self.docker.inspect_image(image_name)
+
+    async def _derived_image(self, image_name):
+        """Get an image with the tools at DERIVED_TOOLS_DIR, building it once.
+
+        The image is tagged by the ID of the base image and the version of the
+        tools, so it gets rebuilt if either changes.
+        """
+        if self.image_gc is not None:
+            self.image_gc.touch(image_name)
+        base_id = (await self._inspect_image(image_name))['Id']
+        tag = hashlib.sha256(
+            (base_id + tools_version()).encode('utf-8'),
+        ).hexdigest()[:20]
+        derived = '%s:%s' % (DERIVED_IMAGE_REPO, tag)
+
+        async with self._derive_locks[derived]:
+            try:
+                await self.docker.inspect_image(derived)
+            except DockerError as e:
+                if e.status != 404:
+                    raise
+            else:
+                return derived
+
+            logger.info("Building image %s from %s", derived, image_name)
+            container = 'build_%s' % tag
+            try:
+                await self.docker.remove_container(container)
+            except DockerError as e:
+                if e.status != 404:
+                    raise
+            await self.docker.create_container(container, {
+                'Image': image_name,
+                'Cmd': [f'{DERIVED_TOOLS_DIR}/busybox', 'true'],
+            })
+            try:
+                await self.docker.put_archive(
+                    container, '/',
+                    await asyncio.get_event_loop().run_in_executor(
+                        None,
+                        make_tools_archive,
+                        DERIVED_TOOLS_DIR,
+                    ),
+                )
+                await self.docker.commit_container(
+                    container, DERIVED_IMAGE_REPO, tag,
+                    config={'Labels': {
+                        DERIVED_BASE_LABEL: image_name,
+                        DERIVED_TOOLS_LABEL: tools_version(),
+                    }},
+                )
+            finally:
+                await self.docker.remove_container(container)
+        return derived
+
+    async def _bundle_stream(self, run_info):
+        """Download the RPZ, or read it from the local cache.
+        """
+        link = self.connector.get_bundle_link(run_info)
+        if self.file_cache is None:
+            stream = download_stream(link)
+        else:
+            stream = file_stream(await self.file_cache.open(
+                'experiment-%s' % run_info['experiment_hash'],
+                lambda path: download_file(link, path),
+            ))
+        async for chunk in stream:
+            yield chunk
+
+    async def _input_file(self, input_file, local_path):
+        """Download an input file, or open it from the local cache.
+        """
+        if self.file_cache is None:
+            await download_file(input_file['link'], local_path)
+            return open(local_path, 'rb')
+        else:
+            return await self.file_cache.open(
+                'input-%s' % input_file['hash'],
+                lambda path: download_file(input_file['link'], path),
+            )
+
+    async def _find_experiment_image(self, image):
+        """Check for a cached experiment image, pulling it if necessary.
+        """
+        try:
+            await self.docker.inspect_image(image)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+            try:
+                await self.docker.pull_image(image)
+            except DockerError:
+                PROM_IMAGE_CACHE.labels('miss').inc()
+                return False
+        PROM_IMAGE_CACHE.labels('hit').inc()
+        await self._touch_local_image(
+            IMAGE_CACHE_LABEL, image, self.image_cache_local_size,
+        )
+        return True
+
+    async def _touch_local_image(self, label, image, size):
+        """Mark a local image as used, removing the old ones with that label.
+        """
+        images = self._local_images.get(label)
+        if images is None:
+            listed = await self.docker.list_images(label=label)
+            listed.sort(key=lambda img: img['Created'])
+            images = self._local_images[label] = collections.OrderedDict(
+                (tag, None)
+                for img in listed
+                for tag in img.get('RepoTags') or ()
+            )
+        images[image] = None
+        images.move_to_end(image)
+
+        while len(images) > size:
+            old_image, _ = images.popitem(last=False)
+            logger.info("Removing image %s", old_image)
+            try:
+                await self.docker.remove_image(old_image)
+            except DockerError as e:
+                # Might be in use, it will be collected later
+                logger.warning("Can't remove image %s: %s", old_image, e)
+
+    async def _cache_experiment_image(self, container, image, run_info):
+        """Commit the extracted experiment, and push it to the registry.
+
+        Returns a future for the push.
+        """
+        logger.info("Caching extracted experiment as %s", image)
+        repo, tag = image.rsplit(':', 1)
+        await self.docker.commit_container(
+            container, repo, tag,
+            config={'Labels': {
+                IMAGE_CACHE_LABEL: run_info['experiment_hash'],
+            }},
+        )
+        await self._touch_local_image(
+            IMAGE_CACHE_LABEL, image, self.image_cache_local_size,
+        )
+        return asyncio.ensure_future(self.docker.push_image(image))
+
+    async def _find_step_snapshot(self, keys):
+        """Find the snapshot after the latest step possible.
+
+        Returns the number of steps done in it and its name, or ``(0, None)``.
+        The last step is not snapshotted, there would be nothing left to run.
+        """
+        for i in range(len(keys) - 2, -1, -1):
+            image = step_snapshot_name(keys[i])
+            try:
+                await self.docker.inspect_image(image)
+            except DockerError as e:
+                if e.status != 404:
+                    raise
+            else:
+                PROM_STEP_SNAPSHOTS.labels('hit').inc()
+                await self._touch_local_image(
+                    STEP_SNAPSHOT_LABEL, image, self.step_snapshots,
+                )
+                return i + 1, image
+        PROM_STEP_SNAPSHOTS.labels('miss').inc()
+        return 0, None
+
+    async def _snapshot_step(self, container, key, run_info):
+        """Commit the container after a step.
+        """
+        image = step_snapshot_name(key)
+        logger.info("Snapshotting container as %s", image)
+        repo, tag = image.rsplit(':', 1)
+        await self.docker.commit_container(
+            container, repo, tag,
+            config={'Labels': {
+                STEP_SNAPSHOT_LABEL: run_info['experiment_hash'],
+            }},
+        )
+        await self._touch_local_image(
+            STEP_SNAPSHOT_LABEL, image, self.step_snapshots,
+        )
+
+    async def _claim_sweep_setup(self, image):
+        """Wait for the prepared container of a sweep, or claim its creation.
+
+        Returns True if the image is ready to use, False if the caller should
+        prepare a container then call ``_commit_sweep_setup()``.
+        """
+        while True:
+            future = self._sweep_setups.get(image)
+            if future is None:
+                future = self._sweep_setups[image] = asyncio.Future()
+                try:
+                    await self.docker.inspect_image(image)
+                except DockerError as e:
+                    if e.status != 404:
+                        self._release_sweep_setup(image, False)
+                        raise
+                    return False
+                self._release_sweep_setup(image, True)
+                await self._touch_local_image(
+                    SWEEP_LABEL, image, SWEEP_LOCAL_IMAGES,
+                )
+                return True
+            if await asyncio.shield(future):
+                return True
+            # Preparing failed, try again
+
+    def _release_sweep_setup(self, image, ready):
+        future = self._sweep_setups.pop(image, None)
+        if future is not None and not future.done():
+            future.set_result(ready)
+
+    async def _commit_sweep_setup(self, container, image, run_info):
+        """Commit a prepared container for the other runs of the sweep.
+        """
+        logger.info("Committing prepared container as %s", image)
+        repo, tag = image.rsplit(':', 1)
+        try:
+            await self.docker.commit_container(
+                container, repo, tag,
+                config={'Labels': {SWEEP_LABEL: str(run_info['sweep_id'])}},
+            )
+            await self._touch_local_image(
+                SWEEP_LABEL, image, SWEEP_LOCAL_IMAGES,
+            )
+        except BaseException:
+            self._release_sweep_setup(image, False)
+            raise
+        self._release_sweep_setup(image, True)
+
+    async def _prepare_container(self, container, image_name, *,
+                                 lifetime, ports=None, labels=None,
+                                 tools_included=False, phases=None):
+        """Create a container with the tools, and start it.
+
+        Returns the directory where the tools are, which can be used as a
+        working directory.
+        """
+        if phases is None:
+            phases = PhaseTimer(None, None)
+        container_start = datetime.utcnow()
+        if tools_included:
+            # This is already a derived image
+            working_dir = DERIVED_TOOLS_DIR
+            run_image = image_name
+        elif self.derived_images:
+            # The tools are already in the image
+            working_dir = DERIVED_TOOLS_DIR
+            run_image = await self._derived_image(image_name)
+        else:
+            # Use a random directory in the container for our operations
+            # This avoids conflicts
+            working_dir = '/.rpz.%d' % random.randint(0, 1000000)
+            run_image = image_name
+
+        logger.info(
+            "Creating container %s with image %s",
+            container, run_image,
+        )
+        ports = ports or {}
+        await self._create_container(container, {
+            'Image': run_image,
+            # The container only lives for so long, in case we lose track
+            'Cmd': [f'{working_dir}/busybox', 'sleep', str(lifetime)],
+            'ExposedPorts': {port: {} for port in ports},
+            'HostConfig': {'PortBindings': ports},
+            'Labels': labels or {},
+        })
+        phases.record('container', container_start)
+
+        if not self.derived_images:
+            # Copy tools into container
+            logger.info("Copying tools into container")
+            with phases.phase('tools'):
+                await self.docker.put_archive(
+                    container, '/',
+                    await asyncio.get_event_loop().run_in_executor(
+                        None,
+                        make_tools_archive,
+                        working_dir,
+                    ),
+                )
+
+        # Start the container (does nothing, but now we may exec)
+        logger.info("Starting container")
+        await self.docker.start_container(container)
+        return working_dir
+
     async def _docker_run(self, run_info, bind_host):
         """Pull or build an image, then run it.
 
@@ -58,129 +815,254 @@ class DockerRunner(BaseRunner):
             40, "Setting up container",
         )
 
+        phases = PhaseTimer(self.connector, run_info['id'])
+
         # Make build directory
         directory = tempfile.mkdtemp('rpz-run')
 
         # Select base image from metadata
         image_name = select_image(run_info['rpz_meta']['meta'])[1]
 
+        push_future = None
         try:
-            # Use a random directory in the container for our operations
-            # This avoids conflicts
-            working_dir = '/.rpz.%d' % random.randint(0, 1000000)
-
-            # Create container
             container = 'run_%s' % run_info['id']
-            logger.info(
-                "Creating container %s with image %s",
-                container, image_name,
-            )
-            cmdline = [
-                'docker', 'create', '--name', container,
-            ]
-            for port in run_info['ports']:
-                cmdline.extend([
-                    '-p', '{0}:{1}:{1}'.format(bind_host, port['port_number']),
-                ])
-            cmdline.extend([
-                '--', image_name,
-                f'{working_dir}/busybox', 'sleep', '86400',
-            ])
-            await subprocess_check_call_async(cmdline)
+            start_time = time.perf_counter()
 
-            # Copy tools into container
-            logger.info("Copying tools into container")
-            await subprocess_check_call_async([
-                'docker', 'cp', '--',
-                '/opt/rpz-tools-x86_64',
-                '%s:%s' % (container, working_dir)
-            ])
-
-            # Start the container (does nothing, but now we may exec)
-            logger.info("Starting container")
-            await subprocess_check_call_async([
-                'docker', 'start', '--', container,
-            ])
-
-            # Download RPZ into container
-            logger.info("Downloading RPZ into container")
-            await subprocess_check_call_async(['sh', '-c', (
-                'curl -fsSL '
-                + shell_escape(self.connector.get_bundle_link(run_info))
-                + ' | '
-                + f'docker exec -i {container} {working_dir}/busybox sh -c'
-                + f' "cat > {working_dir}/exp.rpz"'
-            )])
-
-            # Download inputs into container
-            logger.info("Downloading inputs into container")
-            for i, input_file in enumerate(run_info['inputs']):
-                await subprocess_check_call_async(['sh', '-c', (
-                    'curl -fsSL '
-                    + shell_escape(input_file["link"])
-                    + ' | '
-                    + f'docker exec -i {container} {working_dir}/busybox sh -c'
-                    + f' "cat > {working_dir}/input_{i}"'
-                )])
-
-            # Run script to move files into position
-            logger.info("Moving files into position")
-            script = [textwrap.dedent(
-                f'''\
-                set -eu
-
-                # Extract RPZ
-                cd /
-                {working_dir}/rpztar {working_dir}/exp.rpz
-                rm {working_dir}/exp.rpz
-
-                # Move inputs into position
-                '''
-            )]
-            for i, input_file in enumerate(run_info['inputs']):
-                script.append(
-                    'mv'
-                    + ' ' + f'{working_dir}/input_{i}'
-                    + ' ' + shell_escape(input_file["path"])
-                    + '\n'
+            # A previous container for that run might still be being removed
+            await self._wait_removed(container)
+
+            # Look for a snapshot after some of the steps, so we only run the
+            # remaining ones
+            step_keys = None
+            steps_done = 0
+            bundle_in_image = False
+            if self.step_snapshots:
+                step_keys = step_snapshot_keys(run_info, tools_version())
+                steps_done, snapshot = await self._find_step_snapshot(
+                    step_keys,
+                )
+                if snapshot is not None:
+                    logger.info(
+                        "Resuming from snapshot after %d steps", steps_done,
+                    )
+                    PROM_STEPS_SKIPPED.inc(steps_done)
+                    image_name = snapshot
+                    bundle_in_image = True
+
+            # Runs of a sweep share the setup of their container: the first
+            # one commits it once the experiment and inputs are in, the others
+            # start from that image
+            sweep_image = None
+            inputs_in_image = False
+            if (
+                run_info.get('sweep_id') is not None
+                and self.share_sweep_setup
+                and self.derived_images
+                and not bundle_in_image
+            ):
+                sweep_image = sweep_image_name(run_info, tools_version())
+                if await self._claim_sweep_setup(sweep_image):
+                    logger.info("Using prepared container of the sweep")
+                    PROM_SWEEP_SETUPS.labels('shared').inc()
+                    image_name = sweep_image
+                    bundle_in_image = True
+                    inputs_in_image = True
+                    sweep_image = None
+                else:
+                    PROM_SWEEP_SETUPS.labels('prepared').inc()
+
+            # Look for an image with the experiment already extracted
+            cached_image = None
+            if self.image_cache is not None and not bundle_in_image:
+                cached_image = experiment_image_name(
+                    self.image_cache,
+                    run_info['experiment_hash'],
+                    tools_version(),
+                )
+                bundle_in_image = await self._find_experiment_image(
+                    cached_image,
                 )
-            cmdline = [
-                'docker', 'exec', '--', container,
-                f'{working_dir}/busybox', 'sh', '-c', ''.join(script),
+                if bundle_in_image:
+                    image_name = cached_image
+
+            # Take a ready container from the pool if possible. Containers
+            # with ports can't come from there, ports are set on creation
+            working_dir = None
+            if (
+                self.pool is not None
+                and not run_info['ports']
+                and not bundle_in_image
+            ):
+                claim_start = datetime.utcnow()
+                working_dir = await self.pool.claim(image_name, container)
+                # On a miss, creating the container records the phase
+                if working_dir is not None:
+                    phases.record('container', claim_start)
+
+            if working_dir is None:
+                working_dir = await self._prepare_container(
+                    container, image_name,
+                    tools_included=bundle_in_image,
+                    # The container only lives long enough for the run to
+                    # time out
+                    lifetime=run_info['timeout'] + CONTAINER_GRACE_TIME,
+                    ports={
+                        '%d/tcp' % port['port_number']: [{
+                            'HostIp': bind_host,
+                            'HostPort': '%d' % port['port_number'],
+                        }]
+                        for port in run_info['ports']
+                    },
+                    phases=phases,
+                )
+
+            PROM_TIME_TO_FIRST_COMMAND.observe(
+                time.perf_counter() - start_time,
+            )
+
+            # Download inputs in parallel, while the RPZ gets downloaded
+            semaphore = asyncio.Semaphore(INPUT_DOWNLOAD_CONCURRENCY)
+            # Files are closed even if something fails before they are used
+            opened_inputs = []
+
+            async def download_input(i, input_file):
+                local_path = os.path.join(directory, 'input_%d' % i)
+                async with semaphore:
+                    fp = await self._input_file(input_file, local_path)
+                opened_inputs.append(fp)
+                return fp, input_file['path']
+
+            # Snapshots already have the inputs
+            inputs = [
+                input_file for input_file in run_info['inputs']
+                if not inputs_in_image and not steps_done
             ]
-            await subprocess_check_call_async(cmdline)
+            if inputs:
+                logger.info("Downloading inputs")
+            inputs_start = datetime.utcnow()
+            downloads = [
+                asyncio.ensure_future(download_input(i, input_file))
+                for i, input_file in enumerate(inputs)
+            ]
+            inputs_future = asyncio.gather(*downloads)
+            try:
+                # Download RPZ into container
+                extracted = bundle_in_image
+                if extracted:
+                    logger.info("Using image with extracted RPZ")
+                elif self.stream_bundle:
+                    # Feed the download directly to rpztar, so the bundle is
+                    # not written to disk and extraction overlaps the download
+                    logger.info("Extracting RPZ from download")
+                    try:
+                        with phases.phase('extract'):
+                            await self._exec_check(
+                                container,
+                                [f'{working_dir}/busybox', 'sh', '-c',
+                                 f'cd / && {working_dir}/rpztar /dev/stdin'],
+                                stdin=self._bundle_stream(run_info),
+                            )
+                    except subprocess.CalledProcessError:
+                        # Fall back to a file, rpztar might need to seek
+                        logger.warning(
+                            "Extracting RPZ from stream failed, downloading",
+                        )
+                    else:
+                        extracted = True
+                if not extracted:
+                    logger.info("Downloading RPZ into container")
+                    with phases.phase('bundle'):
+                        await self._exec_check(
+                            container,
+                            [f'{working_dir}/busybox', 'sh', '-c',
+                             f'cat > {working_dir}/exp.rpz'],
+                            stdin=self._bundle_stream(run_info),
+                        )
 
-            # Prepare script to run actual experiment
-            script = ['set -eu\n']
-            for k, cmd in sorted(run_info['parameters'].items()):
-                if k.startswith('cmdline_'):
-                    if all(c in string.whitespace for c in cmd):
-                        continue
+                    # Extract RPZ
+                    logger.info("Extracting RPZ")
+                    with phases.phase('extract'):
+                        await self._exec_check(
+                            container,
+                            [f'{working_dir}/busybox', 'sh', '-c',
+                             f'cd / && {working_dir}/rpztar'
+                             + f' {working_dir}/exp.rpz'
+                             + f' && rm {working_dir}/exp.rpz'],
+                        )
+
+                # Cache the result, before inputs are added
+                if cached_image is not None and not bundle_in_image:
+                    try:
+                        push_future = await self._cache_experiment_image(
+                            container, cached_image, run_info,
+                        )
+                    except DockerError:
+                        logger.exception("Error caching experiment image")
 
-                    i = int(k[8:], 10)
-                    run = run_info['rpz_meta']['runs'][i]
-                    # Apply the environment
-                    cmd = f'{working_dir}/busybox env -i ' + ' '.join(
-                        f'{k}={shell_escape(v)}'
-                        for k, v in run['environ'].items()
-                    ) + ' ' + cmd
-                    # Apply uid/gid
-                    uid, gid = run['uid'], run['gid']
-                    cmd = (
-                        f'{working_dir}/rpzsudo "#{uid}" "#{gid}"'
-                        + f' {working_dir}/busybox sh -c ' + shell_escape(cmd)
+                input_files = await inputs_future
+
+                # Put all inputs in position at once, over the extracted files
+                if input_files:
+                    logger.info("Copying inputs into container")
+                    await self.docker.put_archive(
+                        container, '/',
+                        tar_stream(input_files),
+                    )
+            finally:
+                # Stop the other downloads if something failed, and let them
+                # finish, so no opened file is missed
+                for download in downloads:
+                    download.cancel()
+                if downloads:
+                    await asyncio.wait(downloads)
+                for fp in opened_inputs:
+                    fp.close()
+            if inputs:
+                # Downloads started with the RPZ, this overlaps its phases
+                phases.record('inputs', inputs_start)
+
+            # Let the other runs of the sweep use this container
+            if sweep_image is not None:
+                try:
+                    await self._commit_sweep_setup(
+                        container, sweep_image, run_info,
                     )
-                    # Change to the working directory
-                    wd = run['workingdir']
-                    cmd = f'cd {shell_escape(wd)} && {cmd}'
+                except DockerError:
+                    logger.exception("Error committing prepared container")
+                sweep_image = None
 
-                    script.append(cmd)
-                    script.append(textwrap.dedent(
-                        '''\
+            # Send the downloads through the caching proxy, if there is one
+            proxy_environ = await egress_environ(run_info['id'])
 
-                        printf '*** Command finished, status: %s\n' $?
-                        '''
-                    ))
+            # Prepare scripts to run actual experiment
+            scripts = []
+            for i, cmd in enumerate(run_steps(run_info)):
+                if all(c in string.whitespace for c in cmd):
+                    scripts.append(None)
+                    continue
+
+                run = run_info['rpz_meta']['runs'][i]
+                # Apply the environment
+                cmd = f'{working_dir}/busybox env -i ' + ' '.join(
+                    f'{k}={shell_escape(v)}'
+                    for k, v in (run['environ'] | proxy_environ).items()
+                ) + ' ' + cmd
+                # Apply uid/gid
+                uid, gid = run['uid'], run['gid']
+                cmd = (
+                    f'{working_dir}/rpzsudo "#{uid}" "#{gid}"'
+                    + f' {working_dir}/busybox sh -c ' + shell_escape(cmd)
+                )
+                # Change to the working directory
+                wd = run['workingdir']
+                cmd = f'cd {shell_escape(wd)} && {cmd}'
+
+                scripts.append(cmd + textwrap.dedent(
+                    '''\
+
+                    printf '*** Command finished, status: %s\n' $?
+                    '''
+                ))
 
             # Update status in database
             await asyncio.gather(
@@ -191,70 +1073,316 @@ class DockerRunner(BaseRunner):
                 ),
             )
 
+            # The steps share the bounds on the log
+            capture = get_log_capture()
+
+            async def run_script(script):
+                output = asyncio.StreamReader()
+                ret = await self.connector.log_output(
+                    run_info['id'],
+                    output,
+                    self.docker.exec_run(
+                        container,
+                        [f'{working_dir}/busybox', 'sh', '-c',
+                         'set -eu\n' + script],
+                        output=output,
+                    ),
+                    capture=capture,
+                )
+                if ret != 0:
+                    raise ValueError("Error: Docker returned %d" % ret)
+
+            async def run_all():
+                if step_keys is None:
+                    # Run all the steps in one go
+                    await run_script(''.join(
+                        script for script in scripts if script is not None
+                    ))
+                    return
+
+                # Run the steps one by one, snapshotting the container after
+                # each step but the last
+                if steps_done:
+                    await self.connector.log(
+                        run_info['id'],
+                        "*** Reusing the results of the first %d steps",
+                        steps_done,
+                    )
+                for i in range(steps_done, len(scripts)):
+                    if scripts[i] is None:
+                        continue
+                    await run_script(scripts[i])
+                    if i < len(scripts) - 1:
+                        try:
+                            await self._snapshot_step(
+                                container, step_keys[i], run_info,
+                            )
+                        except DockerError:
+                            logger.exception("Error snapshotting step")
+
             # Run command and wait until completion
-            cmdline = [
-                'docker', 'exec', '--', container,
-                f'{working_dir}/busybox', 'sh', '-c', ''.join(script),
-            ]
-            logger.info("Running experiment")
+            logger.info(
+                "Running experiment, timeout %ds", run_info['timeout'],
+            )
+            sampler = None
+            if resource_sample_interval() > 0:
+                sampler = ResourceSampler(
+                    self.docker, container, resource_sample_interval(),
+                )
+                await sampler.start()
             try:
-                ret = await self.connector.run_cmd_and_log(
-                    run_info['id'],
-                    cmdline,
+                with phases.phase('run'):
+                    await asyncio.wait_for(run_all(), run_info['timeout'])
+            except asyncio.TimeoutError:
+                raise ValueError(
+                    "Run timed out after %d seconds" % run_info['timeout']
                 )
             except IOError:
                 raise ValueError("Got IOError running experiment")
-            if ret != 0:
-                raise ValueError("Error: Docker returned %d" % ret)
+            finally:
+                # Record usage of failed runs too, they might be the
+                # pathological ones
+                if sampler is not None:
+                    await self._record_resources(run_info, sampler)
+                # The end of the output matters most when the run failed
+                if capture is not None:
+                    await self._finish_log_capture(run_info, capture)
+                if proxy_environ:
+                    await self._log_egress_stats(run_info)
             logger.info("Container done")
 
             # Get output files
-            logs = await self._upload_output_files(
-                run_info, container, directory,
-            )
+            with phases.phase('outputs'):
+                logs = await self._upload_output_files(run_info, container)
             if logs:
                 await self.connector.log_multiple(run_info['id'], logs)
             await self.connector.run_done(run_info['id'])
         finally:
-            # Remove container if created
+            cleanup_start = datetime.utcnow()
+            # Let another run of the sweep prepare the container instead
+            if sweep_image is not None:
+                self._release_sweep_setup(sweep_image, False)
+            # Remove container if created, without making the run wait
             if container is not None:
-                subprocess.call(['docker', 'rm', '-f', '--', container])
+                self._remove_later(container)
             # Remove temp directory
             shutil.rmtree(directory)
 
-    async def _upload_output_files(self, run_info, container, directory):
-        logs = []
+            # Finish pushing the experiment image
+            if push_future is not None:
+                if sys.exc_info()[0] is not None:
+                    push_future.cancel()
+                else:
+                    try:
+                        await push_future
+                    except DockerError:
+                        logger.exception("Error pushing experiment image")
 
-        for path in run_info['outputs']:
-            local_path = os.path.join(
-                directory,
-                'output_%s' % path['name'],
+            phases.record('cleanup', cleanup_start)
+            await phases.flush()
+
+    async def _finish_log_capture(self, run_info, capture):
+        lines = capture.finish()
+        if lines:
+            await self.connector.log_multiple(run_info['id'], lines)
+        try:
+            await capture.upload(self.connector, run_info['id'])
+        except Exception:
+            logger.exception("Error uploading full log")
+
+    async def _log_egress_stats(self, run_info):
+        try:
+            stats = await egress_stats(run_info['id'])
+        except Exception:
+            logger.exception("Error getting egress cache statistics")
+            return
+        if stats is not None:
+            await self.connector.log(
+                run_info['id'], '%s', format_egress_stats(stats),
             )
 
-            # Copy file out of container
-            logger.info("Getting output file %s", path['name'])
-            ret = await subprocess_call_async([
-                'docker', 'cp', '--',
-                '%s:%s' % (container, path['path']),
-                local_path,
-            ])
-            if ret != 0:
-                logger.warning("Couldn't get output %s", path['name'])
-                logs.append("Couldn't get output %s" % path['name'])
-                continue
+    async def _record_resources(self, run_info, sampler):
+        usage = await sampler.stop()
+        if usage is None:
+            return
+        logger.info(
+            "Run used %.1f CPU seconds, %d bytes of memory at most",
+            usage['cpu_seconds'], usage['memory_peak'],
+        )
+        try:
+            await self.connector.run_resources(run_info['id'], usage)
+        except Exception:
+            logger.exception("Error recording resource usage")
 
-            # Upload file
-            with open(local_path, 'rb') as file:
-                await self.connector.upload_output_file(
-                    run_info['id'],
-                    path['name'],
-                    file,
+    async def _upload_output_files(self, run_info, container):
+        """Upload the output files, in parallel.
+
+        Returns messages for the log about missing files.
+        """
+        semaphore = asyncio.Semaphore(OUTPUT_UPLOAD_CONCURRENCY)
+
+        async def upload(path):
+            async with semaphore:
+                return await self._upload_output_file(
+                    run_info, container, path,
                 )
 
-            # Remove local file
-            os.remove(local_path)
+        logs = await asyncio.gather(*[
+            upload(path) for path in run_info['outputs']
+        ])
+        return [log for log in logs if log is not None]
+
+    async def _upload_output_file(self, run_info, container, path):
+        """Stream an output file from the container to the object store.
 
-        return logs
+        Returns an error message if it doesn't exist or isn't a file.
+        """
+        logger.info("Getting output file %s", path['name'])
+        start_time = time.perf_counter()
+        archive = self.docker.get_archive(container, path['path'])
+        try:
+            member = await tar_first_file(archive)
+            if member is None:
+                logger.warning("Output %s is not a file", path['name'])
+                return "Couldn't get output %s" % path['name']
+            size, data = member
+            await self.connector.upload_output_stream(
+                run_info['id'], path['name'], size, data,
+            )
+        except DockerError as e:
+            logger.warning("Error getting %s: %s", path['path'], e)
+            return "Couldn't get output %s" % path['name']
+        finally:
+            await archive.aclose()
+
+        elapsed = time.perf_counter() - start_time
+        PROM_OUTPUT_SIZE.observe(size)
+        PROM_OUTPUT_TIME.observe(elapsed)
+        logger.info(
+            "Uploaded output %s, %d bytes in %.2f seconds",
+            path['name'], size, elapsed,
+        )
+        return None
+
+
+class ContainerPool(object):
+    """Keeps started containers ready to be used by runs.
+
+    For each base image in use, this keeps ``size`` containers created, loaded
+    with the tools, and started, so runs can go straight to downloading the
+    experiment. The images are the ones listed in ``images``, plus those used
+    the most by recent runs.
+    """
+    def __init__(self, runner, size, images=()):
+        self.runner = runner
+        self.size = size
+        self.images = list(images)
+        self.recent_images = collections.deque(maxlen=100)
+        # image -> list of (container, working_dir, ready time)
+        self.ready = {}
+        self.pending = collections.Counter()
+
+    def wanted_images(self):
+        images = list(self.images)
+        for image, _ in collections.Counter(self.recent_images).most_common():
+            if len(images) >= len(self.images) + POOL_TRACKED_IMAGES:
+                break
+            if image not in images:
+                images.append(image)
+        return images
+
+    async def claim(self, image_name, name):
+        """Take a ready container for an image, renaming it.
+
+        Returns its working directory, or None if there was none ready.
+        """
+        self.recent_images.append(image_name)
+        working_dir = None
+        ready = self.ready.get(image_name, [])
+        while ready:
+            container, container_dir, _ = ready.pop(0)
+            try:
+                await self.runner.docker.rename_container(container, name)
+            except DockerError:
+                logger.exception("Couldn't claim pool container %s", container)
+                await self._remove(container)
+            else:
+                logger.info("Using container %s from pool", container)
+                working_dir = container_dir
+                break
+
+        PROM_POOL_CLAIMS.labels('miss' if working_dir is None else 'hit').inc()
+        self.refill()
+        return working_dir
+
+    def refill(self):
+        for image_name in self.wanted_images():
+            missing = (
+                self.size
+                - len(self.ready.get(image_name, ()))
+                - self.pending[image_name]
+            )
+            for _ in range(missing):
+                self.pending[image_name] += 1
+                background_future(self._add(image_name))
+        PROM_POOL_READY.set(sum(len(c) for c in self.ready.values()))
+
+    async def _add(self, image_name):
+        container = 'pool_%08x' % random.getrandbits(32)
+        try:
+            working_dir = await self.runner._prepare_container(
+                container, image_name,
+                # Enough to wait in the pool, then be used for a run
+                lifetime=(
+                    POOL_MAX_IDLE + POOL_CHECK_INTERVAL
+                    + get_run_timeout() + CONTAINER_GRACE_TIME
+                ),
+                labels={POOL_LABEL: image_name},
+            )
+        except Exception:
+            logger.exception("Error creating pool container for %s",
+                             image_name)
+            await self._remove(container)
+            return
+        finally:
+            self.pending[image_name] -= 1
+        self.ready.setdefault(image_name, []).append(
+            (container, working_dir, time.monotonic()),
+        )
+        PROM_POOL_READY.set(sum(len(c) for c in self.ready.values()))
+
+    async def _remove(self, container):
+        try:
+            await self.runner.docker.remove_container(container)
+        except DockerError as e:
+            if e.status != 404:
+                logger.warning("Error removing %s: %s", container, e)
+
+    async def maintain(self):
+        """Background task replacing old containers and filling the pool.
+        """
+        # Remove containers left over by a previous process
+        for info in await self.runner.docker.list_containers(
+            label=POOL_LABEL,
+        ):
+            await self._remove(info['Id'])
+
+        while True:
+            try:
+                wanted = set(self.wanted_images())
+                now = time.monotonic()
+                for image_name, ready in self.ready.items():
+                    for entry in list(ready):
+                        if (
+                            image_name not in wanted
+                            or now > entry[2] + POOL_MAX_IDLE
+                        ):
+                            ready.remove(entry)
+                            await self._remove(entry[0])
+                self.refill()
+            except Exception:
+                logger.exception("Error maintaining container pool")
+            await asyncio.sleep(POOL_CHECK_INTERVAL)
 
 
 Runner = DockerRunner
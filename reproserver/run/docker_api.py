@@ -0,0 +1,551 @@
+import asyncio
+import json
+import logging
+import os
+import prometheus_client
+import struct
+import time
+from urllib.parse import quote, urlencode, urlparse
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_DOCKER_API = prometheus_client.Histogram(
+    'docker_api_seconds',
+    "Docker Engine API call time",
+    ['operation'],
+)
+
+
+API_VERSION = '1.41'
+
+# How many idle connections to the daemon to keep open for reuse
+MAX_IDLE_CONNECTIONS = 4
+
+CHUNK_SIZE = 64 * 1024
+
+# How long a command can keep running after closing its output, in seconds
+EXEC_EXIT_TIMEOUT = 60
+
+# Interval between checks of whether a command exited, in seconds
+EXEC_POLL_INTERVAL = 0.1
+
+# Header of the frames multiplexing stdout and stderr of exec sessions
+STREAM_HEADER = struct.Struct('>BxxxL')
+
+
+class DockerError(Exception):
+    """Error returned by the Docker daemon.
+    """
+    def __init__(self, status, message):
+        super(DockerError, self).__init__(
+            "Docker error %d: %s" % (status, message),
+        )
+        self.status = status
+        self.message = message
+
+
+def _error_message(body):
+    try:
+        return json.loads(body.decode('utf-8'))['message']
+    except (ValueError, KeyError, TypeError):
+        return body.decode('utf-8', 'replace').strip()
+
+
+def _split_image_name(image):
+    """Split an image reference into name and tag (or digest).
+    """
+    if '@' in image:
+        return image.split('@', 1)
+    name, sep, tag = image.rpartition(':')
+    if sep and '/' not in tag:
+        return name, tag
+    return image, 'latest'
+
+
+class DockerClient(object):
+    """Minimal asynchronous client for the Docker Engine API.
+
+    This speaks HTTP/1.1 directly over the socket set in ``DOCKER_HOST``
+    (``unix://`` or ``tcp://``, the local socket by default), and keeps
+    connections open to reuse them across calls.
+    """
+    def __init__(self, host=None):
+        if host is None:
+            host = os.environ.get('DOCKER_HOST') or \
+                'unix:///var/run/docker.sock'
+        url = urlparse(host)
+        if url.scheme == 'unix':
+            self._unix_path = url.path
+            self._address = None
+            self._host_header = 'docker'
+        elif url.scheme in ('tcp', 'http'):
+            self._unix_path = None
+            self._address = url.hostname, url.port or 2375
+            self._host_header = url.netloc
+        else:
+            raise ValueError("Unsupported DOCKER_HOST %r" % host)
+
+        self._idle = []
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+    async def _connect(self):
+        if self._unix_path is not None:
+            return await asyncio.open_unix_connection(self._unix_path)
+        else:
+            return await asyncio.open_connection(*self._address)
+
+    def _release(self, conn):
+        if (
+            len(self._idle) < MAX_IDLE_CONNECTIONS
+            and not conn[1].is_closing()
+        ):
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def _send(self, conn, method, path, params, headers, body):
+        reader, writer = conn
+
+        url = '/v%s%s' % (API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+        headers = dict(headers or {})
+        headers['Host'] = self._host_header
+        if body is None:
+            headers['Content-Length'] = '0'
+        elif isinstance(body, bytes):
+            headers['Content-Length'] = '%d' % len(body)
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+        head = ['%s %s HTTP/1.1\r\n' % (method, url)]
+        head.extend('%s: %s\r\n' % header for header in headers.items())
+        head.append('\r\n')
+        writer.write(''.join(head).encode('latin1'))
+
+        # Send body
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            async for chunk in body:
+                if chunk:
+                    writer.write(b'%x\r\n' % len(chunk))
+                    writer.write(chunk)
+                    writer.write(b'\r\n')
+                    await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+        # Read response status and headers
+        line = await reader.readuntil(b'\r\n')
+        status = int(line.split(b' ', 2)[1], 10)
+        response_headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, value = line.decode('latin1').split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+        return status, response_headers
+
+    async def _request(self, method, path, *,
+                       params=None, headers=None, body=None):
+        """Send a request, returns the status, headers, and connection.
+
+        The body of the response is left to be read from the connection.
+        """
+        # Try idle connections first
+        while self._idle:
+            conn = self._idle.pop()
+            if conn[0].at_eof() or conn[1].is_closing():
+                conn[1].close()
+                continue
+            try:
+                status, response_headers = await self._send(
+                    conn, method, path, params, headers, body,
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The daemon closed the idle connection, use another one
+                # unless we already consumed a streamed body
+                conn[1].close()
+                if body is not None and not isinstance(body, bytes):
+                    raise
+                continue
+            except BaseException:
+                conn[1].close()
+                raise
+            return status, response_headers, conn
+
+        conn = await self._connect()
+        try:
+            status, response_headers = await self._send(
+                conn, method, path, params, headers, body,
+            )
+        except BaseException:
+            conn[1].close()
+            raise
+        return status, response_headers, conn
+
+    async def _read_body(self, status, headers, conn):
+        """Read the body of a response, releasing the connection at the end.
+        """
+        reader, writer = conn
+
+        async def read_exactly(size):
+            while size > 0:
+                chunk = await reader.read(min(size, CHUNK_SIZE))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', size)
+                size -= len(chunk)
+                yield chunk
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        try:
+            if status in (204, 304) or 100 <= status < 200:
+                pass
+            elif 'chunked' in headers.get('transfer-encoding', '').lower():
+                while True:
+                    line = await reader.readuntil(b'\r\n')
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                    if size == 0:
+                        # Skip trailers
+                        while await reader.readuntil(b'\r\n') != b'\r\n':
+                            pass
+                        break
+                    async for chunk in read_exactly(size):
+                        yield chunk
+                    await reader.readexactly(2)
+            elif 'content-length' in headers:
+                async for chunk in read_exactly(
+                    int(headers['content-length'], 10),
+                ):
+                    yield chunk
+            else:
+                # Body ends when the connection is closed
+                keep_alive = False
+                while True:
+                    chunk = await reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        except BaseException:
+            writer.close()
+            raise
+
+        if keep_alive:
+            self._release(conn)
+        else:
+            writer.close()
+
+    async def _call(self, operation, method, path, *,
+                    params=None, json_body=None, headers=None, body=None):
+        """Make an API call, returning the decoded response.
+        """
+        if json_body is not None:
+            headers = dict(headers or {})
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(json_body).encode('utf-8')
+
+        with PROM_DOCKER_API.labels(operation).time():
+            status, response_headers, conn = await self._request(
+                method, path,
+                params=params, headers=headers, body=body,
+            )
+            response = b''.join([
+                chunk
+                async for chunk in self._read_body(
+                    status, response_headers, conn,
+                )
+            ])
+        if status >= 400:
+            raise DockerError(status, _error_message(response))
+        if (
+            response
+            and response_headers.get('content-type', '').startswith(
+                'application/json',
+            )
+        ):
+            return json.loads(response.decode('utf-8'))
+        return response
+
+    async def _stream(self, operation, method, path, *,
+                      params=None, headers=None, body=None):
+        """Make an API call, yielding the response body as it is received.
+        """
+        start = time.perf_counter()
+        try:
+            status, response_headers, conn = await self._request(
+                method, path,
+                params=params, headers=headers, body=body,
+            )
+            response = self._read_body(status, response_headers, conn)
+            try:
+                if status >= 400:
+                    raise DockerError(
+                        status,
+                        _error_message(b''.join([c async for c in response])),
+                    )
+                async for chunk in response:
+                    yield chunk
+            finally:
+                # Closes the connection if we stopped reading early
+                await response.aclose()
+        finally:
+            PROM_DOCKER_API.labels(operation).observe(
+                time.perf_counter() - start,
+            )
+
+    async def ping(self):
+        await self._call('ping', 'GET', '/_ping')
+
+    async def inspect_image(self, image):
+        return await self._call(
+            'inspect_image', 'GET',
+            '/images/%s/json' % quote(image, safe='/:@'),
+        )
+
+    async def _progress(self, operation, method, path, *,
+                        params=None, headers=None):
+        """Make an API call that streams its progress as JSON objects.
+
+        Errors appear in that stream, and are raised.
+        """
+        buf = b''
+        async for chunk in self._stream(
+            operation, method, path,
+            params=params, headers=headers,
+        ):
+            buf += chunk
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                message = json.loads(line.decode('utf-8'))
+                if 'error' in message:
+                    raise DockerError(500, message['error'])
+
+    async def pull_image(self, image):
+        name, tag = _split_image_name(image)
+        await self._progress(
+            'pull_image', 'POST', '/images/create',
+            params={'fromImage': name, 'tag': tag},
+        )
+
+    async def push_image(self, image):
+        name, tag = _split_image_name(image)
+        await self._progress(
+            'push_image', 'POST',
+            '/images/%s/push' % quote(name, safe='/:'),
+            params={'tag': tag},
+            # Required by the daemon, even without credentials
+            headers={'X-Registry-Auth': 'e30='},
+        )
+
+    async def list_images(self, *, label=None):
+        params = {}
+        if label is not None:
+            params['filters'] = json.dumps({'label': [label]})
+        return await self._call(
+            'list_images', 'GET', '/images/json',
+            params=params,
+        )
+
+    async def container_stats(self, container):
+        """Get a single sample of a container's resource usage.
+        """
+        return await self._call(
+            'container_stats', 'GET', '/containers/%s/stats' % container,
+            params={'stream': '0', 'one-shot': '1'},
+        )
+
+    async def system_df(self):
+        return await self._call('system_df', 'GET', '/system/df')
+
+    async def remove_image(self, image):
+        await self._call(
+            'remove_image', 'DELETE',
+            '/images/%s' % quote(image, safe='/:@'),
+        )
+
+    async def commit_container(self, container, repo, tag, *, config=None):
+        """Create an image from a container's changes.
+        """
+        return await self._call(
+            'commit_container', 'POST', '/commit',
+            params={'container': container, 'repo': repo, 'tag': tag},
+            json_body=config or {},
+        )
+
+    async def create_container(self, name, config):
+        return await self._call(
+            'create_container', 'POST', '/containers/create',
+            params={'name': name}, json_body=config,
+        )
+
+    async def list_containers(self, *, label=None, name=None, size=False):
+        params = {'all': '1'}
+        filters = {}
+        if label is not None:
+            filters['label'] = [label]
+        if name is not None:
+            filters['name'] = [name]
+        if filters:
+            params['filters'] = json.dumps(filters)
+        if size:
+            params['size'] = '1'
+        return await self._call(
+            'list_containers', 'GET', '/containers/json', params=params,
+        )
+
+    async def rename_container(self, container, name):
+        await self._call(
+            'rename_container', 'POST', '/containers/%s/rename' % container,
+            params={'name': name},
+        )
+
+    async def start_container(self, container):
+        await self._call(
+            'start_container', 'POST', '/containers/%s/start' % container,
+        )
+
+    async def remove_container(self, container, *, force=True):
+        await self._call(
+            'remove_container', 'DELETE', '/containers/%s' % container,
+            params={'force': '1' if force else '0', 'v': '1'},
+        )
+
+    async def put_archive(self, container, path, data):
+        """Extract a tar archive in the container.
+
+        ``data`` is either bytes or an async iterable of bytes.
+        """
+        await self._call(
+            'put_archive', 'PUT', '/containers/%s/archive' % container,
+            params={'path': path},
+            headers={'Content-Type': 'application/x-tar'},
+            body=data,
+        )
+
+    def get_archive(self, container, path):
+        """Get a tar archive of a path in the container, as chunks of bytes.
+        """
+        return self._stream(
+            'get_archive', 'GET', '/containers/%s/archive' % container,
+            params={'path': path},
+        )
+
+    async def exec_run(self, container, cmd, *, stdin=None, output=None):
+        """Run a command in a running container, return its exit status.
+
+        ``stdin`` is an optional async iterable of bytes sent to the command's
+        standard input. The command's output (stdout and stderr) is fed to the
+        ``asyncio.StreamReader`` ``output`` if provided, otherwise it is
+        logged.
+        """
+        try:
+            exec_id = (await self._call(
+                'exec_create', 'POST', '/containers/%s/exec' % container,
+                json_body={
+                    'Cmd': cmd,
+                    'AttachStdin': stdin is not None,
+                    'AttachStdout': True,
+                    'AttachStderr': True,
+                    'Tty': False,
+                },
+            ))['Id']
+
+            with PROM_DOCKER_API.labels('exec_start').time():
+                await self._exec_stream(exec_id, stdin, output)
+        finally:
+            if output is not None:
+                output.feed_eof()
+
+        # The output is closed, wait for the command to exit
+        deadline = time.monotonic() + EXEC_EXIT_TIMEOUT
+        while True:
+            info = await self._call(
+                'exec_inspect', 'GET', '/exec/%s/json' % exec_id,
+            )
+            if not info['Running']:
+                return info['ExitCode']
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    "Command still running %d seconds after closing its "
+                    "output" % EXEC_EXIT_TIMEOUT
+                )
+            await asyncio.sleep(EXEC_POLL_INTERVAL)
+
+    async def _exec_stream(self, exec_id, stdin, output):
+        # Ask to take over the connection for the command's streams
+        status, headers, conn = await self._request(
+            'POST', '/exec/%s/start' % exec_id,
+            headers={
+                'Content-Type': 'application/json',
+                'Connection': 'Upgrade',
+                'Upgrade': 'tcp',
+            },
+            body=json.dumps({'Detach': False, 'Tty': False}).encode('utf-8'),
+        )
+        reader, writer = conn
+        try:
+            if status >= 400:
+                response = b''.join([
+                    chunk
+                    async for chunk in self._read_body(status, headers, conn)
+                ])
+                raise DockerError(status, _error_message(response))
+
+            # The connection is now a raw multiplexed stream
+            async def send_stdin():
+                async for chunk in stdin:
+                    writer.write(chunk)
+                    await writer.drain()
+                if writer.can_write_eof():
+                    writer.write_eof()
+
+            async def read_output():
+                while True:
+                    try:
+                        header = await reader.readexactly(STREAM_HEADER.size)
+                    except asyncio.IncompleteReadError as e:
+                        if e.partial:
+                            raise
+                        break
+                    _, size = STREAM_HEADER.unpack(header)
+                    data = await reader.readexactly(size)
+                    if output is not None:
+                        output.feed_data(data)
+                    else:
+                        logger.info(
+                            "> %s", data.decode('utf-8', 'replace').rstrip(),
+                        )
+
+            read_op = asyncio.ensure_future(read_output())
+            send_op = None
+            if stdin is not None:
+                send_op = asyncio.ensure_future(send_stdin())
+            try:
+                if send_op is not None:
+                    await asyncio.wait(
+                        [read_op, send_op],
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    # If the command exited, it doesn't matter whether it
+                    # read all its input
+                    if send_op.done() and not read_op.done():
+                        send_op.result()
+                await read_op
+            finally:
+                read_op.cancel()
+                if send_op is not None:
+                    send_op.cancel()
+                    if send_op.done() and not send_op.cancelled():
+                        send_op.exception()
+        finally:
+            writer.close()
@@ -0,0 +1,53 @@
+import logging
+import math
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+# How many of the most recent successful runs of an experiment to consider
+DURATION_HISTORY = 20
+
+# Which percentile of past durations to use as the prediction
+DURATION_PERCENTILE = 75
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list of numbers.
+    """
+    if not values:
+        raise ValueError("Empty list")
+    values = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def predict_duration(db, experiment_hash):
+    """Predict how long a run of an experiment will take, in seconds.
+
+    This uses a rolling percentile of the run time (from start to done) of the
+    last successful runs of the same experiment. Returns None if the
+    experiment has never completed a run successfully.
+    """
+    rows = (
+        db.query(database.Run.started, database.Run.done)
+        .filter(database.Run.experiment_hash == experiment_hash)
+        .filter(database.Run.started != None)  # noqa: E711
+        .filter(database.Run.done != None)  # noqa: E711
+        # Failed, cancelled or timed out runs stopped at an arbitrary point
+        .filter(database.Run.succeeded == True)  # noqa: E712
+        # Runs that reused previous results didn't actually run
+        .filter(database.Run.reused_run_id == None)  # noqa: E711
+        .order_by(database.Run.done.desc())
+        .limit(DURATION_HISTORY)
+    ).all()
+    durations = [
+        (done - started).total_seconds()
+        for started, done in rows
+        if done >= started
+    ]
+    if not durations:
+        return None
+    return percentile(durations, DURATION_PERCENTILE)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from tornado.httpclient import AsyncHTTPClient
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+EGRESS_PROXY_PORT = 3128
+
+
+def egress_proxy_url():
+    """URL of the caching proxy for the runs' downloads, None if disabled.
+    """
+    return os.environ.get('RUN_EGRESS_PROXY', '').rstrip('/') or None
+
+
+async def egress_environ(run_id):
+    """Get the variables sending the HTTP traffic of a run through the proxy.
+
+    The run is identified by the user in the proxy URL, so the proxy can count
+    its requests.
+    """
+    url = egress_proxy_url()
+    if url is None:
+        return {}
+    parsed = urllib.parse.urlsplit(url)
+    port = parsed.port or EGRESS_PROXY_PORT
+
+    # The containers might not resolve the names we do (e.g. with Docker in
+    # Docker, they don't use the embedded DNS), so give them the address
+    try:
+        infos = await asyncio.get_event_loop().getaddrinfo(
+            parsed.hostname, port, type=socket.SOCK_STREAM,
+        )
+    except OSError:
+        logger.warning("Can't resolve egress proxy %s", parsed.hostname)
+        return {}
+    address = infos[0][4][0]
+    if ':' in address:
+        address = '[%s]' % address
+
+    proxy = 'http://run%s:run@%s:%d' % (run_id, address, port)
+    no_proxy = 'localhost,127.0.0.1'
+    return {
+        'http_proxy': proxy,
+        'https_proxy': proxy,
+        'HTTP_PROXY': proxy,
+        'HTTPS_PROXY': proxy,
+        'no_proxy': no_proxy,
+        'NO_PROXY': no_proxy,
+    }
+
+
+async def egress_stats(run_id):
+    """Get the requests the proxy received from a run, None if unknown.
+    """
+    url = egress_proxy_url()
+    if url is None:
+        return None
+    response = await AsyncHTTPClient().fetch(
+        '%s/stats/%s' % (url, run_id),
+        raise_error=False,
+    )
+    if response.code != 200:
+        return None
+    return json.loads(response.body.decode('utf-8'))
+
+
+def format_egress_stats(stats):
+    """Describe the requests a run made through the proxy, for its log.
+    """
+    return (
+        "*** Egress cache: %d requests answered from the cache (%d bytes), "
+        "%d fetched and cached (%d bytes), %d not cacheable (%d bytes), "
+        "%d HTTPS connections (not cached), %d errors"
+    ) % (
+        stats['hit']['requests'], stats['hit']['bytes'],
+        stats['miss']['requests'], stats['miss']['bytes'],
+        stats['uncached']['requests'], stats['uncached']['bytes'],
+        stats['tunnel']['requests'],
+        stats['error']['requests'],
+    )
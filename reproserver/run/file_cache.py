@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+import prometheus_client
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_FILE_CACHE_BYTES = prometheus_client.Counter(
+    'file_cache_bytes_total',
+    "Bytes of bundles and input files read from the local cache",
+    ['result'],
+)
+PROM_FILE_CACHE_EVICTED = prometheus_client.Counter(
+    'file_cache_evicted_total',
+    "Files removed from the local cache to stay under its size limit",
+)
+
+
+# Leftover temporary files older than this get removed
+STALE_TEMP_TIME = 24 * 3600
+
+
+def get_file_cache():
+    """Get the cache configured by the environment, or None.
+    """
+    directory = os.environ.get('RUN_FILE_CACHE', '')
+    if not directory:
+        return None
+    max_size = int(os.environ.get('RUN_FILE_CACHE_SIZE', '') or '10240', 10)
+    return FileCache(directory, max_size * 1024 * 1024)
+
+
+class FileCache(object):
+    """Content-addressed cache of downloaded files, on local disk.
+
+    Files are keyed by their hash, so they never change. They are filled
+    atomically (downloaded to a temporary file then renamed), concurrent
+    requests for the same key share a single download, and the least recently
+    used files get removed when the total size goes over the limit.
+
+    The directory may be shared by multiple processes, e.g. runner pods on the
+    same node.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._filling = {}
+        os.makedirs(directory, exist_ok=True)
+
+    async def open(self, key, download):
+        """Open a cached file, filling it with ``download(path)`` if needed.
+        """
+        path = os.path.join(self.directory, key)
+        future = self._filling.get(key)
+        if future is None:
+            try:
+                fp = open(path, 'rb')
+            except FileNotFoundError:
+                future = self._filling[key] = asyncio.ensure_future(
+                    self._fill(key, path, download),
+                )
+                future.add_done_callback(
+                    lambda _: self._filling.pop(key, None),
+                )
+            else:
+                # Mark as recently used
+                os.utime(path)
+                PROM_FILE_CACHE_BYTES.labels('hit').inc(
+                    os.fstat(fp.fileno()).st_size,
+                )
+                return fp
+
+        await asyncio.shield(future)
+        return open(path, 'rb')
+
+    async def _fill(self, key, path, download):
+        temp_path = os.path.join(
+            self.directory,
+            '.tmp-%s-%08x' % (key, random.getrandbits(32)),
+        )
+        try:
+            await download(temp_path)
+            os.rename(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        PROM_FILE_CACHE_BYTES.labels('miss').inc(os.stat(path).st_size)
+
+        await asyncio.get_event_loop().run_in_executor(None, self.evict)
+
+    def evict(self):
+        """Remove the least recently used files to get under the size limit.
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.startswith('.tmp-'):
+                if stat.st_mtime < now - STALE_TEMP_TIME:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        # Always keep the most recent file, even if it's over the limit
+        for _, size, path in entries[:-1]:
+            if total <= self.max_size:
+                break
+            logger.info("Removing %s from cache", os.path.basename(path))
+            self._remove(path)
+            PROM_FILE_CACHE_EVICTED.inc()
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Removed by another process
+            pass
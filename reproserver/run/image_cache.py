@@ -0,0 +1,148 @@
+import asyncio
+from datetime import datetime
+import json
+import logging
+import os
+import prometheus_client
+from sqlalchemy import func
+from tornado import httpclient
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_IMAGE_CACHE = prometheus_client.Counter(
+    'experiment_image_cache_total',
+    "Lookups of pre-extracted experiment images",
+    ['result'],
+)
+PROM_IMAGE_CACHE_EVICTED = prometheus_client.Counter(
+    'experiment_image_cache_evicted_total',
+    "Experiment images removed from the registry",
+)
+
+
+# Repository of the experiment images, in the registry
+IMAGE_CACHE_REPO = 'reproserver-experiment'
+
+# Label set on experiment images, to the experiment hash
+IMAGE_CACHE_LABEL = 'reproserver.experiment'
+
+# How often to remove old images from the registry
+EVICT_INTERVAL = 3600
+
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+])
+
+
+def image_cache_registry():
+    """Get the registry where experiment images are cached, or None.
+    """
+    if (
+        os.environ.get('RUN_IMAGE_CACHE', '').lower()
+        in ('y', 'yes', 'true', 'on', '1')
+    ):
+        return os.environ['REGISTRY']
+    return None
+
+
+def image_cache_size():
+    """Number of experiments to keep images of.
+    """
+    return int(os.environ.get('RUN_IMAGE_CACHE_SIZE', '') or '50', 10)
+
+
+def experiment_image_name(registry, experiment_hash, tools_version):
+    return '%s/%s:%s-%s' % (
+        registry, IMAGE_CACHE_REPO, experiment_hash, tools_version[:12],
+    )
+
+
+def _tag_experiment(tag):
+    return tag.split('-', 1)[0]
+
+
+def images_to_evict(db, tags, keep):
+    """Pick the tags to remove, keeping the most recently run experiments.
+    """
+    hashes = {_tag_experiment(tag) for tag in tags}
+    last_used = dict(
+        db.query(database.Run.experiment_hash, func.max(database.Run.started))
+        .filter(database.Run.experiment_hash.in_(hashes))
+        .group_by(database.Run.experiment_hash)
+        .all()
+    )
+    ranked = sorted(
+        hashes,
+        key=lambda h: last_used.get(h) or datetime.min,
+        reverse=True,
+    )
+    kept = set(ranked[:keep])
+    return sorted(tag for tag in tags if _tag_experiment(tag) not in kept)
+
+
+class RegistryClient(object):
+    """Client for the registry HTTP API, to list and delete images.
+    """
+    def __init__(self, registry):
+        self.base_url = 'http://%s/v2/%s' % (registry, IMAGE_CACHE_REPO)
+
+    async def list_tags(self):
+        try:
+            response = await httpclient.AsyncHTTPClient().fetch(
+                self.base_url + '/tags/list',
+            )
+        except httpclient.HTTPClientError as e:
+            if e.code == 404:
+                return []
+            raise
+        return json.loads(response.body.decode('utf-8'))['tags'] or []
+
+    async def delete_tag(self, tag):
+        # Manifests can only be deleted by digest
+        response = await httpclient.AsyncHTTPClient().fetch(
+            self.base_url + '/manifests/' + tag,
+            method='HEAD',
+            headers={'Accept': MANIFEST_TYPES},
+        )
+        digest = response.headers['Docker-Content-Digest']
+        await httpclient.AsyncHTTPClient().fetch(
+            self.base_url + '/manifests/' + digest,
+            method='DELETE',
+        )
+
+
+async def evict_images(DBSession, registry, keep):
+    """Remove images of the experiments that were not run recently.
+    """
+    client = RegistryClient(registry)
+    tags = await client.list_tags()
+    db = DBSession()
+    try:
+        to_evict = images_to_evict(db, tags, keep)
+    finally:
+        db.close()
+    for tag in to_evict:
+        logger.info("Removing cached experiment image %s", tag)
+        await client.delete_tag(tag)
+        PROM_IMAGE_CACHE_EVICTED.inc()
+
+
+async def image_cache_evictor(DBSession, registry, keep):
+    """Periodically remove the least recently used images from the registry.
+
+    Note that this only deletes manifests, the registry's garbage collection
+    is needed to reclaim the disk space.
+    """
+    while True:
+        try:
+            await evict_images(DBSession, registry, keep)
+        except Exception:
+            logger.exception("Error removing cached experiment images")
+        await asyncio.sleep(EVICT_INTERVAL)
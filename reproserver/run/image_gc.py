@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+import prometheus_client
+import time
+
+from .docker_api import DockerError
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_IMAGES_SIZE = prometheus_client.Gauge(
+    'docker_images_size_bytes',
+    "Disk space used by Docker images",
+)
+PROM_IMAGES_EVICTED = prometheus_client.Counter(
+    'docker_images_evicted_total',
+    "Images removed to free disk space",
+)
+PROM_IMAGES_EVICTED_BYTES = prometheus_client.Counter(
+    'docker_images_evicted_bytes_total',
+    "Disk space freed by removing images",
+)
+
+
+# How often to check disk usage
+IMAGE_GC_INTERVAL = 300
+
+
+def get_image_collector(docker, **kwargs):
+    """Get the image collector configured by the environment, or None.
+
+    Thresholds are set in megabytes.
+    """
+    high = os.environ.get('RUN_IMAGE_GC_HIGH', '')
+    if not high:
+        return None
+    high = int(high, 10)
+    low = int(os.environ.get('RUN_IMAGE_GC_LOW', '') or str(high * 3 // 4))
+    return ImageCollector(
+        docker,
+        high * 1024 * 1024, low * 1024 * 1024,
+        **kwargs,
+    )
+
+
+def _normalize(image):
+    if ':' not in image.rsplit('/', 1)[-1] and '@' not in image:
+        return image + ':latest'
+    return image
+
+
+class ImageCollector(object):
+    """Removes the least recently used images when using too much disk.
+
+    When the images use more than ``high`` bytes, images are removed, least
+    recently used first, until they use less than ``low``. Images used by
+    containers are never removed, nor are images returned by ``pinned()``
+    (and images derived from them, according to the ``derived_label`` label).
+    """
+    def __init__(self, docker, high, low, *, pinned=None, derived_label=None):
+        self.docker = docker
+        self.high = high
+        self.low = low
+        self.pinned = pinned
+        self.derived_label = derived_label
+        self.last_used = {}
+
+    def touch(self, image):
+        """Record that an image is being used.
+        """
+        self.last_used[_normalize(image)] = time.time()
+
+    def _last_use(self, image):
+        uses = [
+            self.last_used[tag]
+            for tag in image.get('RepoTags') or ()
+            if tag in self.last_used
+        ]
+        if uses:
+            return max(uses)
+        return image['Created']
+
+    def _is_pinned(self, image, pinned):
+        if any(tag in pinned for tag in image.get('RepoTags') or ()):
+            return True
+        labels = image.get('Labels') or {}
+        if self.derived_label is not None and self.derived_label in labels:
+            return _normalize(labels[self.derived_label]) in pinned
+        return False
+
+    async def collect(self):
+        """Remove images if over the high-water mark.
+        """
+        usage = await self.docker.system_df()
+        total = usage['LayersSize']
+        PROM_IMAGES_SIZE.set(total)
+        if total <= self.high:
+            return
+
+        pinned = set()
+        if self.pinned is not None:
+            pinned = {_normalize(image) for image in self.pinned()}
+        candidates = [
+            image for image in usage['Images']
+            if image.get('Containers', 0) == 0
+            and not self._is_pinned(image, pinned)
+        ]
+        candidates.sort(key=self._last_use)
+
+        logger.info(
+            "Images use %d bytes, over %d, removing some",
+            total, self.high,
+        )
+        for image in candidates:
+            if total <= self.low:
+                break
+            tags = [
+                tag for tag in image.get('RepoTags') or ()
+                if tag != '<none>:<none>'
+            ]
+            try:
+                # Untag every name, the image goes away with the last one
+                for tag in tags or [image['Id']]:
+                    await self.docker.remove_image(tag)
+                    self.last_used.pop(tag, None)
+            except DockerError as e:
+                # Might be the parent of another image, or started being used
+                logger.info("Not removing image %s: %s", image['Id'], e)
+                continue
+            freed = image['Size'] - max(image.get('SharedSize', 0), 0)
+            logger.info(
+                "Removed image %s (%s), %d bytes",
+                image['Id'], ', '.join(tags) or "untagged", freed,
+            )
+            PROM_IMAGES_EVICTED.inc()
+            PROM_IMAGES_EVICTED_BYTES.inc(freed)
+            total -= freed
+
+    async def maintain(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception:
+                logger.exception("Error collecting images")
+            await asyncio.sleep(IMAGE_GC_INTERVAL)
@@ -1,25 +1,38 @@
 import asyncio
+from datetime import datetime, timezone
 import kubernetes_asyncio.client as k8s_client
 import kubernetes_asyncio.config as k8s_config
 import kubernetes_asyncio.watch as k8s_watch
 import logging
 import os
-import subprocess
 import sys
-import time
 import yaml
 
 from .connector import DirectConnector, HttpConnector
 from .. import database
 from ..proxy import ProxyHandler
 from ..utils import background_future, setup
-from .base import PROM_RUNS, BaseRunner
+from .base import PROM_RUNS, BaseRunner, get_run_timeout
 from .docker import DockerRunner
+from .docker_api import DockerError
+from .phases import PhaseTimer
+from .prepull import warm_mirror
 
 
 logger = logging.getLogger(__name__)
 
 
+# How long a run pod may stay up after the experiment's time limit, to allow
+# for pulling images, setup, and collecting outputs
+POD_GRACE_TIME = 1800
+
+# How long to wait for a cancelled run's pod to terminate
+POD_DELETE_WAIT = 60
+
+# How often the watcher looks for run pods past their time limit, in seconds
+TIMEOUT_CHECK_INTERVAL = 60
+
+
 def labels_to_string(labels_dict):
     return ','.join(k + '=' + v for k, v in labels_dict.items())
 
@@ -73,6 +86,15 @@ class K8sRunner(BaseRunner):
         self.namespace = os.environ['RUN_NAMESPACE']
         self.pod_name_prefix = os.environ['RUN_NAME_PREFIX']
         self.pod_labels = yaml.safe_load(os.environ['RUN_LABELS'])
+        self.registry_mirror = os.environ.get('REGISTRY_MIRROR') or None
+
+    async def prepull(self, image_name):
+        # Each run pod has its own Docker daemon, get the image into the
+        # registry mirror they share instead
+        if self.registry_mirror is None:
+            logger.warning("REGISTRY_MIRROR is not set, can't pre-pull")
+            return
+        await warm_mirror(self.registry_mirror, image_name)
 
     def _pod_name(self, run_id):
         return '{0}run-{1}'.format(self.pod_name_prefix, run_id)
@@ -80,6 +102,7 @@ class K8sRunner(BaseRunner):
     async def run_inner(self, run_info):
         run_id = run_info['id']
         extra_config = run_info['extra_config']
+        timeout = run_info['timeout']
         del run_info
 
         # Load extra configuration
@@ -116,6 +139,11 @@ class K8sRunner(BaseRunner):
         for container in pod_spec['containers']:
             if container['name'] == 'runner':
                 container['args'] += [str(run_id)]
+                # Lets the pod time how long it took to be scheduled
+                container.setdefault('env', []).append({
+                    'name': 'RUN_SCHEDULED_AT',
+                    'value': datetime.utcnow().isoformat(),
+                })
 
                 # This is mostly used by Tilt
                 if os.environ.get('OVERRIDE_RUNNER_IMAGE'):
@@ -124,6 +152,10 @@ class K8sRunner(BaseRunner):
         if extra_containers:
             pod_spec['containers'].extend(extra_containers)
 
+        # Have Kubernetes enforce the time limit, on top of the runner and
+        # the watcher
+        pod_spec['activeDeadlineSeconds'] = timeout + POD_GRACE_TIME
+
         await self.connector.run_progress(run_id, 20, "Worker starting")
 
         async with k8s_client.ApiClient() as api:
@@ -178,6 +210,36 @@ class K8sRunner(BaseRunner):
             )
             logger.info("Service created: %s", name)
 
+    async def cancel_inner(self, run_id):
+        k8s_config.load_incluster_config()
+
+        name = self._pod_name(run_id)
+        async with k8s_client.ApiClient() as api:
+            v1 = k8s_client.CoreV1Api(api)
+            for delete in (
+                v1.delete_namespaced_pod,
+                v1.delete_namespaced_service,
+            ):
+                try:
+                    await delete(name=name, namespace=self.namespace)
+                except k8s_client.ApiException as e:
+                    if e.status != 404:
+                        raise
+
+            # Wait for the pod to be gone, so the run can be started again
+            for _ in range(POD_DELETE_WAIT // 2):
+                try:
+                    await v1.read_namespaced_pod(
+                        name=name,
+                        namespace=self.namespace,
+                    )
+                except k8s_client.ApiException as e:
+                    if e.status == 404:
+                        break
+                    raise
+                await asyncio.sleep(2)
+        logger.info("Pod deleted: %s", name)
+
 
 Runner = K8sRunner
 
@@ -190,20 +252,6 @@ def _run_in_pod(run_id):
     """
     setup(enable_prometheus=False)
 
-    # Wait for Docker to be available
-    for _ in range(30):
-        ret = subprocess.call(
-            ['docker', 'info'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        if ret == 0:
-            break
-        time.sleep(2)
-    else:
-        logger.critical("Docker did not come online")
-        sys.exit(1)
-
     # Get a runner from environment
     runner = DockerRunner(
         HttpConnector(
@@ -211,6 +259,47 @@ def _run_in_pod(run_id):
             os.environ['CONNECTION_TOKEN'],
         ),
     )
+    # Each run has its own Docker daemon, runs of a sweep can't share setup
+    runner.share_sweep_setup = False
+
+    phases = PhaseTimer(runner.connector, run_id)
+
+    # Wait for Docker to be available
+    async def wait_for_docker():
+        if os.environ.get('RUN_SCHEDULED_AT'):
+            phases.record(
+                'scheduled',
+                datetime.fromisoformat(os.environ['RUN_SCHEDULED_AT']),
+            )
+        with phases.phase('docker'):
+            for _ in range(30):
+                try:
+                    await runner.docker.ping()
+                except (OSError, DockerError):
+                    await asyncio.sleep(2)
+                else:
+                    return True
+        return False
+
+    if not asyncio.get_event_loop().run_until_complete(wait_for_docker()):
+        logger.critical("Docker did not come online")
+        sys.exit(1)
+
+    # The background collection started before Docker was up and the pod
+    # might be gone before it tries again, so collect images explicitly
+    async def collect_images():
+        if runner.image_gc is None:
+            return
+        try:
+            await runner.image_gc.collect()
+        except Exception:
+            logger.exception("Error collecting images")
+
+    asyncio.get_event_loop().run_until_complete(collect_images())
+
+    asyncio.get_event_loop().run_until_complete(
+        runner.remove_leftover_containers(),
+    )
 
     # Load run information
     run_info = asyncio.get_event_loop().run_until_complete(
@@ -245,12 +334,18 @@ def _run_in_pod(run_id):
         raise
     else:
         logger.info("Kubernetes runner pod complete")
+    finally:
+        # Don't leave the container in a persistent image store
+        asyncio.get_event_loop().run_until_complete(runner.wait_removals())
+        asyncio.get_event_loop().run_until_complete(collect_images())
+        asyncio.get_event_loop().run_until_complete(phases.flush())
 
 
 class K8sWatcher(object):
     """Background process watching run pods.
 
     * Deletes them when done, setting potential error status
+    * Deletes them when they exceed their time limit
     * Sets Prometheus metrics
 
     How does it work:
@@ -261,6 +356,9 @@ class K8sWatcher(object):
     minutes.
 
     The ``_watch_loop()`` task watches for changes in pods.
+
+    The ``_timeout_loop()`` task deletes pods past their time limit every
+    minute.
     """
     def __init__(self, connector):
         self.connector = connector
@@ -303,10 +401,14 @@ class K8sWatcher(object):
         async with k8s_client.ApiClient() as api:
             watch = asyncio.ensure_future(self._watch_loop(api, DBSession))
             sync = asyncio.ensure_future(self._full_sync_loop(api, DBSession))
+            timeouts = asyncio.ensure_future(
+                self._timeout_loop(api, DBSession),
+            )
             done, pending = await asyncio.wait(
                 [
                     watch,
                     sync,
+                    timeouts,
                 ],
                 return_when=asyncio.FIRST_COMPLETED,
             )
@@ -317,6 +419,8 @@ class K8sWatcher(object):
                     logger.critical("Watch loop finished")
                 elif fut is sync:
                     logger.critical("Full sync loop finished")
+                elif fut is timeouts:
+                    logger.critical("Timeout loop finished")
                 try:
                     fut.result()
                 except Exception as e:
@@ -510,13 +614,76 @@ class K8sWatcher(object):
                         )
 
             if not success:
-                await self.connector.run_failed(run_id, "Internal error")
+                if pod.status.reason == 'DeadlineExceeded':
+                    await self.connector.run_failed(run_id, "Run timed out")
+                else:
+                    await self.connector.run_failed(run_id, "Internal error")
 
             # Schedule deletion in 1 minute
             background_future(wait_then_delete_pod(pod.metadata.name))
         else:
             self.running_set_add(run_id)
 
+    async def _timeout_loop(self, api, DBSession):
+        while True:
+            await asyncio.sleep(TIMEOUT_CHECK_INTERVAL)
+            try:
+                await self._check_timeouts(api, DBSession)
+            except k8s_client.ApiException:
+                logger.exception("Error checking run timeouts")
+
+    async def _check_timeouts(self, api, DBSession):
+        v1 = k8s_client.CoreV1Api(api)
+
+        pods = await v1.list_namespaced_pod(
+            namespace=self.namespace,
+            label_selector=self.label_selector,
+        )
+        started = {}
+        for pod in pods.items:
+            if (
+                pod.metadata.deletion_timestamp is None
+                and pod.status.start_time is not None
+            ):
+                run_id = int(pod.metadata.labels['run'], 10)
+                started[run_id] = pod
+        if not started:
+            return
+
+        # Get the time limits of all those runs at once
+        def get_timeouts():
+            with DBSession() as db:
+                return dict(
+                    db.query(database.Run.id, database.Run.timeout)
+                    .filter(database.Run.id.in_(list(started)))
+                    .filter(database.Run.done == None)  # noqa: E711
+                    .all()
+                )
+
+        timeouts = await self.loop.run_in_executor(None, get_timeouts)
+
+        now = datetime.now(timezone.utc)
+        for run_id, timeout in timeouts.items():
+            pod = started[run_id]
+            timeout = get_run_timeout(timeout) + POD_GRACE_TIME
+            elapsed = now - pod.status.start_time
+            if elapsed.total_seconds() <= timeout:
+                continue
+            logger.warning(
+                "Run pod %s timed out after %ds, deleting",
+                pod.metadata.name, elapsed.total_seconds(),
+            )
+            self.running_set_discard(run_id)
+            try:
+                await v1.delete_namespaced_pod(
+                    name=pod.metadata.name,
+                    namespace=self.namespace,
+                )
+            except k8s_client.ApiException as e:
+                if e.status != 404:
+                    raise
+            await self.connector.run_failed(run_id, "Run timed out")
+
 
 def watch():
     setup()
@@ -0,0 +1,126 @@
+import collections
+import gzip
+import logging
+import os
+import tempfile
+import time
+
+from ..database import LOG_ARCHIVE_NAME
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_log_capture():
+    """Get a capture bounding the log of a run, None if disabled.
+    """
+    head = int(os.environ.get('RUN_LOG_HEAD', '') or '5000', 10)
+    tail = int(os.environ.get('RUN_LOG_TAIL', '') or '1000', 10)
+    if head <= 0:
+        return None
+    return LogCapture(head, tail)
+
+
+class LogCapture(object):
+    """Keeps the beginning and the end of the output of a run in its log.
+
+    The first ``head`` lines go to the log as they come, then only the last
+    ``tail`` lines are kept, to be added after a marker once the output ends.
+    Every line is also written to a compressed file, which is uploaded with
+    the outputs if lines had to be skipped.
+    """
+    def __init__(self, head, tail):
+        self.head = head
+        self.lines = 0
+        self.skipped = 0
+        self._tail = collections.deque(maxlen=max(tail, 0))
+        self._file = tempfile.TemporaryFile()
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode='wb')
+
+    def add(self, line):
+        """Capture a line, returns the lines to add to the log right away.
+        """
+        self._gzip.write(line.encode('utf-8') + b'\n')
+        self.lines += 1
+        if self.lines <= self.head:
+            return [line]
+        if len(self._tail) == self._tail.maxlen:
+            self.skipped += 1
+        self._tail.append(line)
+        if self.lines == self.head + 1:
+            return [
+                "*** Output is long, the next lines will only be shown when "
+                "the run ends"
+            ]
+        return []
+
+    def finish(self):
+        """Get the lines to add to the log after the output ended.
+        """
+        lines = []
+        if self.skipped:
+            lines.append(
+                "*** %d lines skipped, the full log is available with the "
+                "results" % self.skipped
+            )
+        lines.extend(self._tail)
+        self._tail.clear()
+        return lines
+
+    def archive(self):
+        """Get the compressed file with the whole output, None if not needed.
+
+        This closes the capture.
+        """
+        self._gzip.close()
+        if not self.skipped:
+            self._file.close()
+            return None
+        self._file.seek(0, 0)
+        return self._file
+
+    async def upload(self, connector, run_id):
+        """Upload the whole output if lines were skipped.
+        """
+        archive = self.archive()
+        if archive is None:
+            return
+        try:
+            await connector.upload_output_file(
+                run_id, LOG_ARCHIVE_NAME, archive,
+            )
+        finally:
+            archive.close()
+
+
+class ProcessLogLimiter(object):
+    """Rate-limits logging the output of a run to this process's log.
+    """
+    def __init__(self, rate=None):
+        if rate is None:
+            rate = float(
+                os.environ.get('RUN_LOG_PROCESS_RATE', '') or '20',
+            )
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def log(self, line):
+        if self.rate <= 0:
+            logger.info("> %s", line)
+            return
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate,
+            self.tokens + (now - self.last) * self.rate,
+        )
+        self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return
+        self.tokens -= 1
+        if self.dropped:
+            logger.info("(%d lines not logged)", self.dropped)
+            self.dropped = 0
+        logger.info("> %s", line)
@@ -0,0 +1,106 @@
+import asyncio
+import contextlib
+from datetime import datetime
+import logging
+import prometheus_client
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_RUN_PHASE = prometheus_client.Histogram(
+    'run_phase_seconds',
+    "Duration of the phases of runs",
+    ['phase'],
+    buckets=[0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0,
+             float('inf')],
+)
+
+
+# The phases of a run, in the order they usually happen, with descriptions
+PHASES = {
+    'queued': "Queued",
+    'scheduled': "Pod scheduled",
+    'docker': "Docker ready",
+    'container': "Container created",
+    'tools': "Tools copied",
+    'bundle': "RPZ downloaded",
+    'extract': "RPZ extracted",
+    'inputs': "Inputs placed",
+    'run': "Experiment run",
+    'outputs': "Outputs uploaded",
+    'cleanup': "Cleaned up",
+}
+
+
+class PhaseTimer(object):
+    """Times the phases of a run and records them through the connector.
+
+    Phases are sent in the background so they don't slow the run down,
+    ``flush()`` waits until they are all recorded. Without a connector,
+    nothing is recorded.
+    """
+    def __init__(self, connector, run_id):
+        self.connector = connector
+        self.run_id = run_id
+        self._pending = []
+
+    async def _record(self, phase, start, end):
+        try:
+            await self.connector.run_phase(self.run_id, phase, start, end)
+        except Exception:
+            logger.exception("Error recording run phase %s", phase)
+
+    def record(self, phase, start, end=None):
+        """Record a phase that happened between two (UTC) times.
+        """
+        if self.connector is None:
+            return
+        if end is None:
+            end = datetime.utcnow()
+        self._pending = [f for f in self._pending if not f.done()]
+        self._pending.append(asyncio.ensure_future(
+            self._record(phase, start, end),
+        ))
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Time the enclosed code as a phase.
+
+        Failed phases are recorded too, up to when they failed.
+        """
+        start = datetime.utcnow()
+        try:
+            yield
+        finally:
+            self.record(phase, start)
+
+    async def flush(self):
+        pending, self._pending = self._pending, []
+        if pending:
+            await asyncio.gather(*pending)
+
+
+def waterfall(events):
+    """Compute the position of the events of a run on a timeline.
+
+    Returns a list of ``(description, offset, duration, left, width)``, where
+    the last two are percentages of the whole run.
+    """
+    if not events:
+        return []
+    origin = min(event.start for event in events)
+    total = max(event.end for event in events) - origin
+    total = max(total.total_seconds(), 0.001)
+    bars = []
+    for event in events:
+        offset = (event.start - origin).total_seconds()
+        duration = (event.end - event.start).total_seconds()
+        bars.append((
+            PHASES.get(event.phase, event.phase),
+            offset,
+            duration,
+            100.0 * offset / total,
+            max(100.0 * duration / total, 0.2),
+        ))
+    return bars
@@ -0,0 +1,198 @@
+import asyncio
+import collections
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import prometheus_client
+from reprounzip_docker import select_image
+from sqlalchemy import func
+from tornado import httpclient
+
+from .. import database
+from ..utils import background_future
+from .docker_api import _split_image_name
+from .image_cache import MANIFEST_TYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_PREPULLS = prometheus_client.Counter(
+    'image_prepulls_total',
+    "Base images pulled ahead of runs",
+    ['reason'],
+)
+
+
+# How often to pull the most used images
+PREPULL_INTERVAL = 3600
+
+# Runs from that long ago are used to find the most used images
+PREPULL_WINDOW = timedelta(days=7)
+
+# Don't pull the same image again for that long
+PREPULL_MIN_INTERVAL = 600
+
+# Largest layer to fetch into a registry mirror, they are not kept in memory
+MAX_BLOB_SIZE = 100_000_000_000  # 100 GB
+
+
+_prepuller = None
+
+
+def base_image(experiment):
+    """Get the base image that runs of an experiment will use.
+    """
+    return select_image(json.loads(experiment.info)['meta'])[1]
+
+
+def popular_base_images(db, count, *, window=PREPULL_WINDOW):
+    """Get the base images used by the most runs recently.
+    """
+    experiments = (
+        db.query(database.Experiment, func.count(database.Run.id))
+        .join(database.Run)
+        .filter(database.Run.submitted > datetime.utcnow() - window)
+        .group_by(database.Experiment.hash)
+    ).all()
+    images = collections.Counter()
+    for experiment, runs in experiments:
+        try:
+            images[base_image(experiment)] += runs
+        except Exception:
+            logger.exception("Can't get image for %s", experiment.hash)
+    return [image for image, _ in images.most_common(count)]
+
+
+def set_prepuller(prepuller):
+    global _prepuller
+    _prepuller = prepuller
+
+
+def experiment_uploaded(experiment):
+    """Pull the base image of a new upload, if pre-pulling is enabled.
+    """
+    if _prepuller is None:
+        return
+    try:
+        image = base_image(experiment)
+    except Exception:
+        logger.exception("Can't get image for %s", experiment.hash)
+        return
+    background_future(_prepuller.pull(image, 'upload'))
+
+
+class Prepuller(object):
+    """Gets base images ready ahead of runs.
+
+    Images are pulled for new uploads, and the ``count`` base images used the
+    most by recent runs are pulled periodically.
+    """
+    def __init__(self, runner, DBSession, count):
+        self.runner = runner
+        self.DBSession = DBSession
+        self.count = count
+        self._pulling = {}
+        self._last_pulled = {}
+
+    async def pull(self, image, reason):
+        future = self._pulling.get(image)
+        if future is None:
+            last = self._last_pulled.get(image)
+            now = asyncio.get_event_loop().time()
+            if last is not None and last > now - PREPULL_MIN_INTERVAL:
+                return
+            future = self._pulling[image] = asyncio.ensure_future(
+                self._pull(image, reason),
+            )
+            future.add_done_callback(lambda _: self._pulling.pop(image, None))
+        await asyncio.shield(future)
+
+    async def _pull(self, image, reason):
+        logger.info("Pre-pulling image %s (%s)", image, reason)
+        PROM_PREPULLS.labels(reason).inc()
+        try:
+            await self.runner.prepull(image)
+        except Exception:
+            logger.exception("Error pre-pulling image %s", image)
+        else:
+            self._last_pulled[image] = asyncio.get_event_loop().time()
+
+    async def maintain(self):
+        while True:
+            try:
+                with self.DBSession() as db:
+                    images = popular_base_images(db, self.count)
+            except Exception:
+                logger.exception("Error getting popular images")
+                images = []
+            for image in images:
+                await self.pull(image, 'popular')
+            await asyncio.sleep(PREPULL_INTERVAL)
+
+
+def get_prepuller(runner, DBSession):
+    """Get the pre-puller configured by the environment, or None.
+    """
+    if (
+        os.environ.get('RUN_PREPULL', '').lower()
+        not in ('y', 'yes', 'true', 'on', '1')
+    ):
+        return None
+    count = int(os.environ.get('RUN_PREPULL_IMAGES', '') or '5', 10)
+    return Prepuller(runner, DBSession, count)
+
+
+async def warm_mirror(registry, image):
+    """Get an image from Docker Hub into a pull-through registry mirror.
+
+    Fetching the manifest and blobs through the mirror has it cache them, so
+    Docker daemons using it can pull the image from inside the cluster.
+    """
+    name, reference = _split_image_name(image)
+    if '/' not in name:
+        name = 'library/' + name
+    elif '.' in name.split('/', 1)[0] or ':' in name.split('/', 1)[0]:
+        logger.info("Not warming mirror for %s, not on Docker Hub", image)
+        return
+    base_url = 'http://%s/v2/%s' % (registry, name)
+    # The default client rejects bodies over 100 MB, even when streaming them
+    client = httpclient.AsyncHTTPClient(
+        force_instance=True,
+        max_body_size=MAX_BLOB_SIZE,
+    )
+    try:
+        await _warm_mirror(client, base_url, image, reference)
+    finally:
+        client.close()
+
+
+async def _warm_mirror(client, base_url, image, reference):
+    async def get_manifest(reference):
+        response = await client.fetch(
+            base_url + '/manifests/' + reference,
+            headers={'Accept': MANIFEST_TYPES},
+        )
+        return json.loads(response.body.decode('utf-8'))
+
+    manifest = await get_manifest(reference)
+    if 'manifests' in manifest:
+        # Multi-platform image, get the one we run
+        for entry in manifest['manifests']:
+            platform = entry.get('platform', {})
+            if (
+                platform.get('os') == 'linux'
+                and platform.get('architecture') == 'amd64'
+            ):
+                manifest = await get_manifest(entry['digest'])
+                break
+        else:
+            raise ValueError("No linux/amd64 image for %s" % image)
+
+    for blob in [manifest['config']] + manifest['layers']:
+        await client.fetch(
+            base_url + '/blobs/' + blob['digest'],
+            streaming_callback=lambda chunk: None,
+            request_timeout=3600,
+        )
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import prometheus_client
+
+from .docker_api import DockerError
+
+
+logger = logging.getLogger(__name__)
+
+
+_BYTES_BUCKETS = [
+    2 ** 20, 16 * 2 ** 20, 128 * 2 ** 20, 2 ** 30, 4 * 2 ** 30,
+    16 * 2 ** 30, 64 * 2 ** 30, float('inf'),
+]
+
+PROM_RUN_CPU = prometheus_client.Histogram(
+    'run_cpu_seconds',
+    "CPU time used by runs",
+    ['experiment'],
+    buckets=[1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0, 14400.0, float('inf')],
+)
+PROM_RUN_MEMORY_PEAK = prometheus_client.Histogram(
+    'run_memory_peak_bytes',
+    "Peak memory used by runs",
+    ['experiment'],
+    buckets=_BYTES_BUCKETS,
+)
+PROM_RUN_DISK = prometheus_client.Histogram(
+    'run_disk_bytes',
+    "Bytes read and written to disk by runs",
+    ['experiment', 'direction'],
+    buckets=_BYTES_BUCKETS,
+)
+PROM_RUN_NETWORK = prometheus_client.Histogram(
+    'run_network_bytes',
+    "Bytes received and sent over the network by runs",
+    ['experiment', 'direction'],
+    buckets=_BYTES_BUCKETS,
+)
+
+
+# Resources recorded for each run, as stored in the database
+RESOURCE_FIELDS = (
+    'cpu_seconds', 'memory_peak',
+    'disk_read', 'disk_write',
+    'network_rx', 'network_tx',
+)
+
+
+def resource_sample_interval():
+    """Seconds between samples of a run's resource usage, 0 if disabled.
+    """
+    return float(os.environ.get('RUN_RESOURCE_SAMPLE_INTERVAL', '') or '5')
+
+
+def parse_stats(stats):
+    """Get the counters from a sample of the Docker stats API.
+
+    CPU, disk and network are cumulative since the container was created.
+    Memory doesn't count the inactive page cache, like ``docker stats``.
+    """
+    cpu = stats.get('cpu_stats') or {}
+    cpu_ns = (cpu.get('cpu_usage') or {}).get('total_usage', 0)
+
+    memory_stats = stats.get('memory_stats') or {}
+    memory = memory_stats.get('usage', 0)
+    details = memory_stats.get('stats') or {}
+    for key in ('total_inactive_file', 'inactive_file'):
+        if key in details:
+            memory = max(0, memory - details[key])
+            break
+
+    disk_read = disk_write = 0
+    blkio = stats.get('blkio_stats') or {}
+    for entry in blkio.get('io_service_bytes_recursive') or []:
+        op = entry.get('op', '').lower()
+        if op == 'read':
+            disk_read += entry.get('value', 0)
+        elif op == 'write':
+            disk_write += entry.get('value', 0)
+
+    network_rx = network_tx = 0
+    for interface in (stats.get('networks') or {}).values():
+        network_rx += interface.get('rx_bytes', 0)
+        network_tx += interface.get('tx_bytes', 0)
+
+    return {
+        'cpu_ns': cpu_ns,
+        'memory': memory,
+        'disk_read': disk_read,
+        'disk_write': disk_write,
+        'network_rx': network_rx,
+        'network_tx': network_tx,
+    }
+
+
+class ResourceSampler(object):
+    """Samples the resource usage of a container while the run goes on.
+
+    The totals are the difference between the last and the first sample, so
+    setting up the container (e.g. copying inputs) is not counted.
+    """
+    def __init__(self, docker, container, interval):
+        self.docker = docker
+        self.container = container
+        self.interval = interval
+        self.first = None
+        self.last = None
+        self.memory_peak = 0
+        self._task = None
+
+    async def _sample(self):
+        try:
+            stats = await self.docker.container_stats(self.container)
+        except (DockerError, OSError):
+            logger.warning("Error getting container stats", exc_info=True)
+            return
+        counters = parse_stats(stats)
+        # The container might be gone already, in which case all is zero
+        if self.first is not None and counters['cpu_ns'] == 0:
+            return
+        if self.first is None:
+            self.first = counters
+        self.last = counters
+        self.memory_peak = max(self.memory_peak, counters['memory'])
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._sample()
+
+    async def start(self):
+        await self._sample()
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        """Take a last sample and return the usage, or None if unknown.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._sample()
+        if self.first is None:
+            return None
+        first, last = self.first, self.last
+        return {
+            'cpu_seconds': (last['cpu_ns'] - first['cpu_ns']) / 1e9,
+            'memory_peak': self.memory_peak,
+            'disk_read': last['disk_read'] - first['disk_read'],
+            'disk_write': last['disk_write'] - first['disk_write'],
+            'network_rx': last['network_rx'] - first['network_rx'],
+            'network_tx': last['network_tx'] - first['network_tx'],
+        }
+
+
+def observe_usage(experiment_hash, usage):
+    """Export the usage of a run as Prometheus metrics.
+    """
+    PROM_RUN_CPU.labels(experiment_hash).observe(usage['cpu_seconds'])
+    PROM_RUN_MEMORY_PEAK.labels(experiment_hash).observe(usage['memory_peak'])
+    PROM_RUN_DISK.labels(experiment_hash, 'read').observe(usage['disk_read'])
+    PROM_RUN_DISK.labels(experiment_hash, 'write').observe(
+        usage['disk_write'],
+    )
+    PROM_RUN_NETWORK.labels(experiment_hash, 'rx').observe(
+        usage['network_rx'],
+    )
+    PROM_RUN_NETWORK.labels(experiment_hash, 'tx').observe(
+        usage['network_tx'],
+    )
@@ -0,0 +1,91 @@
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import prometheus_client
+
+from .. import database
+
+
+logger = logging.getLogger(__name__)
+
+
+PROM_RESULT_CACHE = prometheus_client.Counter(
+    'run_result_cache_total',
+    "Runs that could reuse the results of an identical run",
+    ['result'],
+)
+PROM_RESULT_CACHE.labels('hit').inc(0)
+PROM_RESULT_CACHE.labels('miss').inc(0)
+
+
+def result_cache_enabled():
+    return os.environ.get('RUN_RESULT_CACHE', '').lower() in (
+        'y', 'yes', 'true', 'on', '1',
+    )
+
+
+def compute_cache_key(experiment, parameter_values, input_files):
+    """Compute a key identifying everything that goes into a run.
+
+    Parameters are normalized by filling in the defaults, so that a run which
+    explicitly sets a parameter to its default value gets the same key as a
+    run which left it unset.
+    """
+    params = {param.name: param.default for param in experiment.parameters}
+    for param in parameter_values:
+        params[param.name] = param.value
+    key = {
+        'experiment': experiment.hash,
+        'parameters': sorted(params.items()),
+        'inputs': sorted(
+            (input_file.name, input_file.hash)
+            for input_file in input_files
+        ),
+    }
+    key = json.dumps(key, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def find_cached_run(db, cache_key):
+    """Find the latest successful run with the given key.
+
+    Failed runs have their key cleared, so any completed run with a key
+    succeeded.
+    """
+    return (
+        db.query(database.Run)
+        .filter(database.Run.cache_key == cache_key)
+        .filter(database.Run.done != None)  # noqa: E711
+        .order_by(database.Run.done.desc())
+        .first()
+    )
+
+
+def reuse_results(run, cached_run):
+    """Complete a run by copying the log and output files of an identical one.
+
+    Output files are stored by hash, so this doesn't copy any data.
+    """
+    for line in cached_run.log:
+        run.log.append(database.RunLogLine(
+            timestamp=line.timestamp,
+            line=line.line,
+        ))
+    run.log.append(database.RunLogLine(
+        line="Results reused from identical run %s" % cached_run.short_id,
+    ))
+    for output_file in cached_run.output_files:
+        run.output_files.append(database.OutputFile(
+            hash=output_file.hash,
+            name=output_file.name,
+            size=output_file.size,
+        ))
+
+    now = datetime.utcnow()
+    run.reused_run_id = cached_run.id
+    run.started = now
+    run.done = now
+    run.succeeded = True
+    run.progress_percent = 100
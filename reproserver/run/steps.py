@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import prometheus_client
+
+
+PROM_STEP_SNAPSHOTS = prometheus_client.Counter(
+    'run_step_snapshots_total',
+    "Lookups of snapshots of the container after the steps of a run",
+    ['result'],
+)
+PROM_STEPS_SKIPPED = prometheus_client.Counter(
+    'run_steps_skipped_total',
+    "Steps not run because a snapshot of their results was available",
+)
+
+
+# Repository of the step snapshots, in the local Docker daemon
+STEP_SNAPSHOT_REPO = 'reproserver-step'
+
+# Label set on step snapshots, to the experiment hash
+STEP_SNAPSHOT_LABEL = 'reproserver.step-snapshot'
+
+
+def step_snapshots_size():
+    """Number of step snapshots to keep locally, 0 if disabled.
+    """
+    return int(os.environ.get('RUN_STEP_SNAPSHOTS', '') or '0', 10)
+
+
+def run_steps(run_info):
+    """Get the command-line of each step of the run, in order.
+    """
+    return [
+        cmd
+        for _, cmd in sorted(
+            (int(k[8:], 10), cmd)
+            for k, cmd in run_info['parameters'].items()
+            if k.startswith('cmdline_')
+        )
+    ]
+
+
+def step_snapshot_keys(run_info, tools_version):
+    """Compute the key of the container's state after each step.
+
+    The key after step ``i`` covers everything that went into it: the
+    experiment, the command-lines of steps up to ``i``, and the input files.
+    All the inputs are placed before the first step, so they are all in every
+    snapshot, even those only read by later steps.
+    """
+    steps = run_steps(run_info)
+    inputs = sorted(
+        [input_file['name'], input_file['hash']]
+        for input_file in run_info['inputs']
+    )
+    keys = []
+    for i in range(len(steps)):
+        state = {
+            'experiment': run_info['experiment_hash'],
+            'tools': tools_version,
+            'steps': steps[:i + 1],
+            'inputs': inputs,
+        }
+        keys.append(hashlib.sha256(
+            json.dumps(state, sort_keys=True).encode('utf-8'),
+        ).hexdigest())
+    return keys
+
+
+def step_snapshot_name(key):
+    return '%s:%s' % (STEP_SNAPSHOT_REPO, key[:40])
@@ -0,0 +1,60 @@
+import hashlib
+import itertools
+import json
+import os
+import prometheus_client
+
+
+PROM_SWEEP_SETUPS = prometheus_client.Counter(
+    'sweep_setups_total',
+    "Container setups for runs of sweeps, shared or not",
+    ['result'],
+)
+
+
+# Repository of the images of prepared containers, in the local Docker daemon
+SWEEP_IMAGE_REPO = 'reproserver-sweep'
+
+# Label set on the images of prepared containers, to the sweep ID
+SWEEP_LABEL = 'reproserver.sweep'
+
+# Number of images of prepared containers to keep locally
+SWEEP_LOCAL_IMAGES = 3
+
+
+def sweep_max_runs():
+    """Maximum number of runs in a sweep.
+    """
+    return int(os.environ.get('SWEEP_MAX_RUNS', '') or '20', 10)
+
+
+def expand_sweep(values):
+    """Get every combination of parameter values.
+
+    ``values`` maps each parameter name to the list of its values.
+    """
+    names = sorted(values)
+    return [
+        dict(zip(names, combination))
+        for combination in itertools.product(*[values[n] for n in names])
+    ]
+
+
+def sweep_image_name(run_info, tools_version):
+    """Name of the image of a prepared container for the runs of a sweep.
+
+    This covers the experiment, the tools, and the input files, which are the
+    same for every run of a sweep anyway.
+    """
+    key = {
+        'experiment': run_info['experiment_hash'],
+        'tools': tools_version,
+        'inputs': sorted(
+            (input_file['name'], input_file['hash'])
+            for input_file in run_info['inputs']
+        ),
+    }
+    key = hashlib.sha256(
+        json.dumps(key, sort_keys=True).encode('utf-8'),
+    ).hexdigest()
+    return '%s:%d-%s' % (SWEEP_IMAGE_REPO, run_info['sweep_id'], key[:20])
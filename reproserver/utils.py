@@ -149,6 +149,8 @@ def background_future(future, *, should_never_exit=False):
         # Call result to avoid warnings
         try:
             f.result()
+        except asyncio.CancelledError:
+            logger.info("Background task cancelled")
         except Exception:
             logger.exception("Error in background task")
         if should_never_exit:
@@ -31,6 +31,7 @@ def make_app(debug=False, xsrf_cookies=True, proxy=None):
             URLSpec('/results/([^/]+)', views.Results, name='results'),
             URLSpec('/results/([^/]+)/json', views.ResultsJson,
                     name='results_json'),
+            URLSpec('/sweep/([^/]+)', views.SweepResults, name='sweep'),
             URLSpec('/web/([^/]+)', webcapture.Index,
                     name='webcapture_index'),
             URLSpec('/web/([^/]+)/preview', webcapture.Preview,
@@ -60,6 +61,10 @@ def make_app(debug=False, xsrf_cookies=True, proxy=None):
             URLSpec('/runners/run/([^/]+)/set-progress', api.RunSetProgress),
             URLSpec('/runners/run/([^/]+)/done', api.RunDone),
             URLSpec('/runners/run/([^/]+)/failed', api.RunFailed),
+            URLSpec('/runners/run/([^/]+)/phase', api.RunPhase),
+            URLSpec('/runners/run/([^/]+)/resources', api.RunResources),
+            URLSpec('/runners/run/([^/]+)/cancel', api.RunCancel),
+            URLSpec('/runners/run/([^/]+)/wake', api.RunWake),
             URLSpec('/runners/run/([^/]+)/output/(.+)', api.UploadOutput),
             URLSpec('/runners/run/([^/]+)/log', api.Log),
         ] + proxy,
@@ -8,7 +8,8 @@ from tornado.web import HTTPError, stream_request_body
 
 from .base import BaseHandler
 from .. import database
-from ..run.connector import DirectConnector
+from ..run.connector import MAX_FILE_SIZE, DirectConnector
+from ..run.resources import RESOURCE_FIELDS
 
 
 logger = logging.getLogger(__name__)
@@ -110,26 +111,172 @@ class RunFailed(BaseApiHandler):
         await self.connector.run_failed(run_id, error)
 
 
+class RunPhase(BaseApiHandler):
+    @parse_run_id
+    async def post(self, run_id):
+        body = self.get_json()
+        try:
+            phase = body['phase']
+            if not isinstance(phase, str) or not 0 < len(phase) <= 32:
+                raise ValueError
+            start = datetime.fromisoformat(body['start'])
+            end = datetime.fromisoformat(body['end'])
+        except (KeyError, TypeError, ValueError):
+            return await self.send_error_json(
+                400,
+                "Expected JSON object with 'phase', 'start' and 'end' keys",
+            )
+
+        await self.connector.run_phase(run_id, phase, start, end)
+
+
+class RunResources(BaseApiHandler):
+    @parse_run_id
+    async def post(self, run_id):
+        body = self.get_json()
+        if (
+            not isinstance(body, dict)
+            or not all(
+                isinstance(body.get(field), (int, float))
+                for field in RESOURCE_FIELDS
+            )
+        ):
+            return await self.send_error_json(
+                400,
+                "Expected JSON object with keys %s" % (
+                    ", ".join(RESOURCE_FIELDS)
+                ),
+            )
+
+        await self.connector.run_resources(run_id, body)
+
+
+class RunCancel(BaseApiHandler):
+    @parse_run_id
+    async def post(self, run_id):
+        run = self.db.query(database.Run).get(run_id)
+        if run is None:
+            return await self.send_error_json(404, "No such run")
+        if run.done is not None:
+            return await self.send_error_json(409, "Run is already done")
+
+        await self.application.runner.cancel(run_id)
+        self.set_status(204)
+        return await self.finish()
+
+
+class RunWake(BaseApiHandler):
+    @parse_run_id
+    async def post(self, run_id):
+        run = self.db.query(database.Run).get(run_id)
+        if run is None:
+            return await self.send_error_json(404, "No such run")
+
+        if (
+            not await self.application.runner.wake(run_id)
+            and run.done is not None
+        ):
+            return await self.send_error_json(409, "Run is not sleeping")
+
+        # Run is starting, or was already running
+        self.set_status(202)
+        return await self.finish()
+
+
 @stream_request_body
 class UploadOutput(BaseApiHandler):
-    # FIXME: Round-trip to disk to compute hash, not ideal
+    """Receive an output file.
+
+    If the size is known upfront, the file is streamed to the object store as
+    it is received, without going through the disk. Otherwise, it is hashed
+    into a temporary file first.
+    """
     def prepare(self):
-        self.temp_file = tempfile.NamedTemporaryFile()
-        self.hasher = hashlib.sha256()
+        super(UploadOutput, self).prepare()
+        self.request.connection.set_max_body_size(MAX_FILE_SIZE)
 
-    def on_finish(self):
-        self.temp_file.close()
         self.temp_file = None
+        self.queue = None
+        self.upload = None
+        size = self.request.headers.get('Content-Length')
+        if size is not None:
+            try:
+                run_id = int(self.path_args[0])
+            except (ValueError, OverflowError):
+                raise HTTPError(400)
+            output_name = self.path_args[1]
+            self.queue = asyncio.Queue(maxsize=4)
+            self.upload = asyncio.ensure_future(
+                self.connector.upload_output_stream(
+                    run_id, output_name, int(size, 10), self._read_queue(),
+                ),
+            )
+        else:
+            self.temp_file = tempfile.NamedTemporaryFile()
+            self.hasher = hashlib.sha256()
+
+    async def _read_queue(self):
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None:
+                break
+            yield chunk
+
+    def on_finish(self):
+        if self.temp_file is not None:
+            self.temp_file.close()
+            self.temp_file = None
+
+    def on_connection_close(self):
+        if self.upload is not None:
+            self.upload.cancel()
+
+    async def _queue_put(self, chunk):
+        if self._finished:
+            # Already failed, drop the rest of the body
+            return
+        # Don't wait on the queue forever if the upload stopped reading it
+        if not self.upload.done():
+            put = asyncio.ensure_future(self.queue.put(chunk))
+            await asyncio.wait(
+                [put, self.upload],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if put.done():
+                return
+            put.cancel()
+
+        # Reply now, the connection gets closed without reading the rest
+        if self.upload.cancelled():
+            logger.error("Output upload cancelled")
+        elif self.upload.exception() is not None:
+            logger.error(
+                "Error uploading output",
+                exc_info=self.upload.exception(),
+            )
+        else:
+            logger.error("Output upload stopped reading")
+        self.send_error(500)
 
     def data_received(self, chunk):
+        if self.queue is not None:
+            return self._queue_put(chunk)
         self.temp_file.write(chunk)
         self.hasher.update(chunk)
 
     @parse_run_id
-    def put(self, run_id, output_name):
+    async def put(self, run_id, output_name):
+        if self.upload is not None:
+            await self._queue_put(None)
+            if self._finished:
+                return
+            await self.upload
+            self.set_status(204)
+            return await self.finish()
+
         self.temp_file.flush()
 
-        return asyncio.get_event_loop().run_in_executor(
+        await asyncio.get_event_loop().run_in_executor(
             None,
             lambda: self.connector.upload_output_file_blocking(
                 run_id,
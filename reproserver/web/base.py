@@ -20,6 +20,10 @@ from .. import __version__
 from .. import database
 from ..objectstore import get_object_store
 from ..run.connector import DirectConnector
+from ..run.image_cache import image_cache_evictor, image_cache_registry, \
+    image_cache_size
+from ..run.prepull import get_prepuller, set_prepuller
+from ..utils import background_future
 
 
 logger = logging.getLogger(__name__)
@@ -91,6 +95,32 @@ class Application(GracefulApplication):
             ),
         )
 
+        background_future(
+            self.runner.orphan_sweeper(),
+            should_never_exit=True,
+        )
+
+        idle_timeout = os.environ.get('RUN_IDLE_TIMEOUT', '')
+        if idle_timeout:
+            background_future(
+                self.runner.idle_reaper(int(idle_timeout, 10)),
+                should_never_exit=True,
+            )
+
+        prepuller = get_prepuller(self.runner, self.DBSession)
+        if prepuller is not None:
+            set_prepuller(prepuller)
+            background_future(prepuller.maintain(), should_never_exit=True)
+
+        image_cache = image_cache_registry()
+        if image_cache is not None:
+            background_future(
+                image_cache_evictor(
+                    self.DBSession, image_cache, image_cache_size(),
+                ),
+                should_never_exit=True,
+            )
+
     def log_request(self, handler):
         if handler.request.path == '/health':
             return
@@ -150,6 +180,19 @@ class BaseHandler(HideStreamClosedHandler):
         return f"{num:.1f} Y{suffix}"
     template_env.filters['human_size'] = _tpl_human_size
 
+    @jinja2.pass_context
+    def _tpl_human_duration(context, seconds):
+        seconds = int(seconds)
+        if seconds < 60:
+            return "less than a minute"
+        elif seconds < 3600:
+            minutes = round(seconds / 60)
+            return "%d minute%s" % (minutes, 's' if minutes > 1 else '')
+        else:
+            hours = seconds / 3600
+            return f"{hours:.1f} hours"
+    template_env.filters['human_duration'] = _tpl_human_duration
+
     def __init__(self, application, request, **kwargs):
         super(BaseHandler, self).__init__(application, request, **kwargs)
         self.db = application.DBSession()
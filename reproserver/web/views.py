@@ -15,6 +15,13 @@ from ..repositories import RepositoryError, RepositoryUnknown, \
     get_from_link, get_experiment_from_repository, get_repository_name, \
     get_repository_page_url, parse_repository_url
 from .. import rpz_metadata
+from ..run.base import get_run_timeout
+from ..run.duration import predict_duration
+from ..run.phases import waterfall
+from ..run.prepull import experiment_uploaded
+from ..run.result_cache import PROM_RESULT_CACHE, compute_cache_key, \
+    find_cached_run, result_cache_enabled, reuse_results
+from ..run.sweeps import expand_sweep, sweep_max_runs
 from ..utils import PromMeasureRequest, background_future
 from .base import BaseHandler, HashedFileTarget, StreamedRequestHandler
 
@@ -93,6 +100,9 @@ async def store_uploaded_rpz(
     db.add(upload)
     db.commit()
 
+    # Get its base image ready
+    experiment_uploaded(experiment)
+
     return upload.short_id
 
 
@@ -262,6 +272,8 @@ class BaseReproduce(BaseHandler):
             experiment_url=experiment_url,
             repo_name=repo_name, repo_url=repo_url,
             expose_ports=' '.join(str(port) for port in sorted(ports)),
+            max_timeout=get_run_timeout() // 60,
+            result_cache=result_cache_enabled(),
         )
 
 
@@ -333,6 +345,28 @@ class ReproduceLocal(BaseReproduce):
         return self.reproduce(upload)
 
 
+def find_stored_file(db, filehash):
+    """Find a file we have, from the inputs or outputs of runs.
+
+    Returns the bucket it's in and its size, or None.
+    """
+    input_file = (
+        db.query(database.InputFile)
+        .filter(database.InputFile.hash == filehash)
+        .first()
+    )
+    if input_file is not None:
+        return input_file.bucket, input_file.size
+    output_file = (
+        db.query(database.OutputFile)
+        .filter(database.OutputFile.hash == filehash)
+        .first()
+    )
+    if output_file is not None:
+        return 'outputs', output_file.size
+    return None
+
+
 class StartRun(BaseHandler):
     @PROM_REQUESTS.async_('start_run')
     async def post(self, upload_short_id):
@@ -362,12 +396,6 @@ class StartRun(BaseHandler):
         upload.last_access = datetime.utcnow()
         upload.experiment.last_access = datetime.utcnow()
 
-        # New run entry
-        run = database.Run(experiment_hash=experiment.hash,
-                           upload_id=upload_id,
-                           submitted_ip=self.request.remote_ip)
-        self.db.add(run)
-
         # Get list of parameters
         params = set()
         params_unset = set()
@@ -376,7 +404,10 @@ class StartRun(BaseHandler):
                 params_unset.add(param.name)
             params.add(param.name)
 
-        # Get run parameters
+        # Get run parameters. A list of values for a parameter (one per line
+        # in its sweep_ field) makes a sweep, with a run per combination
+        values = {}
+        sweep_values = {}
         for k, v in self.request.body_arguments.items():
             if k.startswith('param_'):
                 if not v:
@@ -384,16 +415,33 @@ class StartRun(BaseHandler):
                 name = k[6:]
                 if name not in params:
                     raise ValueError("Unknown parameter %s" % k)
-                v = v[-1].decode('utf-8')
-                run.parameter_values.append(
-                    database.ParameterValue(name=name, value=v)
-                )
+                values[name] = [v[-1].decode('utf-8')]
                 params_unset.discard(name)
+            elif k.startswith('sweep_'):
+                if not v:
+                    continue
+                name = k[6:]
+                if name not in params:
+                    raise ValueError("Unknown parameter %s" % k)
+                lines = [
+                    line for line in v[-1].decode('utf-8').splitlines()
+                    if line.strip()
+                ]
+                if lines:
+                    sweep_values[name] = lines
+                    params_unset.discard(name)
+        values.update(sweep_values)
 
         if params_unset:
             raise ValueError("Missing value for parameters: %s" %
                              ", ".join(params_unset))
 
+        combinations = expand_sweep(values)
+        if len(combinations) > sweep_max_runs():
+            raise ValueError("Too many runs in sweep (%d, limit is %d)" % (
+                len(combinations), sweep_max_runs(),
+            ))
+
         # Get list of input files
         input_files = set(
             p.name for p in (
@@ -403,6 +451,7 @@ class StartRun(BaseHandler):
             ).all())
 
         # Get input files
+        inputs = []
         for k, uploaded_file in self.request.files.items():
             if not uploaded_file:
                 continue
@@ -427,14 +476,35 @@ class StartRun(BaseHandler):
             )
             logger.info("Inserted file in storage")
 
-            # Insert it in database
-            input_file = database.InputFile(
-                hash=inputfilehash, name=name,
-                size=len(uploaded_file.body),
+            inputs.append(
+                (name, inputfilehash, len(uploaded_file.body), 'inputs'),
             )
-            run.input_files.append(input_file)
+
+        # Get input files given by hash, using a file we already have (the
+        # input or output of another run) without transferring it
+        for k, v in self.request.body_arguments.items():
+            if not k.startswith('inputhash_') or not v:
+                continue
+            filehash = v[-1].decode('utf-8').strip().lower()
+            if not filehash:
+                continue
+
+            name = k[10:]
+            if name not in input_files:
+                raise ValueError("Unknown input file %s" % k)
+            if any(name == input_name for input_name, *_ in inputs):
+                raise ValueError("Got both a file and a hash for input %s" %
+                                 name)
+
+            stored = find_stored_file(self.db, filehash)
+            if stored is None:
+                raise ValueError("No file with hash %s" % filehash)
+            bucket, size = stored
+            logger.info("Using stored file %s for input %s", filehash, name)
+            inputs.append((name, filehash, size, bucket))
 
         # Get ports to expose
+        ports = []
         for port_str in self.get_body_argument('ports', '').split():
             port_str = port_str.strip()
             if port_str:
@@ -444,21 +514,135 @@ class StartRun(BaseHandler):
                         raise ValueError
                 except (ValueError, OverflowError):
                     raise ValueError("Invalid port number %r" % port_str)
-                run.ports.append(database.RunPort(
-                    port_number=port,
-                ))
+                ports.append(port)
+        if ports and sweep_values:
+            raise ValueError("Can't expose ports from the runs of a sweep")
 
-        # Trigger run
+        # Get time limit
+        timeout = self.get_body_argument('timeout', '').strip()
+        if timeout:
+            try:
+                timeout = int(timeout, 10)
+                if timeout <= 0:
+                    raise ValueError
+            except (ValueError, OverflowError):
+                raise ValueError("Invalid time limit %r" % timeout)
+
+        sweep = None
+        if sweep_values:
+            sweep = database.Sweep(experiment_hash=experiment.hash,
+                                   upload_id=upload_id)
+            self.db.add(sweep)
+
+        runs = []
+        for combination in combinations:
+            # New run entry
+            run = database.Run(experiment_hash=experiment.hash,
+                               upload_id=upload_id,
+                               submitted_ip=self.request.remote_ip,
+                               sweep=sweep)
+            self.db.add(run)
+            runs.append(run)
+
+            for name, value in sorted(combination.items()):
+                run.parameter_values.append(
+                    database.ParameterValue(name=name, value=value)
+                )
+            for name, inputfilehash, size, bucket in inputs:
+                run.input_files.append(database.InputFile(
+                    hash=inputfilehash, name=name, size=size, bucket=bucket,
+                ))
+            for port in ports:
+                run.ports.append(database.RunPort(port_number=port))
+            if timeout:
+                run.timeout = timeout * 60
+
+            # Reuse the results of an identical run if possible. Runs with
+            # ports are interactive, users want them to actually run
+            if result_cache_enabled() and not run.ports:
+                run.cache_key = compute_cache_key(
+                    experiment,
+                    run.parameter_values,
+                    run.input_files,
+                )
+                if not self.get_body_argument('rerun', ''):
+                    cached_run = find_cached_run(self.db, run.cache_key)
+                    if cached_run is not None:
+                        logger.info(
+                            "Reusing results of run %d", cached_run.id,
+                        )
+                        PROM_RESULT_CACHE.labels('hit').inc()
+                        reuse_results(run, cached_run)
+                        run.cache_key = None
+                    else:
+                        PROM_RESULT_CACHE.labels('miss').inc()
+
+        # Trigger runs
         self.db.commit()
-        background_future(self.application.runner.run(run.id))
+        for run in runs:
+            if run.done is None:
+                background_future(self.application.runner.run(run.id))
 
         # Redirect to results page
+        if sweep is not None:
+            return self.redirect(
+                self.reverse_url('sweep', sweep.short_id),
+                status=303,
+            )
         return self.redirect(
-            self.reverse_url('results', run.short_id),
+            self.reverse_url('results', runs[0].short_id),
             status=303,
         )
 
 
+class SweepResults(BaseHandler):
+    @PROM_REQUESTS.sync('sweep')
+    def get(self, sweep_short_id):
+        """Shows the runs of a sweep, with links to their results.
+        """
+        # Decode info from URL
+        try:
+            sweep_id = database.Sweep.decode_id(sweep_short_id)
+        except ValueError:
+            self.set_status(404)
+            return self.render('results_notfound.html')
+
+        # Look up the sweep in the database
+        sweep = (
+            self.db.query(database.Sweep)
+            .options(
+                joinedload(database.Sweep.upload),
+                joinedload(database.Sweep.runs).joinedload(
+                    database.Run.parameter_values,
+                ),
+            )
+        ).get(sweep_id)
+        if sweep is None:
+            self.set_status(404)
+            return self.render('results_notfound.html')
+
+        # Show the parameters that vary
+        values = {}
+        for run in sweep.runs:
+            for param in run.parameter_values:
+                values.setdefault(param.name, set()).add(param.value)
+        swept = sorted(name for name, v in values.items() if len(v) > 1)
+
+        def param_value(run, name):
+            for param in run.parameter_values:
+                if param.name == name:
+                    return param.value
+            return None
+
+        return self.render(
+            'sweep.html',
+            sweep=sweep,
+            swept=swept,
+            param_value=param_value,
+            experiment_url=self.url_for_upload(sweep.upload),
+        )
+
+
 class Results(BaseHandler):
     @PROM_REQUESTS.sync('results')
     def get(self, run_short_id):
@@ -482,6 +666,7 @@ class Results(BaseHandler):
                 joinedload(database.Run.parameter_values),
                 joinedload(database.Run.input_files),
                 joinedload(database.Run.output_files),
+                joinedload(database.Run.events),
             )
         ).get(run_id)
         if run is None:
@@ -520,6 +705,19 @@ class Results(BaseHandler):
                 mime,
             )
 
+        log_archive = run.log_archive
+        if log_archive is None:
+            log_archive_link = None
+        else:
+            log_archive_link = (
+                self.application.object_store.presigned_serve_url(
+                    'outputs',
+                    log_archive.hash,
+                    'log-%s.txt.gz' % run_short_id,
+                    'application/gzip',
+                )
+            )
+
         wacz_hash = self.get_query_argument('wacz', None)
         if wacz_hash is None and 'web1' in extensions:
             wacz_hash = extensions['web1']['filehash']
@@ -551,6 +749,11 @@ class Results(BaseHandler):
         web_coll = '%d|%s' % (run.id, web_hostname)
         web_coll = sha256(web_coll.encode('utf-8')).hexdigest()
 
+        if run.done:
+            expected_duration = None
+        else:
+            expected_duration = predict_duration(self.db, run.experiment_hash)
+
         return self.render(
             'results.html',
             run=run,
@@ -558,12 +761,27 @@ class Results(BaseHandler):
             experiment_url=self.url_for_upload(run.upload),
             get_port_url=get_port_url,
             output_link=output_link,
+            log_archive_link=log_archive_link,
             wacz=wacz,
             web_hostname=web_hostname,
             web_coll=web_coll,
+            expected_duration=expected_duration,
+            eta=estimated_remaining(run, expected_duration),
+            waterfall=waterfall(run.events),
         )
 
 
+def estimated_remaining(run, expected_duration):
+    """Estimate how many seconds are left before a run completes.
+    """
+    if run.done or expected_duration is None:
+        return None
+    if not run.started:
+        return expected_duration
+    elapsed = (datetime.utcnow() - run.started).total_seconds()
+    return max(expected_duration - elapsed, 0)
+
+
 class ResultsJson(BaseHandler):
     @PROM_REQUESTS.sync('results-json')
     def get(self, run_short_id):
@@ -598,6 +816,14 @@ class ResultsJson(BaseHandler):
                 progress_percent = 40
                 progress_text = "Starting"
 
+        if run.done:
+            eta = None
+        else:
+            eta = estimated_remaining(
+                run,
+                predict_duration(self.db, run.experiment_hash),
+            )
+
         log_from = int(self.get_query_argument('log_from', '0'), 10)
         return self.send_json({
             'started': bool(run.started),
@@ -605,6 +831,19 @@ class ResultsJson(BaseHandler):
             'log': run.get_log(log_from),
             'progress_percent': progress_percent,
             'progress_text': progress_text,
+            'eta': eta,
+            # The hashes can be used to give those files to other runs
+            'output_files': [
+                {'name': f.name, 'hash': f.hash, 'size': f.size}
+                for f in run.experiment_output_files
+            ],
+            'log_archive': (
+                None if run.log_archive is None
+                else {
+                    'hash': run.log_archive.hash,
+                    'size': run.log_archive.size,
+                }
+            ),
         })
 
 
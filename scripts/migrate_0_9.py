@@ -0,0 +1,90 @@
+import logging
+from sqlalchemy import text
+
+from reproserver import database
+from reproserver.database import LOG_ARCHIVE_NAME
+
+
+# Columns added to existing tables, as (table, column, SQL type)
+NEW_COLUMNS = [
+    ('runs', 'timeout', 'INTEGER'),
+    ('runs', 'last_activity', 'TIMESTAMP WITHOUT TIME ZONE'),
+    ('runs', 'sleeping', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('runs', 'cache_key', 'VARCHAR(64)'),
+    ('runs', 'reused_run_id',
+     'INTEGER REFERENCES runs (id) ON DELETE SET NULL'),
+    ('runs', 'sweep_id',
+     'INTEGER REFERENCES sweeps (id) ON DELETE SET NULL'),
+    ('runs', 'cpu_seconds', 'DOUBLE PRECISION'),
+    ('runs', 'memory_peak', 'BIGINT'),
+    ('runs', 'disk_read', 'BIGINT'),
+    ('runs', 'disk_write', 'BIGINT'),
+    ('runs', 'network_rx', 'BIGINT'),
+    ('runs', 'network_tx', 'BIGINT'),
+    ('runs', 'succeeded', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('input_files', 'bucket', "VARCHAR(16) NOT NULL DEFAULT 'inputs'"),
+]
+
+# Indexes on new columns, as (name, table, column)
+NEW_INDEXES = [
+    ('ix_runs_cache_key', 'runs', 'cache_key'),
+]
+
+# Values for new columns on existing rows, as (description, SQL)
+BACKFILLS = [
+    # Runs that completed before the flag existed succeeded if they kept
+    # their cache key (failures clear it), reused results, or uploaded
+    # outputs (only done once the experiment exited with status 0)
+    (
+        "successful runs",
+        text(
+            'UPDATE runs SET succeeded = TRUE'
+            ' WHERE done IS NOT NULL AND NOT succeeded AND ('
+            '  cache_key IS NOT NULL'
+            '  OR reused_run_id IS NOT NULL'
+            '  OR EXISTS ('
+            '   SELECT 1 FROM output_files'
+            '   WHERE output_files.run_id = runs.id'
+            '   AND output_files.name != :log_archive'
+            '  )'
+            ' )'
+        ).bindparams(log_archive=LOG_ARCHIVE_NAME),
+    ),
+]
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+    DBSession = database.connect()
+    db = DBSession()
+
+    # Create new tables
+    database.Base.metadata.create_all(bind=db.get_bind())
+
+    # Add new columns
+    for table, column, type_ in NEW_COLUMNS:
+        logging.info("Adding column %s.%s", table, column)
+        db.execute(text(
+            f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {type_}'
+        ))
+
+    # Add new indexes
+    for name, table, column in NEW_INDEXES:
+        logging.info("Adding index %s", name)
+        db.execute(text(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})'
+        ))
+
+    # Fill new columns
+    for description, statement in BACKFILLS:
+        logging.info("Backfilling %s", description)
+        db.execute(statement)
+    db.commit()
+
+
+if __name__ == '__main__':
+    main()
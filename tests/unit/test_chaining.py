@@ -0,0 +1,58 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.web.views import find_stored_file
+
+
+class FakeObjectStore(object):
+    def presigned_internal_url(self, bucket, objectname):
+        return 'http://objects/%s/%s' % (bucket, objectname)
+
+
+class TestChaining(AsyncTestCase):
+    @gen_test
+    async def test_output_as_input(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        experiment = database.Experiment(hash='exp', size=1, info='{}')
+        experiment.paths.append(database.Path(
+            is_input=True, is_output=True, name='data', path='/data',
+        ))
+        db.add(experiment)
+        first = database.Run(experiment_hash='exp')
+        first.input_files.append(database.InputFile(
+            name='data', hash='aaaa', size=3,
+        ))
+        first.output_files.append(database.OutputFile(
+            name='data', hash='bbbb', size=5,
+        ))
+        db.add(first)
+        db.commit()
+
+        # Files are found by hash, wherever they are
+        self.assertEqual(find_stored_file(db, 'aaaa'), ('inputs', 3))
+        self.assertEqual(find_stored_file(db, 'bbbb'), ('outputs', 5))
+        self.assertIsNone(find_stored_file(db, 'cccc'))
+
+        # The runner downloads it from where it is
+        second = database.Run(experiment_hash='exp')
+        second.input_files.append(database.InputFile(
+            name='data', hash='bbbb', size=5, bucket='outputs',
+        ))
+        db.add(second)
+        db.commit()
+        connector = DirectConnector(
+            DBSession=DBSession,
+            object_store=FakeObjectStore(),
+        )
+        run_info = await connector.init_run_get_info(second.id)
+        run_info = connector.get_input_links(run_info)
+        self.assertEqual(
+            [(i['name'], i['link']) for i in run_info['inputs']],
+            [('data', 'http://objects/outputs/bbbb')],
+        )
@@ -0,0 +1,98 @@
+import asyncio
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.run.docker import DockerRunner
+from reproserver.run.docker_api import DockerError
+
+
+class FakeDocker(object):
+    def __init__(self, containers):
+        self.containers = containers
+        self.removed = []
+
+    async def list_containers(self, *, name='', size=False):
+        return [
+            {'Id': 'id_' + c, 'Names': ['/' + c], 'SizeRw': 100}
+            for c in self.containers
+            if name in c
+        ]
+
+    async def remove_container(self, container):
+        await asyncio.sleep(0.01)
+        if container.startswith('id_'):
+            container = container[3:]
+        if container not in self.containers:
+            raise DockerError(404, "No such container")
+        self.containers.remove(container)
+        self.removed.append(container)
+
+
+class TestCleanup(AsyncTestCase):
+    def setUp(self):
+        super(TestCleanup, self).setUp()
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        self.DBSession = sessionmaker(bind=engine)
+        db = self.DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        runs = [database.Run(experiment_hash='exp') for _ in range(3)]
+        runs[0].done = datetime(2020, 1, 1)
+        db.add_all(runs)
+        db.commit()
+        self.run_ids = [run.id for run in runs]
+        self.runner = DockerRunner(DirectConnector(
+            DBSession=self.DBSession,
+            object_store=None,
+        ))
+        self.runner.docker.close()
+
+    @gen_test
+    async def test_sweep(self):
+        done, active, running = self.run_ids
+        self.runner.docker = FakeDocker([
+            'run_%d' % done, 'run_%d' % active, 'run_%d' % running,
+            'run_9999', 'pool_1234', 'run_other',
+        ])
+        self.runner.tasks[running] = None
+
+        # Done and unknown runs get removed
+        await self.runner.sweep_orphans()
+        self.assertEqual(
+            sorted(self.runner.docker.removed),
+            sorted(['run_%d' % done, 'run_9999']),
+        )
+
+    @gen_test
+    async def test_background_removal(self):
+        docker = self.runner.docker = FakeDocker(['run_1'])
+
+        self.runner._remove_later('run_1')
+        self.assertIn('run_1', self.runner._removing)
+        # The name can be reused once removal is done
+        await self.runner._wait_removed('run_1')
+        self.assertEqual(docker.removed, ['run_1'])
+        self.assertEqual(self.runner._removing, {})
+
+        # Cancelling waits for the removal, then ignores the missing container
+        docker.containers.append('run_1')
+        self.runner._remove_later('run_1')
+        await self.runner.cancel_inner(1)
+        self.assertEqual(docker.removed, ['run_1', 'run_1'])
+
+    @gen_test
+    async def test_leftovers(self):
+        docker = self.runner.docker = FakeDocker(['run_1', 'pool_2'])
+
+        # Runner pods remove every container left in their image store
+        await self.runner.remove_leftover_containers()
+        self.assertEqual(sorted(docker.removed), ['pool_2', 'run_1'])
+
+        docker.containers.append('run_3')
+        self.runner._remove_later('run_3')
+        await self.runner.wait_removals()
+        self.assertEqual(docker.containers, [])
@@ -0,0 +1,354 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+from tornado.testing import AsyncTestCase, gen_test
+from unittest.mock import patch
+from urllib.parse import parse_qs, unquote, urlparse
+
+from reproserver.run import docker
+from reproserver.run.docker import DockerRunner, tar_stream
+from reproserver.run.docker_api import DockerClient, DockerError
+
+
+class FakeDocker(object):
+    """Just enough of the Docker Engine API, over a unix socket.
+    """
+    def __init__(self):
+        self.connections = 0
+        self.images = {}
+        self.containers = {}
+        self.archives = {}
+        self.execs = {}
+        # How many times exec_inspect reports the command still running
+        self.exec_running = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b'\r\n')
+                except asyncio.IncompleteReadError:
+                    return
+                method, url, _ = line.decode('latin1').split(' ')
+                headers = {}
+                while True:
+                    line = await reader.readuntil(b'\r\n')
+                    if line == b'\r\n':
+                        break
+                    name, value = line.decode('latin1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get('transfer-encoding') == 'chunked':
+                    body = b''
+                    while True:
+                        size = int(await reader.readuntil(b'\r\n'), 16)
+                        if size == 0:
+                            await reader.readuntil(b'\r\n')
+                            break
+                        body += await reader.readexactly(size)
+                        await reader.readexactly(2)
+                else:
+                    body = await reader.readexactly(
+                        int(headers.get('content-length', '0')),
+                    )
+
+                url = urlparse(url)
+                assert url.path.startswith('/v1.41/')
+                path = url.path[6:]
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if not await self.route(
+                    method, path, params, body, reader, writer,
+                ):
+                    return
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, body=b'', *, chunked=False):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            content_type = 'text/plain'
+        head = 'HTTP/1.1 %d Whatever\r\nContent-Type: %s\r\n' % (
+            status, content_type,
+        )
+        if chunked:
+            writer.write(head.encode() + b'Transfer-Encoding: chunked\r\n\r\n')
+            for i in range(0, len(body), 3):
+                part = body[i:i + 3]
+                writer.write(b'%x\r\n%s\r\n' % (len(part), part))
+            writer.write(b'0\r\n\r\n')
+        elif status == 204:
+            writer.write(head.encode() + b'\r\n')
+        else:
+            writer.write(
+                head.encode()
+                + b'Content-Length: %d\r\n\r\n' % len(body)
+                + body
+            )
+
+    async def route(self, method, path, params, body, reader, writer):
+        if path == '/_ping':
+            self.respond(writer, 200, b'OK')
+        elif path == '/images/create':
+            image = '%s:%s' % (params['fromImage'], params['tag'])
+            self.images[image] = {'Id': 'sha256:' + image}
+            self.respond(
+                writer, 200,
+                b'{"status": "Pulling"}\n{"status": "Done"}\n',
+                chunked=True,
+            )
+        elif path.startswith('/images/') and path.endswith('/json'):
+            image = unquote(path[8:-5])
+            if image not in self.images:
+                self.respond(writer, 404, {'message': "No such image"})
+            else:
+                self.respond(writer, 200, self.images[image])
+        elif path == '/commit':
+            image = '%s:%s' % (params['repo'], params['tag'])
+            self.images[image] = {
+                'Id': 'sha256:' + image,
+                'Config': json.loads(body),
+                'Parent': self.containers[params['container']],
+            }
+            self.respond(writer, 201, {'Id': 'sha256:' + image})
+        elif path == '/containers/create':
+            config = json.loads(body)
+            if config['Image'] not in self.images:
+                self.respond(writer, 404, {'message': "No such image"})
+            else:
+                self.containers[params['name']] = config['Image']
+                self.respond(writer, 201, {'Id': 'abc'})
+        elif path.endswith('/archive') and method == 'PUT':
+            self.archives[params['path']] = body
+            self.respond(writer, 200)
+        elif path == '/containers/c1/archive':
+            if params['path'] not in self.archives:
+                self.respond(writer, 404, {'message': "No such file"})
+            else:
+                self.respond(
+                    writer, 200, self.archives[params['path']], chunked=True,
+                )
+        elif path == '/containers/c1/exec':
+            exec_id = 'e%d' % len(self.execs)
+            self.execs[exec_id] = json.loads(body)
+            self.respond(writer, 201, {'Id': exec_id})
+        elif path.startswith('/exec/') and path.endswith('/start'):
+            exec_id = path[6:-6]
+            writer.write(
+                b'HTTP/1.1 101 UPGRADED\r\n'
+                + b'Connection: Upgrade\r\nUpgrade: tcp\r\n\r\n'
+            )
+            # Echo stdin back as stdout, then write to stderr
+            if self.execs[exec_id]['AttachStdin']:
+                data = await reader.read()
+                writer.write(struct.pack('>BxxxL', 1, len(data)) + data)
+            writer.write(struct.pack('>BxxxL', 2, 6) + b'error\n')
+            await writer.drain()
+            return False
+        elif path.startswith('/exec/') and path.endswith('/json'):
+            if self.exec_running:
+                self.exec_running -= 1
+                self.respond(writer, 200, {'Running': True, 'ExitCode': None})
+            else:
+                self.respond(writer, 200, {'Running': False, 'ExitCode': 3})
+        elif path.startswith('/containers/') and method == 'DELETE':
+            assert params['force'] == '1'
+            if self.containers.pop(path[12:], None) is None:
+                self.respond(writer, 404, {'message': "No such container"})
+            else:
+                self.respond(writer, 204)
+        else:
+            self.respond(writer, 500, {'message': "Unknown %s" % path})
+        await writer.drain()
+        return True
+
+
+class TestDockerApi(AsyncTestCase):
+    def setUp(self):
+        super(TestDockerApi, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmp, 'docker.sock')
+        self.fake = FakeDocker()
+        self.server = self.io_loop.run_sync(
+            lambda: asyncio.start_unix_server(self.fake.handle, self.socket),
+        )
+        self.client = DockerClient('unix://' + self.socket)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+        shutil.rmtree(self.tmp)
+        super(TestDockerApi, self).tearDown()
+
+    @gen_test
+    async def test_calls(self):
+        await self.client.ping()
+
+        config = {'Image': 'busybox:latest', 'Cmd': ['true']}
+        with self.assertRaises(DockerError) as cm:
+            await self.client.create_container('c1', config)
+        self.assertEqual(cm.exception.status, 404)
+        self.assertEqual(cm.exception.message, "No such image")
+
+        await self.client.pull_image('busybox')
+        self.assertEqual(
+            await self.client.create_container('c1', config),
+            {'Id': 'abc'},
+        )
+
+        async def data():
+            yield b'hello '
+            yield b'world'
+
+        await self.client.put_archive('c1', '/data', data())
+        self.assertEqual(self.fake.archives, {'/data': b'hello world'})
+        self.assertEqual(
+            b''.join([
+                chunk
+                async for chunk in self.client.get_archive('c1', '/data')
+            ]),
+            b'hello world',
+        )
+        with self.assertRaises(DockerError):
+            async for chunk in self.client.get_archive('c1', '/missing'):
+                pass
+
+        await self.client.remove_container('c1')
+
+        # All those calls went over the same connection
+        self.assertEqual(self.fake.connections, 1)
+
+    @gen_test
+    async def test_exec(self):
+        async def stdin():
+            yield b'line 1\n'
+            yield b'line 2\n'
+
+        output = asyncio.StreamReader()
+        ret = await self.client.exec_run(
+            'c1', ['cat'],
+            stdin=stdin(), output=output,
+        )
+        self.assertEqual(ret, 3)
+        self.assertEqual(
+            await output.read(),
+            b'line 1\nline 2\nerror\n',
+        )
+        self.assertEqual(
+            self.fake.execs['e0'],
+            {
+                'Cmd': ['cat'],
+                'AttachStdin': True,
+                'AttachStdout': True,
+                'AttachStderr': True,
+                'Tty': False,
+            },
+        )
+
+        # Without stdin, output gets logged
+        ret = await self.client.exec_run('c1', ['true'])
+        self.assertEqual(ret, 3)
+        self.assertFalse(self.fake.execs['e1']['AttachStdin'])
+
+    @gen_test
+    async def test_exec_exit(self):
+        # The command can take a while to exit after closing its output
+        self.fake.exec_running = 50
+        with patch('reproserver.run.docker_api.EXEC_POLL_INTERVAL', 0.01):
+            ret = await self.client.exec_run('c1', ['true'])
+        self.assertEqual(ret, 3)
+
+        # But not forever
+        self.fake.exec_running = 1000
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(
+                patch('reproserver.run.docker_api.EXEC_POLL_INTERVAL', 0.01),
+            )
+            stack.enter_context(
+                patch('reproserver.run.docker_api.EXEC_EXIT_TIMEOUT', 0.2),
+            )
+            with self.assertRaises(TimeoutError):
+                await self.client.exec_run('c1', ['true'])
+
+    @gen_test
+    async def test_derived_image(self):
+        tools = os.path.join(self.tmp, 'tools')
+        os.mkdir(tools)
+        with open(os.path.join(tools, 'busybox'), 'wb') as fp:
+            fp.write(b'#!busybox')
+        docker.tools_version.cache_clear()
+        self.addCleanup(docker.tools_version.cache_clear)
+
+        with patch.object(docker, 'RPZ_TOOLS_DIR', tools):
+            runner = DockerRunner(None)
+            runner.docker.close()
+            runner.docker = self.client
+
+            # Base image gets pulled, derived image gets built from it
+            image = await runner._derived_image('debian:bookworm')
+            self.assertTrue(image.startswith('reproserver-run:'))
+            self.assertEqual(
+                self.fake.images[image]['Parent'],
+                'debian:bookworm',
+            )
+            self.assertEqual(
+                self.fake.images[image]['Config']['Labels'],
+                {
+                    'reproserver.base-image': 'debian:bookworm',
+                    'reproserver.tools-version': docker.tools_version(),
+                },
+            )
+            self.assertIn('/', self.fake.archives)
+            # Build container was removed
+            self.assertEqual(self.fake.containers, {})
+
+            # Second time, it is reused
+            self.fake.archives.clear()
+            self.assertEqual(
+                await runner._derived_image('debian:bookworm'),
+                image,
+            )
+            self.assertEqual(self.fake.archives, {})
+
+            # New tools means new image
+            with open(os.path.join(tools, 'busybox'), 'wb') as fp:
+                fp.write(b'#!busybox 2')
+            docker.tools_version.cache_clear()
+            self.assertNotEqual(
+                await runner._derived_image('debian:bookworm'),
+                image,
+            )
+
+    @gen_test
+    async def test_tar_stream(self):
+        files = []
+        for i, size in enumerate([0, 5, 512, 1000]):
+            local_path = os.path.join(self.tmp, 'input_%d' % i)
+            with open(local_path, 'wb') as fp:
+                fp.write(b'%d' % i * size)
+            files.append((open(local_path, 'rb'), '/data/dir%d/file' % i))
+
+        data = b''.join([chunk async for chunk in tar_stream(files)])
+        self.assertTrue(all(fp.closed for fp, _ in files))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.assertEqual(
+                [(m.name, m.size) for m in tar.getmembers()],
+                [
+                    ('data/dir0/file', 0),
+                    ('data/dir1/file', 5),
+                    ('data/dir2/file', 512),
+                    ('data/dir3/file', 1000),
+                ],
+            )
+            self.assertEqual(
+                tar.extractfile('data/dir3/file').read(),
+                b'3' * 1000,
+            )
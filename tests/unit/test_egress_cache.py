@@ -0,0 +1,211 @@
+import asyncio
+import base64
+import signal
+import tempfile
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port, gen_test
+import tornado.web
+
+from reproserver.egress_cache import DiskCache, EgressCacheApplication, \
+    cache_lifetime
+
+
+class Origin(tornado.web.RequestHandler):
+    """Stand-in for a server on the internet.
+    """
+    requests = 0
+    big_sent = 0
+
+    def compute_etag(self):
+        return None
+
+    async def get(self, name):
+        Origin.requests += 1
+        if name == 'big':
+            # Sends as fast as the proxy reads
+            for _ in range(BIG_CHUNKS):
+                self.write(b'x' * 65536)
+                await self.flush()
+                Origin.big_sent += 65536
+            return await self.finish()
+        if name == 'private':
+            self.set_header('Cache-Control', 'private')
+        elif name != 'dynamic':
+            self.set_header('Last-Modified', 'Wed, 01 Jan 2020 00:00:00 GMT')
+        self.finish(('content of %s' % name).encode('utf-8') * 100)
+
+
+BIG_CHUNKS = 1000  # 65 MB
+
+
+def dechunk(body):
+    result = []
+    pos = 0
+    while True:
+        end = body.index(b'\r\n', pos)
+        size = int(body[pos:end], 16)
+        if not size:
+            return b''.join(result)
+        result.append(body[end + 2:end + 2 + size])
+        pos = end + 4 + size
+
+
+class TestEgressCache(AsyncHTTPTestCase):
+    def setUp(self):
+        self.signals = (
+            signal.getsignal(signal.SIGTERM),
+            signal.getsignal(signal.SIGINT),
+        )
+        self.cache_dir = tempfile.TemporaryDirectory()
+        super(TestEgressCache, self).setUp()
+
+        # Start the origin server
+        sock, port = bind_unused_port()
+        self.origin = HTTPServer(tornado.web.Application([
+            ('/(.+)', Origin),
+        ]))
+        self.origin.add_sockets([sock])
+        self.origin_url = 'http://127.0.0.1:%d' % port
+        Origin.requests = 0
+        Origin.big_sent = 0
+
+    def tearDown(self):
+        self.origin.stop()
+        super(TestEgressCache, self).tearDown()
+        self.cache_dir.cleanup()
+        signal.signal(signal.SIGTERM, self.signals[0])
+        signal.signal(signal.SIGINT, self.signals[1])
+
+    def get_app(self):
+        self.cache = DiskCache(self.cache_dir.name, 4000, 2000)
+        self.app = EgressCacheApplication(self.cache, default_ttl=3600)
+        return self.app
+
+    async def request_through(self, path, run_id):
+        """Send a request through the proxy, like a run would.
+        """
+        stream = await TCPClient().connect('127.0.0.1', self.get_http_port())
+        auth = base64.b64encode(b'run%d:run' % run_id).decode('ascii')
+        request = (
+            'GET %s%s HTTP/1.1\r\n'
+            'Host: %s\r\n'
+            'Proxy-Authorization: Basic %s\r\n'
+            'Connection: close\r\n'
+            '\r\n'
+        ) % (self.origin_url, path, self.origin_url[7:], auth)
+        await stream.write(request.encode('ascii'))
+        return stream
+
+    async def fetch_through(self, path, run_id):
+        stream = await self.request_through(path, run_id)
+        response = await stream.read_until_close()
+        head, body = response.split(b'\r\n\r\n', 1)
+        lines = head.decode('iso-8859-1').split('\r\n')
+        headers = HTTPHeaders.parse('\r\n'.join(lines[1:]))
+        if headers.get('Transfer-Encoding') == 'chunked':
+            body = dechunk(body)
+        return lines[0], headers, body
+
+    @gen_test
+    async def test_cache(self):
+        expected = b'content of one' * 100
+
+        # Fetched from the origin, then from the cache
+        status, headers, body = await self.fetch_through('/one', 1)
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertEqual(body, expected)
+        self.assertEqual(headers['X-Cache'], 'MISS')
+        status, headers, body = await self.fetch_through('/one', 2)
+        self.assertEqual(status, 'HTTP/1.1 200 OK')
+        self.assertEqual(body, expected)
+        self.assertEqual(headers['X-Cache'], 'HIT')
+        self.assertEqual(Origin.requests, 1)
+
+        # Private responses are not stored
+        await self.fetch_through('/private', 2)
+        await self.fetch_through('/private', 2)
+        self.assertEqual(Origin.requests, 3)
+
+        # Neither are responses that don't look static
+        await self.fetch_through('/dynamic', 2)
+        await self.fetch_through('/dynamic', 2)
+        self.assertEqual(Origin.requests, 5)
+
+        # Each run has its statistics
+        stats = self.app.stats.get(2)
+        self.assertEqual(stats['hit'], {'requests': 1, 'bytes': 1400})
+        self.assertEqual(stats['uncached']['requests'], 4)
+        stats = self.app.stats.get(1)
+        self.assertEqual(stats['miss'], {'requests': 1, 'bytes': 1400})
+
+        # Least recently used responses are evicted over the size limit
+        await self.fetch_through('/two', 1)
+        await self.fetch_through('/three', 1)
+        self.assertLessEqual(self.cache.size, 4000)
+        _, headers, _ = await self.fetch_through('/one', 1)
+        self.assertEqual(headers['X-Cache'], 'MISS')
+
+    @gen_test
+    async def test_tunnel(self):
+        stream = await TCPClient().connect('127.0.0.1', self.get_http_port())
+        origin = self.origin_url[7:].encode('ascii')
+        await stream.write(
+            b'CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (origin, origin),
+        )
+        self.assertEqual(
+            await stream.read_until(b'\r\n\r\n'),
+            b'HTTP/1.1 200 Connection established\r\n\r\n',
+        )
+        await stream.write(
+            b'GET /one HTTP/1.1\r\nHost: origin\r\nConnection: close\r\n'
+            b'\r\n',
+        )
+        response = await stream.read_until_close()
+        self.assertTrue(response.endswith(b'content of one'))
+        self.assertEqual(Origin.requests, 1)
+
+    @gen_test
+    async def test_slow_client(self):
+        # The proxy doesn't read from the origin faster than the run reads
+        stream = await self.request_through('/big', 1)
+        await asyncio.sleep(1)
+        self.assertLess(Origin.big_sent, BIG_CHUNKS * 65536 // 2)
+
+        response = await stream.read_until_close()
+        _, body = response.split(b'\r\n\r\n', 1)
+        self.assertEqual(len(dechunk(body)), BIG_CHUNKS * 65536)
+
+    def test_lifetime(self):
+        modified = {'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}
+        self.assertIsNone(cache_lifetime({}, 60))
+        self.assertEqual(cache_lifetime(modified, 60), 60)
+        self.assertEqual(cache_lifetime({'ETag': '"abc"'}, 60), 60)
+        self.assertEqual(
+            cache_lifetime({'Cache-Control': 'public, max-age=10'}, 60),
+            10,
+        )
+        self.assertIsNone(cache_lifetime({'Cache-Control': 'no-store'}, 60))
+        self.assertIsNone(cache_lifetime(
+            {'Cache-Control': 'no-cache'} | modified, 60,
+        ))
+        self.assertIsNone(cache_lifetime({'Vary': 'Cookie'} | modified, 60))
+        self.assertEqual(
+            cache_lifetime({'Vary': 'Accept-Encoding'} | modified, 60),
+            60,
+        )
+
+        # Expires is relative to the server's date
+        date = {'Date': 'Wed, 01 Jan 2020 00:00:00 GMT'}
+        self.assertEqual(
+            cache_lifetime(
+                {'Expires': 'Wed, 01 Jan 2020 00:02:00 GMT'} | date, 60,
+            ),
+            120,
+        )
+        self.assertIsNone(cache_lifetime(
+            {'Expires': 'Tue, 31 Dec 2019 00:00:00 GMT'} | date | modified,
+            60,
+        ))
+        self.assertIsNone(cache_lifetime({'Expires': '0'} | modified, 60))
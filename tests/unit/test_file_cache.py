@@ -0,0 +1,62 @@
+import asyncio
+import os
+import shutil
+import tempfile
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver.run.file_cache import FileCache
+
+
+class TestFileCache(AsyncTestCase):
+    def setUp(self):
+        super(TestFileCache, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.downloads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(TestFileCache, self).tearDown()
+
+    def download(self, data):
+        async def download(path):
+            self.downloads.append(data)
+            await asyncio.sleep(0.01)
+            with open(path, 'wb') as fp:
+                fp.write(data)
+        return download
+
+    async def read(self, cache, key, data):
+        with await cache.open(key, self.download(data)) as fp:
+            return fp.read()
+
+    @gen_test
+    async def test_cache(self):
+        cache = FileCache(self.tmp, 10)
+
+        # Concurrent requests share a single download
+        self.assertEqual(
+            await asyncio.gather(
+                self.read(cache, 'a', b'aaaa'),
+                self.read(cache, 'a', b'aaaa'),
+            ),
+            [b'aaaa', b'aaaa'],
+        )
+        self.assertEqual(self.downloads, [b'aaaa'])
+        self.assertEqual(await self.read(cache, 'a', b'aaaa'), b'aaaa')
+        self.assertEqual(self.downloads, [b'aaaa'])
+
+        # Least recently used gets removed
+        await self.read(cache, 'b', b'bbbb')
+        os.utime(os.path.join(self.tmp, 'b'), (1, 1))
+        await self.read(cache, 'c', b'cccc')
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['a', 'c'])
+
+        # Failed downloads don't leave anything
+        async def fail(path):
+            with open(path, 'wb') as fp:
+                fp.write(b'partial')
+            raise OSError("Download failed")
+
+        with self.assertRaises(OSError):
+            await cache.open('d', fail)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['a', 'c'])
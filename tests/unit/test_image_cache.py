@@ -0,0 +1,78 @@
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+
+from reproserver import database
+from reproserver.run.image_cache import IMAGE_CACHE_REPO, evict_images, \
+    experiment_image_name
+
+
+class FakeRegistry(object):
+    def __init__(self, tags):
+        self.tags = tags
+
+    def make_app(self):
+        registry = self
+
+        class Tags(RequestHandler):
+            def get(self):
+                self.write({'name': IMAGE_CACHE_REPO, 'tags': registry.tags})
+
+        class Manifest(RequestHandler):
+            def head(self, reference):
+                assert 'manifest' in self.request.headers['Accept']
+                self.set_header('Docker-Content-Digest', 'sha256:' + reference)
+
+            def delete(self, reference):
+                registry.tags.remove(reference[7:])
+                self.set_status(202)
+
+        return Application([
+            ('/v2/%s/tags/list' % IMAGE_CACHE_REPO, Tags),
+            ('/v2/%s/manifests/([^/]+)' % IMAGE_CACHE_REPO, Manifest),
+        ])
+
+
+class TestImageCache(AsyncHTTPTestCase):
+    def get_app(self):
+        self.registry = FakeRegistry([
+            'aaaa-tools1', 'aaaa-tools2', 'bbbb-tools2', 'cccc-tools2',
+            'dddd-tools2',
+        ])
+        return self.registry.make_app()
+
+    def test_name(self):
+        self.assertEqual(
+            experiment_image_name('registry:5000', 'aaaa', 'abcdef' * 10),
+            'registry:5000/reproserver-experiment:aaaa-abcdefabcdef',
+        )
+
+    @gen_test
+    async def test_evict(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        for exp in ['aaaa', 'bbbb', 'cccc', 'dddd']:
+            db.add(database.Experiment(hash=exp, size=1, info='{}'))
+        for exp, day in [
+            ('aaaa', 3), ('aaaa', 1), ('bbbb', 2), ('cccc', 4), ('dddd', None),
+        ]:
+            db.add(database.Run(
+                experiment_hash=exp,
+                started=day and datetime(2020, 1, day),
+            ))
+        db.commit()
+
+        # Keep the 2 most recently run experiments
+        await evict_images(
+            DBSession,
+            '127.0.0.1:%d' % self.get_http_port(),
+            2,
+        )
+        self.assertEqual(
+            self.registry.tags,
+            ['aaaa-tools1', 'aaaa-tools2', 'cccc-tools2'],
+        )
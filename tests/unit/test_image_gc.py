@@ -0,0 +1,62 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver.run.docker_api import DockerError
+from reproserver.run.image_gc import ImageCollector
+
+
+MB = 1024 * 1024
+
+
+class FakeDocker(object):
+    def __init__(self, images):
+        self.images = images
+        self.removed = []
+
+    async def system_df(self):
+        return {
+            'LayersSize': sum(image['Size'] for image in self.images),
+            'Images': self.images,
+        }
+
+    async def remove_image(self, image):
+        if image == 'parent:latest':
+            raise DockerError(409, "Image has dependent child images")
+        self.removed.append(image)
+
+
+def image(id, tags, size, created, containers=0, labels=None):
+    return {
+        'Id': id, 'RepoTags': tags, 'Size': size * MB, 'SharedSize': -1,
+        'Created': created, 'Containers': containers, 'Labels': labels,
+    }
+
+
+class TestImageGC(AsyncTestCase):
+    @gen_test
+    async def test_collect(self):
+        docker = FakeDocker([
+            image('1', ['old:1', 'old:2'], 100, 1),
+            image('2', ['parent:latest'], 100, 2),
+            image('3', ['in-use:1'], 100, 3, containers=1),
+            image('4', ['pinned:1'], 100, 4),
+            image('5', [], 100, 5, labels={'derived-from': 'pinned:1'}),
+            image('6', ['recent:1'], 100, 6),
+            image('7', ['new:1'], 100, 7),
+            image('8', ['<none>:<none>'], 100, 8),
+        ])
+        gc = ImageCollector(
+            docker, 1100 * MB, 900 * MB,
+            pinned=lambda: ['pinned:1'],
+            derived_label='derived-from',
+        )
+
+        # Under the high-water mark
+        await gc.collect()
+        self.assertEqual(docker.removed, [])
+
+        # Over it, remove down to the low-water mark
+        docker.images.append(image('9', ['big:1'], 400, 9))
+        gc.touch('recent:1')
+        gc.touch('big:1')
+        await gc.collect()
+        self.assertEqual(docker.removed, ['old:1', 'old:2', 'new:1', '8'])
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from tornado.testing import AsyncTestCase, gen_test
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.run.k8s import K8sWatcher
+
+
+def make_pod(run_id, started):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name='run-%d' % run_id,
+            labels={'run': str(run_id)},
+            deletion_timestamp=None,
+        ),
+        status=SimpleNamespace(start_time=started),
+    )
+
+
+class FakeCoreV1Api(object):
+    def __init__(self, pods):
+        self.pods = pods
+        self.deleted = []
+
+    async def list_namespaced_pod(self, namespace, label_selector):
+        return SimpleNamespace(items=self.pods)
+
+    async def delete_namespaced_pod(self, name, namespace):
+        self.deleted.append(name)
+
+
+class TestPodTimeouts(AsyncTestCase):
+    @gen_test
+    async def test_timeouts(self):
+        # The check queries the database in a thread
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool,
+        )
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        for run_id, timeout in [(1, 600), (2, None), (3, 600)]:
+            db.add(database.Run(
+                id=run_id, experiment_hash='exp', timeout=timeout,
+            ))
+        db.commit()
+
+        env = {
+            'K8S_CONFIG_DIR': '/nonexistent',
+            'RUN_NAMESPACE': 'default',
+            'RUN_LABELS': '{}',
+            'RUN_NAME_PREFIX': '',
+            'RUN_TIMEOUT': '3600',
+        }
+        with patch.dict(os.environ, env):
+            watcher = K8sWatcher(DirectConnector(
+                DBSession=DBSession,
+                object_store=None,
+            ))
+
+            # Pods that don't get any event are checked too
+            now = datetime.now(timezone.utc)
+            api = FakeCoreV1Api([
+                make_pod(1, now - timedelta(hours=1)),
+                make_pod(2, now - timedelta(hours=1)),
+                make_pod(3, now - timedelta(minutes=5)),
+            ])
+            with patch(
+                'reproserver.run.k8s.k8s_client.CoreV1Api',
+                lambda client: api,
+            ):
+                await watcher._check_timeouts(None, DBSession)
+
+        self.assertEqual(api.deleted, ['run-1'])
+        db.expire_all()
+        self.assertIsNotNone(db.query(database.Run).get(1).done)
+        self.assertIsNone(db.query(database.Run).get(2).done)
+        self.assertIsNone(db.query(database.Run).get(3).done)
@@ -0,0 +1,66 @@
+import asyncio
+import gzip
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver.database import LOG_ARCHIVE_NAME
+from reproserver.run.connector import BaseConnector
+from reproserver.run.log_capture import LogCapture
+
+
+class FakeConnector(BaseConnector):
+    RUN_CMD_LOG_INTERVAL = 0
+
+    def __init__(self):
+        self.lines = []
+        self.uploads = {}
+
+    async def log_multiple(self, run_id, lines):
+        self.lines.extend(lines)
+
+    async def upload_output_file(self, run_id, name, file, *, digest=None):
+        self.uploads[name] = file.read()
+
+
+class TestLogCapture(AsyncTestCase):
+    @gen_test
+    async def test_head_tail(self):
+        connector = FakeConnector()
+        capture = LogCapture(3, 2)
+
+        stream = asyncio.StreamReader()
+        stream.feed_data(b''.join(b'line %d\n' % i for i in range(10)))
+        stream.feed_eof()
+
+        async def wait_end():
+            return 0
+
+        ret = await connector.log_output(
+            1, stream, wait_end(), capture=capture,
+        )
+        self.assertEqual(ret, 0)
+        connector.lines.extend(capture.finish())
+        self.assertEqual(connector.lines, [
+            'line 0', 'line 1', 'line 2',
+            "*** Output is long, the next lines will only be shown when the "
+            "run ends",
+            "*** 5 lines skipped, the full log is available with the results",
+            'line 8', 'line 9',
+        ])
+
+        # The whole output is archived
+        await capture.upload(connector, 1)
+        self.assertEqual(
+            gzip.decompress(connector.uploads[LOG_ARCHIVE_NAME]),
+            b''.join(b'line %d\n' % i for i in range(10)),
+        )
+
+    @gen_test
+    async def test_short(self):
+        connector = FakeConnector()
+        capture = LogCapture(3, 2)
+        for i in range(4):
+            capture.add('line %d' % i)
+        # Nothing was skipped, no need for the archive
+        self.assertEqual(capture.finish(), ['line 3'])
+        await capture.upload(connector, 1)
+        self.assertEqual(connector.uploads, {})
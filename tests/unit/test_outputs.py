@@ -0,0 +1,238 @@
+import hashlib
+import io
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+import tarfile
+from tornado.testing import AsyncHTTPTestCase, gen_test
+import tornado.web
+from unittest.mock import patch
+
+from reproserver import database
+from reproserver.objectstore import ObjectStore
+from reproserver.run.connector import DirectConnector
+from reproserver.run.docker import tar_first_file
+from reproserver.web.api import UploadOutput
+
+
+def make_tar(members, format):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w', format=format) as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+async def chunks(data, size=100):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+class FakeS3(tornado.web.RequestHandler):
+    """Stand-in for the S3 API, storing the objects it receives.
+    """
+    objects = {}
+    uploads = {}
+    parts = 0
+
+    def check_xsrf_cookie(self):
+        pass
+
+    def _body(self):
+        body = self.request.body
+        if 'aws-chunked' in self.request.headers.get('Content-Encoding', ''):
+            body = dechunk(body)
+        return body
+
+    def _xml(self, tag, **fields):
+        self.set_header('Content-Type', 'application/xml')
+        self.finish('<%s>%s</%s>' % (
+            tag,
+            ''.join('<%s>%s</%s>' % (k, v, k) for k, v in fields.items()),
+            tag,
+        ))
+
+    def head(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            raise tornado.web.HTTPError(404)
+        body = self.objects[(bucket, key)]
+        self.set_header('Content-Length', str(len(body)))
+        self.set_header('ETag', '"%s"' % hashlib.md5(body).hexdigest())
+        self.set_header('Last-Modified', 'Wed, 01 Jan 2020 00:00:00 GMT')
+
+    def post(self, bucket, key):
+        if 'uploads' in self.request.arguments:
+            upload_id = 'upload%d' % len(self.uploads)
+            self.uploads[upload_id] = {}
+            self._xml(
+                'InitiateMultipartUploadResult',
+                Bucket=bucket, Key=key, UploadId=upload_id,
+            )
+        else:
+            parts = self.uploads.pop(self.get_argument('uploadId'))
+            self.objects[(bucket, key)] = b''.join(
+                parts[number] for number in sorted(parts)
+            )
+            self._xml(
+                'CompleteMultipartUploadResult',
+                Bucket=bucket, Key=key, ETag='"etag"',
+            )
+
+    def put(self, bucket, key):
+        source = self.request.headers.get('X-Amz-Copy-Source')
+        if source is not None:
+            source_bucket, source_key = source.lstrip('/').split('/', 1)
+            self.objects[(bucket, key)] = \
+                self.objects[(source_bucket, source_key)]
+            return self._xml(
+                'CopyObjectResult',
+                ETag='"etag"', LastModified='2020-01-01T00:00:00.000Z',
+            )
+        body = self._body()
+        if 'uploadId' in self.request.arguments:
+            parts = self.uploads[self.get_argument('uploadId')]
+            parts[int(self.get_argument('partNumber'))] = body
+            FakeS3.parts += 1
+        else:
+            self.objects[(bucket, key)] = body
+        self.set_header('ETag', '"%s"' % hashlib.md5(body).hexdigest())
+
+    def delete(self, bucket, key):
+        if 'uploadId' in self.request.arguments:
+            self.uploads.pop(self.get_argument('uploadId'))
+        else:
+            self.objects.pop((bucket, key), None)
+        self.set_status(204)
+
+
+def dechunk(body):
+    result = []
+    while True:
+        size, body = body.split(b'\r\n', 1)
+        size = int(size.split(b';', 1)[0], 16)
+        if not size:
+            return b''.join(result)
+        result.append(body[:size])
+        body = body[size + 2:]
+
+
+class TestOutputs(AsyncHTTPTestCase):
+    def get_app(self):
+        FakeS3.objects = {}
+        FakeS3.uploads = {}
+        FakeS3.parts = 0
+        app = tornado.web.Application(
+            [
+                ('/runners/run/([^/]+)/output/(.+)', UploadOutput),
+                ('/([^/]+)/(.+)', FakeS3),
+            ],
+            connection_token='token',
+        )
+        # The uploads happen in a thread
+        engine = create_engine(
+            'sqlite://',
+            connect_args={'check_same_thread': False},
+            poolclass=StaticPool,
+        )
+        database.Base.metadata.create_all(bind=engine)
+        app.DBSession = sessionmaker(bind=engine)
+        app.object_store = None
+        return app
+
+    async def first_file(self, data):
+        member = await tar_first_file(chunks(data))
+        if member is None:
+            return None
+        size, content = member
+        content = b''.join([chunk async for chunk in content])
+        self.assertEqual(len(content), size)
+        return content
+
+    @gen_test
+    async def test_tar_first_file(self):
+        long_name = 'dir/' + 'a' * 150
+        for format in (tarfile.USTAR_FORMAT, tarfile.GNU_FORMAT,
+                       tarfile.PAX_FORMAT):
+            self.assertEqual(
+                await self.first_file(make_tar(
+                    [('file', b'hello' * 200), ('other', b'world')],
+                    format,
+                )),
+                b'hello' * 200,
+            )
+            self.assertIsNone(
+                await self.first_file(make_tar([('dir', None)], format)),
+            )
+        for format in (tarfile.GNU_FORMAT, tarfile.PAX_FORMAT):
+            self.assertEqual(
+                await self.first_file(make_tar(
+                    [(long_name, b'long')],
+                    format,
+                )),
+                b'long',
+            )
+
+    @gen_test
+    async def test_upload_stream(self):
+        DBSession = self._app.DBSession
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        run = database.Run(experiment_hash='exp')
+        db.add(run)
+        db.commit()
+
+        env = {'S3_KEY': 'key', 'S3_SECRET': 'secret'}
+        with patch.dict(os.environ, env):
+            object_store = ObjectStore(
+                self.get_url('/'), self.get_url('/'), 'test',
+            )
+        connector = DirectConnector(
+            DBSession=DBSession,
+            object_store=object_store,
+        )
+        data = b'output data\n' * 1000
+        with patch('reproserver.run.connector.UPLOAD_PART_SIZE', 5000):
+            await connector.upload_output_stream(
+                run.id, 'out', len(data), chunks(data),
+            )
+            self.assertEqual(FakeS3.parts, 3)
+
+            # An upload that doesn't match its size is abandoned
+            with self.assertRaises(ValueError):
+                await connector.upload_output_stream(
+                    run.id, 'bad', len(data) + 1, chunks(data),
+                )
+        digest = hashlib.sha256(data).hexdigest()
+        self.assertEqual(FakeS3.objects, {('testoutputs', digest): data})
+        self.assertEqual(FakeS3.uploads, {})
+        db.expire_all()
+        self.assertEqual(
+            [(f.name, f.hash, f.size) for f in run.output_files],
+            [('out', digest, len(data))],
+        )
+
+    @gen_test
+    async def test_upload_handler_failure(self):
+        async def failing_upload(self, run_id, name, size, stream):
+            raise RuntimeError("Object store unavailable")
+
+        # The request fails instead of waiting on the queue forever
+        with patch.object(
+            DirectConnector, 'upload_output_stream', failing_upload,
+        ):
+            response = await self.http_client.fetch(
+                self.get_url('/runners/run/1/output/out'),
+                method='PUT',
+                headers={'X-Reproserver-Authenticate': 'token'},
+                body=b'output data\n' * 1000000,
+                raise_error=False,
+                request_timeout=10,
+            )
+        self.assertEqual(response.code, 500)
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.run.phases import PhaseTimer, waterfall
+
+
+class TestPhases(AsyncTestCase):
+    @gen_test
+    async def test_record(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        run = database.Run(
+            experiment_hash='exp',
+            submitted=datetime(2020, 1, 1, 12, 0, 0),
+        )
+        db.add(run)
+        db.commit()
+        connector = DirectConnector(DBSession=DBSession, object_store=None)
+
+        run_info = await connector.init_run_get_info(run.id)
+        self.assertEqual(run_info['queued_since'], '2020-01-01T12:00:00')
+
+        phases = PhaseTimer(connector, run.id)
+        phases.record(
+            'queued',
+            datetime(2020, 1, 1, 12, 0, 0),
+            datetime(2020, 1, 1, 12, 0, 4),
+        )
+        # Failed phases are recorded too
+        with self.assertRaises(ValueError):
+            with phases.phase('run'):
+                raise ValueError
+        await phases.flush()
+
+        db.expire_all()
+        run = db.query(database.Run).get(run.id)
+        self.assertEqual([e.phase for e in run.events], ['queued', 'run'])
+
+        # Waking up the run forgets them
+        run.sleeping = True
+        db.commit()
+        self.assertTrue(await connector.wake_run(run.id))
+        db.expire_all()
+        self.assertEqual(db.query(database.RunEvent).count(), 0)
+
+    def test_waterfall(self):
+        start = datetime(2020, 1, 1, 12, 0, 0)
+
+        def event(phase, offset, duration):
+            return database.RunEvent(
+                phase=phase,
+                start=start + timedelta(seconds=offset),
+                end=start + timedelta(seconds=offset + duration),
+            )
+
+        self.assertEqual(
+            waterfall([
+                event('queued', 0, 2),
+                event('bundle', 2, 4),
+                event('inputs', 2, 8),
+            ]),
+            [
+                ("Queued", 0.0, 2.0, 0.0, 20.0),
+                ("RPZ downloaded", 2.0, 4.0, 20.0, 40.0),
+                ("Inputs placed", 2.0, 8.0, 20.0, 80.0),
+            ],
+        )
+        self.assertEqual(waterfall([]), [])
@@ -0,0 +1,58 @@
+import asyncio
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver.run.docker import ContainerPool, POOL_LABEL
+
+
+class FakeDocker(object):
+    def __init__(self):
+        self.containers = {}
+
+    async def rename_container(self, container, name):
+        self.containers[name] = self.containers.pop(container)
+
+    async def remove_container(self, container):
+        del self.containers[container]
+
+
+class FakeRunner(object):
+    def __init__(self):
+        self.docker = FakeDocker()
+
+    async def _prepare_container(self, container, image_name, *,
+                                 lifetime, labels):
+        assert labels == {POOL_LABEL: image_name}
+        working_dir = '/.rpz.%s' % container
+        self.docker.containers[container] = image_name, working_dir
+        return working_dir
+
+
+class TestPool(AsyncTestCase):
+    @gen_test
+    async def test_claim(self):
+        runner = FakeRunner()
+        pool = ContainerPool(runner, 2, ['debian:bookworm'])
+        self.assertEqual(pool.wanted_images(), ['debian:bookworm'])
+
+        # Nothing ready, containers get created for it and the listed one
+        self.assertIsNone(await pool.claim('ubuntu:24.04', 'run_1'))
+        await asyncio.sleep(0.01)
+        self.assertEqual(
+            sorted(image for image, _ in runner.docker.containers.values()),
+            ['debian:bookworm'] * 2 + ['ubuntu:24.04'] * 2,
+        )
+
+        # Container is taken from the pool, and replaced
+        working_dir = await pool.claim('ubuntu:24.04', 'run_2')
+        self.assertEqual(
+            runner.docker.containers['run_2'],
+            ('ubuntu:24.04', working_dir),
+        )
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(pool.ready['ubuntu:24.04']), 2)
+        self.assertEqual(len(runner.docker.containers), 5)
+
+    def test_wanted_images(self):
+        pool = ContainerPool(FakeRunner(), 1, ['a'])
+        pool.recent_images.extend(['b', 'c', 'c', 'd', 'd', 'd', 'e', 'a'])
+        self.assertEqual(pool.wanted_images(), ['a', 'd', 'c', 'b'])
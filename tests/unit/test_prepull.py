@@ -0,0 +1,127 @@
+import asyncio
+from datetime import datetime, timedelta
+import json
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+import tornado.web
+from unittest.mock import patch
+
+from reproserver import database
+from reproserver.run.prepull import Prepuller, popular_base_images, \
+    warm_mirror
+
+
+# Larger than the HTTP client's default body limit of 100 MB
+LAYER_SIZE = 150_000_000
+
+
+def fake_base_image(experiment):
+    return json.loads(experiment.info)['image']
+
+
+class FakeRunner(object):
+    def __init__(self):
+        self.pulled = []
+
+    async def prepull(self, image):
+        await asyncio.sleep(0.01)
+        self.pulled.append(image)
+
+
+class TestPrepull(AsyncTestCase):
+    def test_popular(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        for exp, image in [
+            ('aaaa', 'debian:11'), ('bbbb', 'ubuntu:22.04'),
+            ('cccc', 'debian:11'), ('dddd', 'centos:7'),
+        ]:
+            db.add(database.Experiment(
+                hash=exp, size=1, info=json.dumps({'image': image}),
+            ))
+        now = datetime.utcnow()
+        for exp, days in [
+            ('aaaa', 1), ('bbbb', 1), ('bbbb', 2), ('cccc', 3),
+            ('cccc', 4), ('dddd', 30), ('dddd', 30), ('dddd', 30),
+        ]:
+            db.add(database.Run(
+                experiment_hash=exp,
+                submitted=now - timedelta(days=days),
+            ))
+        db.commit()
+
+        with patch('reproserver.run.prepull.base_image', fake_base_image):
+            # Old runs are not counted
+            self.assertEqual(
+                popular_base_images(db, 2),
+                ['debian:11', 'ubuntu:22.04'],
+            )
+            self.assertEqual(
+                popular_base_images(db, 1, window=timedelta(days=60)),
+                ['debian:11'],
+            )
+
+    @gen_test
+    async def test_dedupe(self):
+        runner = FakeRunner()
+        prepuller = Prepuller(runner, None, 5)
+
+        # Concurrent requests share a pull
+        await asyncio.gather(
+            prepuller.pull('debian:11', 'upload'),
+            prepuller.pull('debian:11', 'popular'),
+            prepuller.pull('ubuntu:22.04', 'upload'),
+        )
+        self.assertEqual(sorted(runner.pulled), ['debian:11', 'ubuntu:22.04'])
+
+        # Recently pulled images are not pulled again
+        await prepuller.pull('debian:11', 'upload')
+        self.assertEqual(len(runner.pulled), 2)
+
+
+class FakeRegistry(tornado.web.RequestHandler):
+    """Stand-in for a registry mirror, serving one image.
+    """
+    fetched = {}
+
+    def compute_etag(self):
+        return None
+
+    async def get(self, name, kind, reference):
+        if kind == 'manifests':
+            return self.finish({
+                'config': {'digest': 'sha256:config'},
+                'layers': [{'digest': 'sha256:layer'}],
+            })
+        size = LAYER_SIZE if reference == 'sha256:layer' else 100
+        self.set_header('Content-Length', str(size))
+        chunk = b'\0' * 1_000_000
+        sent = 0
+        while sent < size:
+            data = chunk[:size - sent]
+            self.write(data)
+            await self.flush()
+            sent += len(data)
+        FakeRegistry.fetched[reference] = sent
+
+
+class TestWarmMirror(AsyncHTTPTestCase):
+    def get_app(self):
+        FakeRegistry.fetched = {}
+        return tornado.web.Application([
+            ('/v2/(.+)/(manifests|blobs)/([^/]+)', FakeRegistry),
+        ])
+
+    @gen_test(timeout=60)
+    async def test_large_layer(self):
+        await warm_mirror(
+            '127.0.0.1:%d' % self.get_http_port(),
+            'debian:11',
+        )
+        self.assertEqual(
+            FakeRegistry.fetched,
+            {'sha256:config': 100, 'sha256:layer': LAYER_SIZE},
+        )
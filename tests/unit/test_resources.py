@@ -0,0 +1,98 @@
+import asyncio
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.run.resources import ResourceSampler, parse_stats
+
+
+def make_stats(cpu, memory, read, write, rx):
+    return {
+        'cpu_stats': {'cpu_usage': {'total_usage': cpu}},
+        'memory_stats': {'usage': memory, 'stats': {'inactive_file': 100}},
+        'blkio_stats': {'io_service_bytes_recursive': [
+            {'major': 8, 'minor': 0, 'op': 'read', 'value': read},
+            {'major': 8, 'minor': 16, 'op': 'Read', 'value': 1},
+            {'major': 8, 'minor': 0, 'op': 'write', 'value': write},
+        ]},
+        'networks': {
+            'eth0': {'rx_bytes': rx, 'tx_bytes': 10},
+            'eth1': {'rx_bytes': 1, 'tx_bytes': 0},
+        },
+    }
+
+
+class FakeDocker(object):
+    def __init__(self, samples):
+        self.samples = samples
+
+    async def container_stats(self, container):
+        return self.samples.pop(0)
+
+
+class TestResources(AsyncTestCase):
+    def test_parse(self):
+        self.assertEqual(
+            parse_stats(make_stats(5000, 1100, 20, 30, 40)),
+            {
+                'cpu_ns': 5000,
+                'memory': 1000,
+                'disk_read': 21,
+                'disk_write': 30,
+                'network_rx': 41,
+                'network_tx': 10,
+            },
+        )
+        # cgroup v2 hosts don't report blkio
+        stats = make_stats(1, 1, 0, 0, 0)
+        stats['blkio_stats'] = {'io_service_bytes_recursive': None}
+        self.assertEqual(parse_stats(stats)['disk_read'], 0)
+
+    @gen_test
+    async def test_sampler(self):
+        docker = FakeDocker([
+            make_stats(1_000_000_000, 1100, 20, 30, 40),
+            make_stats(3_000_000_000, 5100, 120, 30, 40),
+            make_stats(3_500_000_000, 2100, 220, 530, 1040),
+        ])
+        sampler = ResourceSampler(docker, 'container', 0.01)
+        await sampler.start()
+        while docker.samples[1:]:
+            await asyncio.sleep(0.01)
+        usage = await sampler.stop()
+        self.assertEqual(usage, {
+            'cpu_seconds': 2.5,
+            'memory_peak': 5000,
+            'disk_read': 200,
+            'disk_write': 500,
+            'network_rx': 1000,
+            'network_tx': 0,
+        })
+
+    @gen_test
+    async def test_store(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        run = database.Run(experiment_hash='exp')
+        db.add(run)
+        db.commit()
+
+        connector = DirectConnector(DBSession=DBSession, object_store=None)
+        await connector.run_resources(run.id, {
+            'cpu_seconds': 2.5,
+            'memory_peak': 5 * 2 ** 30,
+            'disk_read': 200,
+            'disk_write': 500,
+            'network_rx': 1000,
+            'network_tx': 0,
+        })
+        db.expire_all()
+        run = db.query(database.Run).get(run.id)
+        self.assertEqual(run.cpu_seconds, 2.5)
+        self.assertEqual(run.memory_peak, 5 * 2 ** 30)
+        self.assertEqual(run.network_rx, 1000)
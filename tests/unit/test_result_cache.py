@@ -0,0 +1,110 @@
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+from unittest.mock import patch
+
+from reproserver import database
+from reproserver.run.connector import DirectConnector
+from reproserver.run.result_cache import compute_cache_key, \
+    find_cached_run, reuse_results
+from reproserver.shortid import ShortIDs
+
+
+class TestResultCache(AsyncTestCase):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        self.DBSession = sessionmaker(bind=engine)
+        self.db = self.DBSession()
+        self.experiment = database.Experiment(hash='exp', size=1, info='{}')
+        self.experiment.parameters.append(database.Parameter(
+            name='size', description="Size", optional=True, default='10',
+        ))
+        self.experiment.parameters.append(database.Parameter(
+            name='mode', description="Mode", optional=False, default=None,
+        ))
+        self.db.add(self.experiment)
+        self.db.commit()
+
+    def key(self, params, inputs=()):
+        return compute_cache_key(
+            self.experiment,
+            [database.ParameterValue(name=k, value=v) for k, v in params],
+            [database.InputFile(name=n, hash=h, size=1) for n, h in inputs],
+        )
+
+    def test_key(self):
+        # Default values are the same as unset
+        self.assertEqual(
+            self.key([('mode', 'fast')]),
+            self.key([('mode', 'fast'), ('size', '10')]),
+        )
+        self.assertNotEqual(
+            self.key([('mode', 'fast')]),
+            self.key([('mode', 'fast'), ('size', '11')]),
+        )
+
+        # Order doesn't matter
+        self.assertEqual(
+            self.key([('mode', 'a')], [('in1', 'aa'), ('in2', 'bb')]),
+            self.key([('mode', 'a')], [('in2', 'bb'), ('in1', 'aa')]),
+        )
+        self.assertNotEqual(
+            self.key([('mode', 'a')], [('in1', 'aa'), ('in2', 'bb')]),
+            self.key([('mode', 'a')], [('in1', 'bb'), ('in2', 'aa')]),
+        )
+
+    @gen_test
+    @patch.object(database, 'run_short_ids', ShortIDs(b'run'), create=True)
+    async def test_reuse(self):
+        db = self.db
+        key = self.key([('mode', 'fast')])
+
+        done = datetime(2020, 1, 1)
+        run = database.Run(
+            experiment_hash='exp', cache_key=key,
+            started=done, done=done,
+        )
+        run.log.append(database.RunLogLine(line="hello", timestamp=done))
+        run.output_files.append(database.OutputFile(
+            name='out', hash='cafe', size=4,
+        ))
+        db.add(run)
+        # In progress, not used
+        db.add(database.Run(experiment_hash='exp', cache_key=key))
+        failed = database.Run(
+            experiment_hash='exp', cache_key=key,
+            started=datetime(2020, 1, 2),
+        )
+        db.add(failed)
+        db.commit()
+
+        # Failed runs are not used
+        connector = DirectConnector(
+            DBSession=self.DBSession,
+            object_store=None,
+        )
+        await connector.run_failed(failed.id, "Error")
+        db.expire_all()
+        self.assertIsNone(failed.cache_key)
+
+        cached_run = find_cached_run(db, key)
+        self.assertEqual(cached_run.id, run.id)
+        self.assertIsNone(find_cached_run(db, self.key([('mode', 'slow')])))
+
+        new_run = database.Run(experiment_hash='exp')
+        db.add(new_run)
+        reuse_results(new_run, cached_run)
+        db.commit()
+        self.assertIsNotNone(new_run.done)
+        self.assertEqual(new_run.reused_run_id, run.id)
+        self.assertEqual(
+            new_run.get_log(),
+            ["hello", "Results reused from identical run %s" % run.short_id],
+        )
+        self.assertEqual(
+            [(f.name, f.hash) for f in new_run.output_files],
+            [('out', 'cafe')],
+        )
@@ -0,0 +1,199 @@
+import asyncio
+from datetime import datetime, timedelta
+import os
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from tornado.testing import AsyncTestCase, gen_test
+import unittest
+from unittest.mock import patch
+
+from reproserver import database
+from reproserver.run.base import BaseRunner
+from reproserver.run.connector import DirectConnector
+from reproserver.run.duration import percentile, predict_duration
+
+
+class TestDuration(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(percentile([3], 75), 3)
+        self.assertEqual(percentile([4, 1, 3, 2], 50), 2)
+        self.assertEqual(percentile([4, 1, 3, 2], 75), 3)
+        self.assertEqual(percentile([4, 1, 3, 2], 100), 4)
+        self.assertEqual(percentile([4, 1, 3, 2], 0), 1)
+
+    def test_predict(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        db.add(database.Experiment(hash='exp1', size=1, info='{}'))
+        db.add(database.Experiment(hash='exp2', size=1, info='{}'))
+        start = datetime(2020, 1, 1)
+        for i, minutes in enumerate([2, 4, 1, 3]):
+            db.add(database.Run(
+                experiment_hash='exp1',
+                started=start + timedelta(hours=i),
+                done=start + timedelta(hours=i, minutes=minutes),
+                succeeded=True,
+            ))
+        # Not done, ignored
+        db.add(database.Run(experiment_hash='exp1', started=start))
+        # Failed after a long time (e.g. timed out), ignored
+        db.add(database.Run(
+            experiment_hash='exp1',
+            started=start + timedelta(hours=5),
+            done=start + timedelta(hours=6),
+        ))
+        db.commit()
+
+        self.assertEqual(predict_duration(db, 'exp1'), 180)
+        self.assertIsNone(predict_duration(db, 'exp2'))
+
+
+class TestIdle(AsyncTestCase):
+    @gen_test
+    async def test_get_idle_runs(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        now = datetime.utcnow()
+        long_ago = now - timedelta(hours=2)
+
+        def add_run(run_id, *, ports=True, **kwargs):
+            run = database.Run(id=run_id, experiment_hash='exp', **kwargs)
+            if ports:
+                run.ports.append(database.RunPort(port_number=8000))
+            db.add(run)
+
+        # Idle since it started
+        add_run(1, started=long_ago)
+        # Recently used
+        add_run(2, started=long_ago, last_activity=now)
+        # Used a long time ago
+        add_run(3, started=long_ago, last_activity=long_ago)
+        # No ports
+        add_run(4, ports=False, started=long_ago)
+        # Done
+        add_run(5, started=long_ago, done=now)
+        # Not started yet
+        add_run(6)
+        db.commit()
+
+        connector = DirectConnector(DBSession=DBSession, object_store=None)
+        self.assertEqual(
+            sorted(await connector.get_idle_runs(3600)),
+            [1, 3],
+        )
+
+    @gen_test
+    async def test_wake(self):
+        engine = create_engine('sqlite://')
+        database.Base.metadata.create_all(bind=engine)
+        DBSession = sessionmaker(bind=engine)
+        db = DBSession()
+        db.add(database.Experiment(hash='exp', size=1, info='{}'))
+        long_ago = datetime.utcnow() - timedelta(hours=2)
+        db.add(database.Run(
+            id=1, experiment_hash='exp',
+            started=long_ago, done=long_ago,
+        ))
+        db.add(database.Run(id=2, experiment_hash='exp', started=long_ago))
+        db.commit()
+
+        connector = DirectConnector(DBSession=DBSession, object_store=None)
+        await connector.run_sleeping(1)
+
+        # Only sleeping runs can be woken, and only once
+        self.assertFalse(await connector.wake_run(2))
+        self.assertTrue(await connector.wake_run(1))
+        self.assertFalse(await connector.wake_run(1))
+
+        run = db.query(database.Run).get(1)
+        db.refresh(run)
+        self.assertFalse(run.sleeping)
+        self.assertIsNone(run.started)
+        self.assertIsNone(run.done)
+        self.assertIsNotNone(run.last_activity)
+
+
+class FakeConnector(object):
+    def __init__(self, durations):
+        self.durations = durations
+        self.failed = {}
+
+    async def init_run_get_info(self, run_id):
+        return {'id': run_id, 'expected_duration': self.durations[run_id]}
+
+    async def run_failed(self, run_id, error):
+        self.failed[run_id] = error
+
+
+class RecordingRunner(BaseRunner):
+    def __init__(self, connector):
+        super(RecordingRunner, self).__init__(connector)
+        self.order = []
+        self.release = asyncio.Event()
+
+    async def run_inner(self, run_info):
+        self.order.append(run_info['id'])
+        await self.release.wait()
+
+
+class TestQueue(AsyncTestCase):
+    @gen_test
+    async def test_shortest_first(self):
+        with patch.dict(os.environ, {'RUN_SLOTS': '1'}):
+            runner = RecordingRunner(FakeConnector({
+                1: 3600,
+                2: 7200,
+                3: 60,
+                4: None,
+            }))
+
+        # First run takes the slot, others are queued
+        tasks = [asyncio.ensure_future(runner.run(i)) for i in range(1, 5)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(runner.order, [1])
+        self.assertEqual(len(runner.queue), 3)
+
+        # Shortest expected runs go first, unknown uses the default
+        runner.release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(runner.order, [1, 3, 4, 2])
+        self.assertEqual(runner.active, 0)
+        self.assertEqual(runner.connector.failed, {})
+
+    @gen_test
+    async def test_cancel(self):
+        with patch.dict(os.environ, {'RUN_SLOTS': '1'}):
+            runner = RecordingRunner(FakeConnector({1: 60, 2: 60, 3: 60}))
+        tasks = [asyncio.ensure_future(runner.run(i)) for i in (1, 2, 3)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(runner.order, [1])
+
+        # Cancel a queued run, it never starts
+        await runner.cancel(2)
+        # Cancel the running run, the slot goes to the next one
+        await runner.cancel(1)
+        await asyncio.sleep(0.01)
+        self.assertEqual(runner.order, [1, 3])
+        self.assertEqual(
+            runner.connector.failed,
+            {1: "Run cancelled", 2: "Run cancelled"},
+        )
+
+        runner.release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertEqual(runner.active, 0)
+        self.assertEqual(runner.tasks, {})
+
+    @gen_test
+    async def test_unlimited(self):
+        with patch.dict(os.environ, {'RUN_SLOTS': ''}):
+            runner = RecordingRunner(FakeConnector({1: 60, 2: 60}))
+        tasks = [asyncio.ensure_future(runner.run(i)) for i in (1, 2)]
+        await asyncio.sleep(0.01)
+        self.assertEqual(runner.order, [1, 2])
+        runner.release.set()
+        await asyncio.gather(*tasks)
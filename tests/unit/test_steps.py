@@ -0,0 +1,77 @@
+import unittest
+
+from reproserver.run.steps import run_steps, step_snapshot_keys
+
+
+def make_run_info(cmdlines, inputs):
+    return {
+        'experiment_hash': 'exp',
+        'parameters': {
+            'cmdline_%05d' % i: cmd for i, cmd in enumerate(cmdlines)
+        },
+        'inputs': [
+            {'name': name, 'hash': hash, 'path': '/' + name}
+            for name, hash in inputs
+        ],
+        'rpz_meta': {
+            'inputs_outputs': {
+                'data': {'read_runs': [1, 2], 'write_runs': []},
+                'config': {'read_runs': [0], 'write_runs': []},
+            },
+        },
+    }
+
+
+class TestSteps(unittest.TestCase):
+    def test_order(self):
+        run_info = make_run_info(
+            ['prepare'] + ['step%d' % i for i in range(1, 11)], [],
+        )
+        self.assertEqual(
+            run_steps(run_info),
+            ['prepare'] + ['step%d' % i for i in range(1, 11)],
+        )
+
+    def test_keys(self):
+        keys = step_snapshot_keys(
+            make_run_info(['a', 'b', 'c'], [('data', 'h1')]),
+            'tools',
+        )
+        self.assertEqual(len(set(keys)), 3)
+
+        # Changing the last step keeps the earlier snapshots
+        other = step_snapshot_keys(
+            make_run_info(['a', 'b', 'd'], [('data', 'h1')]),
+            'tools',
+        )
+        self.assertEqual(other[:2], keys[:2])
+        self.assertNotEqual(other[2], keys[2])
+
+        # Inputs without metadata invalidate everything
+        other = step_snapshot_keys(
+            make_run_info(['a', 'b', 'c'], [('data', 'h1'), ('new', 'h3')]),
+            'tools',
+        )
+        self.assertNotEqual(other[0], keys[0])
+
+        # So do new tools
+        other = step_snapshot_keys(
+            make_run_info(['a', 'b', 'c'], [('data', 'h1')]),
+            'tools2',
+        )
+        self.assertNotEqual(other[0], keys[0])
+
+    def test_later_step_input(self):
+        # 'data' is only read from the second step, but it is in the container
+        # from the start, so it is part of every snapshot
+        keys = step_snapshot_keys(
+            make_run_info(['a', 'b', 'c'], [('data', 'h1')]),
+            'tools',
+        )
+        for inputs in ([('data', 'h2')], []):
+            other = step_snapshot_keys(
+                make_run_info(['a', 'b', 'c'], inputs),
+                'tools',
+            )
+            for key, other_key in zip(keys, other):
+                self.assertNotEqual(key, other_key)
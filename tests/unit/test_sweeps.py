@@ -0,0 +1,68 @@
+import asyncio
+from tornado.testing import AsyncTestCase, gen_test
+
+from reproserver.run.docker import DockerRunner
+from reproserver.run.docker_api import DockerError
+from reproserver.run.sweeps import expand_sweep
+
+
+class FakeDocker(object):
+    def __init__(self):
+        self.images = set()
+        self.commits = 0
+
+    async def inspect_image(self, image):
+        if image not in self.images:
+            raise DockerError(404, "No such image")
+        return {'Id': image}
+
+    async def commit_container(self, container, repo, tag, *, config=None):
+        await asyncio.sleep(0.01)
+        self.commits += 1
+        self.images.add('%s:%s' % (repo, tag))
+
+    async def list_images(self, *, label=None):
+        return []
+
+
+class TestSweeps(AsyncTestCase):
+    def test_expand(self):
+        self.assertEqual(
+            expand_sweep({'b': ['1', '2'], 'a': ['x'], 'c': ['3', '4']}),
+            [
+                {'a': 'x', 'b': '1', 'c': '3'},
+                {'a': 'x', 'b': '1', 'c': '4'},
+                {'a': 'x', 'b': '2', 'c': '3'},
+                {'a': 'x', 'b': '2', 'c': '4'},
+            ],
+        )
+        self.assertEqual(expand_sweep({}), [{}])
+
+    @gen_test
+    async def test_shared_setup(self):
+        runner = DockerRunner(None)
+        runner.docker.close()
+        docker = runner.docker = FakeDocker()
+        image = 'reproserver-sweep:1-abcd'
+        run_info = {'sweep_id': 1}
+
+        async def run(fail=False):
+            if await runner._claim_sweep_setup(image):
+                return 'shared'
+            await asyncio.sleep(0.01)
+            if fail:
+                runner._release_sweep_setup(image, False)
+                return 'failed'
+            await runner._commit_sweep_setup('run', image, run_info)
+            return 'prepared'
+
+        # The first run failing to prepare the container lets the next do it,
+        # then the others use its image
+        results = await asyncio.gather(
+            run(fail=True), run(), run(), run(),
+        )
+        self.assertEqual(results, ['failed', 'prepared', 'shared', 'shared'])
+        self.assertEqual(docker.commits, 1)
+
+        # Later runs find the image
+        self.assertEqual(await run(), 'shared')